@@ -1,7 +1,8 @@
 from django.contrib import admin
-from .models import Session, Card
+from .models import Session, Card, GenerationJob
 
 # Register your models here.
 
 admin.site.register(Session)
 admin.site.register(Card)
+admin.site.register(GenerationJob)
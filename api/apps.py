@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api"
+
+    def ready(self):
+        # Cached read views follow the writes, see api/caching.py
+        from .caching import connect_signals
+
+        connect_signals()
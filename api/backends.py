@@ -0,0 +1,300 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from typing import List
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from pydantic import BaseModel, Field
+from typing_extensions import TypedDict
+
+from .documents import Download, fetch_document, fetch_documents
+from .metrics import annotate, span
+from .parsing import read_documents
+
+
+class StudySession(BaseModel):
+    """Data model for a study session."""
+
+    description: str = Field(
+        description="High-level summary of the given requirement for the session"
+    )
+    cards: List[TypedDict("cards", {"question": str, "answer": str})] = Field(
+        description="The questions and answers list of JSON objects from the study session"
+    )
+
+
+def session_prompt():
+    from llama_index.core import ChatPromptTemplate
+    from llama_index.core.llms import ChatMessage
+
+    return ChatPromptTemplate(
+        message_templates=[
+            ChatMessage(
+                role="system",
+                content=(
+                    "You are an expert assitant for formatting the structure of a study session with a description and a list of JSON objects called cards"
+                ),
+            ),
+            ChatMessage(
+                role="user",
+                content=(
+                    "Here is the input I want you to format: \n"
+                    "------\n"
+                    "{input}\n"
+                    "------"
+                ),
+            ),
+        ]
+    )
+
+
+class GenerationBackend:
+    """
+    Everything the generation pipeline (api/utils.py) asks of the outside world:
+    fetching and parsing the document, embedding its chunks, the LLM answering the
+    query and the structured output call formatting an answer into a StudySession.
+    The llama_index LLM and query embedding model are installed in its Settings.
+    """
+
+    embedding_model = None
+
+    def callback_manager(self):
+        """
+        Callbacks of the backend's LLMs, they add their tokens to the current span
+        """
+        from llama_index.core.callbacks import CallbackManager
+        from .callbacks import SpanTokenHandler
+
+        return CallbackManager([SpanTokenHandler(self.tokenize)])
+
+    def __init__(self, llm, embed_model):
+        from llama_index.core import Settings
+        from .embeddings import EmbeddingStore
+
+        self.llm = llm
+        self.embed_model = embed_model
+        # Settings hands its callback manager to the LLM, so it has to be ours
+        Settings.callback_manager = llm.callback_manager
+        Settings.llm = llm
+        Settings.embed_model = embed_model
+        self.embedding_store = EmbeddingStore(
+            settings.EMBEDDING_STORE_DIR, self.embedding_model
+        )
+
+    def tokenize(self, text):
+        """
+        Tokens of a text, for the LLM calls that do not report their usage
+        """
+        raise NotImplementedError
+
+    def fetch(self, url, force=False):
+        """
+        Returns (content_hash, Download or None), see api/documents.py
+        """
+        return fetch_document(url, force=force)
+
+    def fetch_many(self, urls):
+        """
+        fetch() of several urls at once, a failed url maps to its exception
+        """
+        return fetch_documents(urls)
+
+    def parse(self, url, download, pages=None):
+        """
+        Returns (documents, base_nodes, objects), from the given pages (0-based) only
+        when there are some
+        """
+        raise NotImplementedError
+
+    def embed(self, texts):
+        """
+        Returns one embedding per text
+        """
+        raise NotImplementedError
+
+    def structured(self, text):
+        """
+        Formats a free text answer into a StudySession
+        """
+        raise NotImplementedError
+
+
+class OpenAIBackend(GenerationBackend):
+    """
+    OpenAI models, LlamaParse and the markdown element parser
+    """
+
+    def __init__(self):
+        from llama_parse import LlamaParse
+        from llama_index.core.node_parser import MarkdownElementNodeParser
+        from llama_index.llms.openai import OpenAI
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        from llama_index.program.openai import OpenAIPydanticProgram
+        from .embeddings import EmbeddingPipeline
+
+        self.embedding_model = settings.EMBEDDING_MODEL
+        callbacks = self.callback_manager()
+        llm = OpenAI(model="gpt-3.5-turbo", temperature=0, callback_manager=callbacks)
+        super().__init__(llm, OpenAIEmbedding(model=settings.EMBEDDING_MODEL))
+        self.node_parser = MarkdownElementNodeParser(
+            llm=OpenAI(model="gpt-3.5-turbo", callback_manager=callbacks),
+            num_workers=8,
+        )
+        self.embedding_pipeline = EmbeddingPipeline(
+            model=settings.EMBEDDING_MODEL,
+            api_key=settings.OPENAI_API_KEY,
+            api_base=settings.EMBEDDING_API_BASE,
+            max_batch_tokens=settings.EMBEDDING_BATCH_TOKENS,
+            max_batch_size=settings.EMBEDDING_BATCH_SIZE,
+            max_in_flight=settings.EMBEDDING_MAX_IN_FLIGHT,
+        )
+
+        # Check parser
+        self.parser = LlamaParse(result_type="markdown")
+        self.program = OpenAIPydanticProgram.from_defaults(
+            output_cls=StudySession,
+            llm=llm,
+            prompt=session_prompt(),
+        )
+
+    def tokenize(self, text):
+        from llama_index.core.utils import get_tokenizer
+
+        return get_tokenizer()(text)
+
+    def parse(self, url, download, pages=None):
+        with span("read") as record:
+            documents = read_documents(url, download, pages)
+            record["documents"] = len(documents)
+        # Also summarizes every table with the LLM
+        with span("parse_elements") as record:
+            nodes = self.node_parser.get_nodes_from_documents(documents)
+            record["nodes"] = len(nodes)
+        with span("parse_objects") as record:
+            base_nodes, objects = self.node_parser.get_nodes_and_objects(nodes)
+            record["nodes"] = len(base_nodes) + len(objects)
+        return documents, base_nodes, objects
+
+    def embed(self, texts):
+        return self.embedding_pipeline(texts)
+
+    def structured(self, text):
+        return self.program(input=text)
+
+
+# Words the fake documents are written with
+FAKE_WORDS = (
+    "mitochondria ribosome enzyme substrate catalyst photosynthesis chlorophyll "
+    "glucose respiration membrane protein nucleus chromosome allele genotype "
+    "phenotype mutation evolution selection population ecosystem biomass "
+    "equilibrium entropy enthalpy kinetics oxidation reduction electrolyte "
+    "polymer monomer isotope neutron electron proton orbital valence"
+).split()
+
+
+class FakeBackend(GenerationBackend):
+    """
+    Deterministic stand-in that never leaves the machine, to load test the API without
+    spending credits. Every provider call waits `latency` seconds and the LLM writes
+    `tokens_per_second` tokens per second (no limit when 0).
+    """
+
+    embedding_model = "fake-embedding"
+    dimensions = 64
+
+    def __init__(self, latency=None, tokens_per_second=None):
+        from llama_index.core.node_parser import SentenceSplitter
+        from llama_index.core.program import LLMTextCompletionProgram
+        from .fakes import FakeEmbedding, FakeLLM, tokenize
+
+        if latency is None:
+            latency = settings.FAKE_BACKEND_LATENCY
+        if tokens_per_second is None:
+            tokens_per_second = settings.FAKE_BACKEND_TOKENS_PER_SECOND
+        self.latency = latency
+        self.tokenize = tokenize
+        llm = FakeLLM(
+            latency=latency,
+            tokens_per_second=tokens_per_second,
+            callback_manager=self.callback_manager(),
+        )
+        super().__init__(llm, FakeEmbedding(self))
+        self.node_parser = SentenceSplitter(chunk_size=256, chunk_overlap=0)
+        self.program = LLMTextCompletionProgram.from_defaults(
+            output_cls=StudySession, llm=llm, prompt=session_prompt()
+        )
+
+    def fetch(self, url, force=False):
+        time.sleep(self.latency)
+        return self.download(url)
+
+    def fetch_many(self, urls):
+        # Concurrently, like the real downloads
+        time.sleep(self.latency)
+        return {url: self.download(url) for url in urls}
+
+    def download(self, url):
+        # A few chapters of text that only depend on the url
+        rng = random.Random(url)
+        paragraphs = [
+            f"## Chapter {number}\n"
+            + " ".join(rng.choice(FAKE_WORDS) for _ in range(120))
+            + "."
+            for number in range(1, 13)
+        ]
+        content = f"# {url}\n\n" + "\n\n".join(paragraphs)
+        content = content.encode()
+        return hashlib.sha256(content).hexdigest(), Download.from_content(
+            content, "text/plain"
+        )
+
+    def parse(self, url, download, pages=None):
+        from llama_index.core.schema import Document
+
+        time.sleep(self.latency)
+        # Every paragraph is a page, labelled the way the PDF reader does it
+        documents = [
+            Document(text=text, metadata={"page_label": str(page + 1), "Source": url})
+            for page, text in enumerate(download.content.decode().split("\n\n"))
+            if pages is None or page in pages
+        ]
+        with span("parse_elements") as record:
+            nodes = self.node_parser.get_nodes_from_documents(documents)
+            record["nodes"] = len(nodes)
+        return documents, nodes, []
+
+    def vector(self, text):
+        digest = hashlib.shake_256(text.encode()).digest(self.dimensions)
+        return [byte / 255 for byte in digest]
+
+    def embed(self, texts):
+        time.sleep(self.latency)
+        annotate(embedding_tokens=sum(len(self.tokenize(text)) for text in texts))
+        return [self.vector(text) for text in texts]
+
+    def structured(self, text):
+        return self.program(input=text)
+
+
+_backend = None
+_backend_key = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Returns the GENERATION_BACKEND of this process, building it on the first call since
+    that imports most of llama_index. A forked process builds its own instead of
+    sharing the parent's HTTP clients.
+    """
+    global _backend, _backend_key
+    key = (os.getpid(), settings.GENERATION_BACKEND)
+    if _backend_key != key:
+        with _backend_lock:
+            if _backend_key != key:
+                _backend = import_string(settings.GENERATION_BACKEND)()
+                _backend_key = key
+    return _backend
@@ -0,0 +1,401 @@
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .jobs import cards_json, run_pending_jobs
+from .models import Session, Card, GenerationJob
+
+BENCHMARK_URL = "https://example.com/benchmark.pdf"
+
+
+def summarize(latencies, errors, seconds):
+    """
+    Latency percentiles in milliseconds and the throughput of one route
+    """
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        centiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p95, p99 = centiles[49], centiles[94], centiles[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else 0.0
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0,
+        "p50_ms": round(p50 * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "p99_ms": round(p99 * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0,
+        "requests_per_second": round(len(latencies) / seconds, 2) if seconds else 0,
+    }
+
+
+class Benchmark:
+    """
+    Seeds `users` users owning `sessions` sessions of `cards` cards each, then times
+    `requests` calls of every route in api/urls.py but the docs with their JWT.
+    Requests go through the Django test client in this process, or to a running
+    server at base_url. Session generation and semantic search are expected to run
+    on api.backends.FakeBackend.
+    """
+
+    def __init__(
+        self,
+        users=5,
+        sessions=20,
+        cards=10,
+        requests=100,
+        generation_requests=10,
+        concurrency=1,
+        base_url=None,
+        seed=0,
+    ):
+        self.users = users
+        self.sessions = sessions
+        self.cards = cards
+        self.requests = requests
+        self.generation_requests = generation_requests
+        self.concurrency = concurrency
+        self.base_url = base_url
+        self.random = random.Random(seed)
+        self.prefix = f"bench-{uuid.uuid4().hex[:8]}-"
+        self.local = threading.local()
+
+    # SEEDING
+    def seed(self):
+        """
+        Bulk inserts the users, their sessions, cards and one finished job each
+        """
+        User.objects.bulk_create(
+            [User(username=f"{self.prefix}{i}") for i in range(self.users)]
+        )
+        # Not every database returns the ids of bulk inserted rows
+        users = list(User.objects.filter(username__startswith=self.prefix))
+        GenerationJob.objects.bulk_create(
+            [
+                GenerationJob(
+                    author=user, status="done", payload={"url": BENCHMARK_URL}
+                )
+                for user in users
+            ]
+        )
+        jobs = dict(
+            GenerationJob.objects.filter(author__in=users).values_list("author", "id")
+        )
+
+        output = {
+            "cards": [
+                {"question": f"Question {i}?", "answer": f"Answer {i}"}
+                for i in range(self.cards)
+            ]
+        }
+        Session.objects.bulk_create(
+            [
+                Session(
+                    url=BENCHMARK_URL,
+                    author=user,
+                    description=f"Session {i}",
+                    cards=cards_json([Card(**card) for card in output["cards"]]),
+                    job_id=jobs[user.id],
+                )
+                for user in users
+                for i in range(self.sessions)
+            ],
+            batch_size=500,
+        )
+        sessions = list(
+            Session.objects.filter(author__in=users).values_list("id", "author")
+        )
+        Card.objects.bulk_create(
+            [
+                Card(
+                    question=card["question"],
+                    answer=card["answer"],
+                    session_id=session_id,
+                    author_id=author_id,
+                )
+                for session_id, author_id in sessions
+                for card in output["cards"]
+            ],
+            batch_size=500,
+        )
+
+        cards = defaultdict(list)
+        for card_id, session_id in Card.objects.filter(author__in=users).values_list(
+            "id", "session"
+        ):
+            cards[session_id].append(card_id)
+        self.owners = []
+        for user in users:
+            self.owners.append(
+                {
+                    "token": str(RefreshToken.for_user(user).access_token),
+                    "job": jobs[user.id],
+                    "sessions": {
+                        session_id: cards[session_id]
+                        for session_id, author_id in sessions
+                        if author_id == user.id
+                    },
+                }
+            )
+
+    def cleanup(self):
+        User.objects.filter(username__startswith=self.prefix).delete()
+
+    # REQUESTS
+    def send(self, method, path, token, body=None):
+        """
+        Sends one request and returns (status code, seconds, parsed body or None)
+        """
+        data = json.dumps(body) if body is not None else None
+        start = time.perf_counter()
+        if self.base_url is None:
+            if not hasattr(self.local, "client"):
+                self.local.client = Client()
+            response = self.local.client.generic(
+                method,
+                path,
+                data=data or "",
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {token}",
+            )
+            with warnings.catch_warnings():
+                # The SSE view streams asynchronously, the test client reads it synchronously
+                warnings.simplefilter("ignore")
+                content = b"".join(response) if response.streaming else response.content
+            status = response.status_code
+        else:
+            import requests
+
+            if not hasattr(self.local, "client"):
+                self.local.client = requests.Session()
+            response = self.local.client.request(
+                method,
+                self.base_url.rstrip("/") + path,
+                data=data,
+                headers={
+                    "Authorization": f"Bearer {token}",
+                    "Content-Type": "application/json",
+                },
+            )
+            content, status = response.content, response.status_code
+        seconds = time.perf_counter() - start
+        if status < 400 and b"event: error\n" in content:
+            # The stream started fine but the generation failed
+            status = 500
+
+        try:
+            parsed = json.loads(content) if content else None
+        except ValueError:
+            parsed = None
+        return status, seconds, parsed
+
+    def pick(self):
+        owner = self.random.choice(self.owners)
+        session = self.random.choice(list(owner["sessions"]))
+        card = self.random.choice(owner["sessions"][session] or [0])
+        return owner, session, card
+
+    def routes(self):
+        """
+        (name, count, request factory) of every route, the factory returns the
+        method, path, token and body of one request
+        """
+        created = []
+        requirement = {"url": BENCHMARK_URL, "requirement": "Key terms"}
+        batch = {
+            "urls": [BENCHMARK_URL, BENCHMARK_URL.replace(".pdf", "-2.pdf")],
+            "requirements": ["Key terms", "Processes"],
+        }
+
+        def route(method, path, body=None):
+            def request():
+                owner, session, card = self.pick()
+                values = {"session": session, "card": card, "job": owner["job"]}
+                request_body = body(card) if callable(body) else body
+                return method, path.format(**values), owner["token"], request_body
+
+            return request
+
+        def delete_created():
+            token, session = created.pop()
+            return "DELETE", f"/api/sessions/{session}/", token, None
+
+        n = self.requests
+        return [
+            ("GET /api/sessions/", n, route("GET", "/api/sessions/")),
+            (
+                "GET /api/sessions/?fields=id,description",
+                n,
+                route("GET", "/api/sessions/?fields=id,description"),
+            ),
+            ("POST /api/sessions/", n, route("POST", "/api/sessions/", requirement)),
+            (
+                "POST /api/sessions/batch/",
+                n,
+                route("POST", "/api/sessions/batch/", batch),
+            ),
+            ("GET /api/sessions/<pk>/", n, route("GET", "/api/sessions/{session}/")),
+            (
+                "GET /api/sessions/<pk>/cards/",
+                n,
+                route("GET", "/api/sessions/{session}/cards/"),
+            ),
+            (
+                "GET /api/sessions/<session>/cards/<pk>/",
+                n,
+                route("GET", "/api/sessions/{session}/cards/{card}/"),
+            ),
+            (
+                "PATCH /api/sessions/<session>/cards/<pk>/",
+                n,
+                route(
+                    "PATCH", "/api/sessions/{session}/cards/{card}/", {"state": "done"}
+                ),
+            ),
+            ("GET /api/cards/", n, route("GET", "/api/cards/")),
+            (
+                "PATCH /api/cards/bulk/",
+                n,
+                route(
+                    "PATCH",
+                    "/api/cards/bulk/",
+                    lambda card: [{"id": card, "state": "done"}],
+                ),
+            ),
+            (
+                "GET /api/cards/search/?q=Question",
+                n,
+                route("GET", "/api/cards/search/?q=Question"),
+            ),
+            (
+                "GET /api/cards/search/?q=Answer&mode=semantic",
+                n,
+                route("GET", "/api/cards/search/?q=Answer&mode=semantic"),
+            ),
+            ("GET /api/cards/<pk>/", n, route("GET", "/api/cards/{card}/")),
+            (
+                "PATCH /api/cards/<pk>/",
+                n,
+                route("PATCH", "/api/cards/{card}/", {"state": "pending"}),
+            ),
+            *(
+                (f"GET /api/export/<kind>/ ({kind})", n, route("GET", path))
+                for kind, path in [
+                    ("csv", "/api/export/csv/"),
+                    ("jsonl", "/api/export/jsonl/"),
+                    ("anki", "/api/export/anki/?session={session}"),
+                ]
+            ),
+            ("GET /api/jobs/<pk>/", n, route("GET", "/api/jobs/{job}/")),
+            (
+                "GET /api/review/next/?limit=20",
+                n,
+                route("GET", "/api/review/next/?limit=20"),
+            ),
+            (
+                "POST /api/review/",
+                n,
+                route(
+                    "POST", "/api/review/", lambda card: [{"id": card, "quality": 4}]
+                ),
+            ),
+            (
+                "POST /api/sessions/stream/",
+                self.generation_requests,
+                route("POST", "/api/sessions/stream/", requirement),
+            ),
+            ("DELETE /api/sessions/<pk>/", None, delete_created),
+        ], created
+
+    def time_route(self, count, make_request, on_response=None):
+        requests = [make_request() for _ in range(count)]
+        latencies, errors = [], 0
+
+        def call(request):
+            method, path, token, body = request
+            status, seconds, parsed = self.send(method, path, token, body)
+            if on_response is not None:
+                on_response(token, status, parsed)
+            return status, seconds
+
+        start = time.perf_counter()
+        if self.concurrency > 1 and self.base_url is not None:
+            with ThreadPoolExecutor(self.concurrency) as pool:
+                results = list(pool.map(call, requests))
+        else:
+            results = [call(request) for request in requests]
+        wall = time.perf_counter() - start
+
+        for status, seconds in results:
+            latencies.append(seconds)
+            errors += status >= 400
+        return summarize(latencies, errors, wall)
+
+    def time_generation(self):
+        """
+        Runs the jobs queued by POST /api/sessions/ and POST /api/sessions/batch/ the
+        way the worker would
+        """
+        start = time.perf_counter()
+        jobs = run_pending_jobs()
+        seconds = time.perf_counter() - start
+        return {
+            "jobs": jobs,
+            "seconds": round(seconds, 3),
+            "jobs_per_second": round(jobs / seconds, 2) if jobs else 0,
+        }
+
+    def run(self):
+        """
+        Times every route and, in process, the background generation of the sessions
+        created through POST /api/sessions/. Returns the JSON report.
+        """
+        self.seed()
+        try:
+            routes, created = self.routes()
+
+            def remember_created(token, status, parsed):
+                if status == 202:
+                    for session in parsed.get("sessions", [parsed]):
+                        created.append((token, session["id"]))
+
+            results = {}
+            for name, count, make_request in routes:
+                if count is None:
+                    # The sessions created by POST /api/sessions/ are deleted, once
+                    # they are generated when the jobs run in this process
+                    if self.base_url is None:
+                        results["generation jobs"] = self.time_generation()
+                    count = len(created)
+                creates = ("POST /api/sessions/", "POST /api/sessions/batch/")
+                on_response = remember_created if name in creates else None
+                results[name] = self.time_route(count, make_request, on_response)
+        finally:
+            self.cleanup()
+
+        return {
+            "meta": {
+                "target": self.base_url or "in-process",
+                "database": connection.vendor,
+                "generation_backend": settings.GENERATION_BACKEND,
+                "users": self.users,
+                "sessions_per_user": self.sessions,
+                "cards_per_session": self.cards,
+                "requests_per_route": self.requests,
+                "concurrency": self.concurrency,
+            },
+            "routes": results,
+        }
@@ -0,0 +1,51 @@
+from django.db import transaction
+from django.db.models import F
+
+from .caching import invalidate_cards
+from .dedup import fingerprint, simhash
+from .models import Card
+
+EDITABLE_FIELDS = ["state", "question", "answer"]
+
+
+def update_cards(author, changes):
+    """
+    Applies every {"id": ..., "state": ..., "question": ..., "answer": ...} change in
+    order to the cards of the user, found with one query. The ones that changed are
+    saved with one UPDATE, in the same transaction. Returns an (id, card) pair per
+    change, card None when the id is not one of the user's cards.
+    """
+    ids = {change["id"] for change in changes}
+    with transaction.atomic():
+        cards = Card.objects.select_for_update().filter(author=author, id__in=ids)
+        cards = {card.id: card for card in cards.defer("embedding")}
+        fields = set()
+        changed = {}
+        edited = set()
+        for change in changes:
+            card = cards.get(change["id"])
+            if card is None:
+                continue
+            for name in EDITABLE_FIELDS:
+                if name in change and getattr(card, name) != change[name]:
+                    setattr(card, name, change[name])
+                    fields.add(name)
+                    changed[card.id] = card
+                    if name != "state":
+                        edited.add(card.id)
+        if edited:
+            # Like CardSerializer.update: compared with new cards by their new text
+            # and embedded again by the worker or the next semantic search. The
+            # embeddings of the other cards are not loaded, the UPDATE keeps them.
+            fields.update(["fingerprint", "simhash", "embedding"])
+            for card in changed.values():
+                card.embedding = F("embedding")
+            for pk in edited:
+                card = cards[pk]
+                card.fingerprint = fingerprint(card.question, card.answer)
+                card.simhash = simhash(card.question, card.answer)
+                card.embedding = None
+        if changed:
+            Card.objects.bulk_update(changed.values(), sorted(fields), batch_size=500)
+        invalidate_cards(changed.values())
+    return [(change["id"], cards.get(change["id"])) for change in changes]
@@ -0,0 +1,164 @@
+import hashlib
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from rest_framework.response import Response
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import Card, GenerationJob, Session
+
+# Read views of this process: cached responses "hits"/"misses", version
+# "invalidations", and "auth_hits"/"auth_misses" of the users behind the tokens
+stats = Counter()
+
+
+def view_cache():
+    return caches["views"]
+
+
+def version_key(scope, pk):
+    return f"views:version:{scope}:{pk}"
+
+
+def versions(keys):
+    """
+    The current value of each version key. A missing one (never set or evicted)
+    starts at the current time, so it never comes back to an older value.
+    """
+    cache = view_cache()
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            value = time.time_ns()
+            found[key] = value if cache.add(key, value, None) else cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump(keys):
+    cache = view_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Not cached, it starts over from a new value
+            pass
+
+
+def invalidate(users=(), sessions=()):
+    """
+    Moves the cached responses of the users and sessions to new versions, the old
+    ones are never read again and expire. Done again once the transaction commits,
+    a request in between may have cached the rows from before it.
+    """
+    if not settings.VIEW_CACHE_TTL:
+        return
+    keys = [version_key("user", pk) for pk in set(users)]
+    keys += [version_key("session", pk) for pk in set(sessions)]
+    if not keys:
+        return
+    stats["invalidations"] += len(keys)
+    bump(keys)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: bump(keys))
+
+
+def invalidate_cards(cards):
+    invalidate(
+        users=[card.author_id for card in cards],
+        sessions=[card.session_id for card in cards],
+    )
+
+
+class CachedReadMixin:
+    """
+    Serves GET from the "views" cache for VIEW_CACHE_TTL seconds. The key is made of
+    the user, the full path with its query and the versions of cache_scopes(), which
+    every write to the cards and sessions in them moves on (see invalidate).
+    """
+
+    def cache_scopes(self):
+        return [("user", self.request.user.pk)]
+
+    def cacheable(self, response):
+        return response.status_code == 200
+
+    def get(self, request, *args, **kwargs):
+        if not settings.VIEW_CACHE_TTL:
+            return super().get(request, *args, **kwargs)
+        scopes = [version_key(scope, pk) for scope, pk in self.cache_scopes()]
+        path = hashlib.sha256(request.get_full_path().encode()).hexdigest()[:32]
+        key = ":".join(
+            ["views", type(self).__name__, str(request.user.pk)]
+            + [str(version) for version in versions(scopes)]
+            + [path]
+        )
+        cache = view_cache()
+        data = cache.get(key)
+        if data is not None:
+            stats["hits"] += 1
+            return Response(data)
+        stats["misses"] += 1
+        response = super().get(request, *args, **kwargs)
+        if self.cacheable(response):
+            cache.set(key, response.data, settings.VIEW_CACHE_TTL)
+        return response
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication keeping the users in the "views" cache, so a cached response
+    costs no query at all. A user is dropped from it when saved or deleted, password
+    changes and deactivations included.
+    """
+
+    def get_user(self, validated_token):
+        if not settings.VIEW_CACHE_TTL:
+            return super().get_user(validated_token)
+        key = f"views:auth:{validated_token.get(api_settings.USER_ID_CLAIM)}"
+        cache = view_cache()
+        user = cache.get(key)
+        if user is not None:
+            stats["auth_hits"] += 1
+            return user
+        stats["auth_misses"] += 1
+        user = super().get_user(validated_token)
+        cache.set(key, user, settings.VIEW_CACHE_TTL)
+        return user
+
+
+def user_changed(sender, instance, **kwargs):
+    if settings.VIEW_CACHE_TTL:
+        view_cache().delete(f"views:auth:{instance.pk}")
+
+
+def card_changed(sender, instance, **kwargs):
+    invalidate_cards([instance])
+
+
+def session_changed(sender, instance, **kwargs):
+    invalidate(users=[instance.author_id], sessions=[instance.pk])
+
+
+def job_changed(sender, instance, **kwargs):
+    # The sessions show the status of their job
+    invalidate(sessions=instance.sessions.values_list("pk", flat=True))
+
+
+def connect_signals():
+    """
+    Invalidates on every save and delete, bulk writes call invalidate themselves
+    """
+    for model, receiver in (
+        (User, user_changed),
+        (Card, card_changed),
+        (Session, session_changed),
+    ):
+        post_save.connect(receiver, sender=model, dispatch_uid=f"views_{model}")
+        post_delete.connect(receiver, sender=model, dispatch_uid=f"views_{model}")
+    post_save.connect(job_changed, sender=GenerationJob, dispatch_uid="views_job")
@@ -0,0 +1,35 @@
+from llama_index.core.callbacks import CBEventType
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.token_counting import get_llm_token_counts
+from llama_index.core.utilities.token_counting import TokenCounter
+
+from .metrics import annotate
+
+
+class SpanTokenHandler(BaseCallbackHandler):
+    """
+    Adds the prompt and completion tokens of every LLM call to the current span,
+    see api/metrics.py. The usage reported by OpenAI is used when there is one.
+    """
+
+    def __init__(self, tokenizer):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.token_counter = TokenCounter(tokenizer=tokenizer)
+
+    def on_event_start(self, event_type, payload=None, event_id="", **kwargs):
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        if event_type != CBEventType.LLM or payload is None:
+            return
+        counts = get_llm_token_counts(self.token_counter, payload, event_id)
+        annotate(
+            prompt_tokens=counts.prompt_token_count,
+            completion_tokens=counts.completion_token_count,
+        )
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
@@ -0,0 +1,150 @@
+import hashlib
+import re
+from collections import Counter
+
+from django.conf import settings
+
+from .models import Card
+
+WORD = re.compile(r"\w+")
+# State of the cards kept with CARD_DEDUP = "flag", never reviewed
+DUPLICATE = "duplicate"
+# The 64 bits of a SimHash in 4 bands of 16: two hashes at most 3 bits apart have at
+# least one identical band
+BANDS = 4
+
+# New cards of this process: "duplicates" of a stored card, "repeated" within a batch
+stats = Counter()
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def fingerprint(question, answer):
+    """
+    sha256 of the words of a card, the same for cards differing in case and
+    punctuation only
+    """
+    text = " ".join(words(question)) + "\n" + " ".join(words(answer))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def simhash(question, answer):
+    """
+    64 bit SimHash of the words and pairs of words of a card, cards worded nearly the
+    same are a few bits apart. Signed to fit a BigIntegerField.
+    """
+    tokens = words(question) + words(answer)
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    weights = [0] * 64
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    value = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a, b):
+    return bin((a ^ b) & (1 << 64) - 1).count("1")
+
+
+def bands(hashes):
+    import numpy as np
+
+    return np.asarray(hashes, dtype=np.int64).view(np.uint16).reshape(-1, BANDS)
+
+
+class CardIndex:
+    """
+    The fingerprints of the stored cards of one author. Exact duplicates are found
+    through card_author_fingerprint_idx, near ones among the SimHashes of all of the
+    author's cards, loaded once and compared band by band with NumPy.
+    """
+
+    def __init__(self, author_id):
+        self.author_id = author_id
+        self.ids = None
+
+    def stored(self):
+        return Card.objects.filter(author_id=self.author_id).exclude(state=DUPLICATE)
+
+    def load(self):
+        import numpy as np
+
+        rows = list(self.stored().exclude(simhash=None).values_list("id", "simhash"))
+        self.ids = [pk for pk, _ in rows]
+        self.hashes = [value for _, value in rows]
+        self.bands = bands(self.hashes) if rows else np.empty((0, BANDS), np.uint16)
+
+    def nearest(self, value):
+        """
+        The id of a stored card at most CARD_DEDUP_MAX_DISTANCE (up to 3) bits away
+        """
+        if self.ids is None:
+            self.load()
+        candidates = (self.bands == bands([value])).any(axis=1).nonzero()[0]
+        for i in candidates:
+            if distance(self.hashes[i], value) <= settings.CARD_DEDUP_MAX_DISTANCE:
+                return self.ids[i]
+        return None
+
+    def originals(self, rows):
+        """
+        For each of the fingerprinted rows, the id of the stored card it repeats or None
+        """
+        exact = dict(
+            self.stored()
+            .filter(fingerprint__in={row.fingerprint for row in rows})
+            .values_list("fingerprint", "id")
+        )
+        found = []
+        for row in rows:
+            original = exact.get(row.fingerprint)
+            if original is None and settings.CARD_DEDUP_MAX_DISTANCE:
+                original = self.nearest(row.simhash)
+            found.append(original)
+        return found
+
+
+def deduplicate(rows):
+    """
+    Fingerprints new Card rows and returns the ones to insert. A card repeating a
+    stored card of its author is kept in the "duplicate" state pointing at it with
+    CARD_DEDUP = "flag", so its session still lists it, or left out with "skip", the
+    stored one and its review history standing for both. Repeats among the new rows
+    are always left out.
+    """
+    for row in rows:
+        row.fingerprint = fingerprint(row.question, row.answer)
+        row.simhash = simhash(row.question, row.answer)
+    if settings.CARD_DEDUP == "off":
+        return rows
+
+    by_author = {}
+    for row in rows:
+        by_author.setdefault(row.author_id, []).append(row)
+    kept = set()
+    for author_id, author_rows in by_author.items():
+        seen = []
+        originals = CardIndex(author_id).originals(author_rows)
+        for row, original in zip(author_rows, originals):
+            if any(
+                row.fingerprint == other.fingerprint
+                or distance(row.simhash, other.simhash)
+                <= settings.CARD_DEDUP_MAX_DISTANCE
+                for other in seen
+            ):
+                stats["repeated"] += 1
+                continue
+            seen.append(row)
+            if original is not None:
+                stats["duplicates"] += 1
+                if settings.CARD_DEDUP == "skip":
+                    continue
+                row.state = DUPLICATE
+                row.duplicate_of_id = original
+            kept.add(id(row))
+    return [row for row in rows if id(row) in kept]
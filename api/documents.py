@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import weakref
+import zlib
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import DocumentSource, ParsedDocument
+
+logger = logging.getLogger(__name__)
+
+# Hit/miss counters of this process, the per-entry hits live in the database
+stats = Counter()
+
+
+class DocumentTooLarge(ValueError):
+    pass
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Download:
+    """
+    A downloaded document, kept in a temporary file rather than in memory.
+    close() removes the file, otherwise it goes when the Download is collected.
+    """
+
+    def __init__(self, path, content_type, size=None):
+        self.path = path
+        self.content_type = content_type
+        self.size = os.path.getsize(path) if size is None else size
+        self._remove = weakref.finalize(self, remove_file, path)
+
+    @classmethod
+    def from_content(cls, content, content_type):
+        with tempfile.NamedTemporaryFile(prefix="download-", delete=False) as file:
+            file.write(content)
+        return cls(file.name, content_type, len(content))
+
+    @property
+    def content(self):
+        with open(self.path, "rb") as file:
+            return file.read()
+
+    def close(self):
+        self._remove()
+
+
+def fetch_document(url, force=False):
+    """
+    Returns the sha256 of what the url serves and the Download when the bytes were
+    actually transferred. Recently checked urls skip the network, older ones are
+    revalidated with their ETag/Last-Modified so an unchanged document is not downloaded.
+    """
+    result = fetch_documents([url], force=force)[url]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def fetch_documents(urls, force=False):
+    """
+    fetch_document for several urls at once. The downloads run concurrently
+    (DOCUMENT_FETCH_CONCURRENCY) and each must finish within DOCUMENT_FETCH_TIMEOUT
+    seconds, so a slow host only holds up its own document. Returns
+    {url: (content_hash, Download or None)} with the exception instead when it failed.
+    """
+    sources = {
+        source.url: source for source in DocumentSource.objects.filter(url__in=urls)
+    }
+    results, pending = {}, {}
+    for url in urls:
+        source = sources.get(url)
+        headers = {"User-Agent": "Magic Browser"}
+        if source is not None and not force:
+            fresh_until = source.checked_at + timedelta(
+                seconds=settings.DOCUMENT_CACHE_REVALIDATE_AFTER
+            )
+            if timezone.now() < fresh_until:
+                stats["fresh"] += 1
+                results[url] = (source.content_hash, None)
+                continue
+            if source.etag:
+                headers["If-None-Match"] = source.etag
+            if source.last_modified:
+                headers["If-Modified-Since"] = source.last_modified
+        pending[url] = headers
+
+    responses = asyncio.run(download_all(pending)) if pending else {}
+    for url, response in responses.items():
+        try:
+            if isinstance(response, Exception):
+                raise response
+            results[url] = store_response(url, sources.get(url), response)
+        except Exception as e:
+            logger.warning("Fetching %s failed: %r", url, e)
+            results[url] = e
+    return results
+
+
+async def download_all(pending):
+    """
+    GETs every url with its headers, returns {url: (response, Download, sha256) or
+    the exception}. The Download and its hash are None when there was no body.
+    """
+    import httpx
+
+    timeout = settings.DOCUMENT_FETCH_TIMEOUT
+    semaphore = asyncio.Semaphore(settings.DOCUMENT_FETCH_CONCURRENCY)
+
+    async def download(client, url, headers):
+        async with semaphore:
+            try:
+                # The client timeout is per read, this one covers the whole download
+                return await asyncio.wait_for(
+                    stream_to_file(client, url, headers), timeout
+                )
+            except (asyncio.TimeoutError, httpx.TimeoutException):
+                return TimeoutError(f"Fetching {url} took more than {timeout} seconds")
+            except Exception as e:
+                return e
+
+    async with httpx.AsyncClient(follow_redirects=True, timeout=timeout) as client:
+        responses = await asyncio.gather(
+            *(download(client, url, headers) for url, headers in pending.items())
+        )
+    return dict(zip(pending, responses))
+
+
+async def stream_to_file(client, url, headers):
+    """
+    Writes the body to a temporary file as it arrives, hashing it on the way, and
+    gives up on documents over DOCUMENT_MAX_BYTES
+    """
+    max_bytes = settings.DOCUMENT_MAX_BYTES
+    too_large = DocumentTooLarge(f"{url} is larger than {max_bytes} bytes")
+    async with client.stream("GET", url, headers=headers) as response:
+        if not response.is_success:
+            return response, None, None
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) > max_bytes:
+            raise too_large
+
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        digest = hashlib.sha256()
+        size = 0
+        file = tempfile.NamedTemporaryFile(prefix="download-", delete=False)
+        try:
+            with file:
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise too_large
+                    digest.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            remove_file(file.name)
+            raise
+    return response, Download(file.name, content_type, size), digest.hexdigest()
+
+
+def store_response(url, source, downloaded):
+    response, download, content_hash = downloaded
+    if response.status_code == 304 and source is not None:
+        stats["not_modified"] += 1
+        source.checked_at = timezone.now()
+        source.save(update_fields=["checked_at"])
+        return source.content_hash, None
+
+    response.raise_for_status()
+    stats["downloads"] += 1
+    DocumentSource.objects.update_or_create(
+        url=url,
+        defaults={
+            "etag": response.headers.get("ETag", ""),
+            "last_modified": response.headers.get("Last-Modified", ""),
+            "content_hash": content_hash,
+            "checked_at": timezone.now(),
+        },
+    )
+    return content_hash, download
+
+
+def parsed_key(content_hash, pages=None):
+    """
+    Cache key of the parser output of a document, or of a selection of its pages
+    """
+    if pages is None:
+        return content_hash
+    selection = ",".join(map(str, pages))
+    return hashlib.sha256(f"{content_hash}:{selection}".encode()).hexdigest()
+
+
+def get_parsed(content_hash):
+    """
+    Returns (documents, base_nodes, objects) for the given content hash or None on a miss
+    """
+    from llama_index.core.storage.docstore.utils import json_to_doc
+
+    entry = ParsedDocument.objects.filter(content_hash=content_hash).first()
+    if entry is None:
+        stats["misses"] += 1
+        return None
+
+    stats["hits"] += 1
+    ParsedDocument.objects.filter(pk=entry.pk).update(
+        hits=F("hits") + 1, last_used_at=timezone.now()
+    )
+    data = json.loads(zlib.decompress(entry.data))
+    return tuple(
+        [json_to_doc(node) for node in data[key]]
+        for key in ("documents", "base_nodes", "objects")
+    )
+
+
+def store_parsed(content_hash, documents, base_nodes, objects):
+    """
+    Caches the parser output and evicts the least recently used entries over the size limit
+    """
+    from llama_index.core.storage.docstore.utils import doc_to_json
+
+    data = zlib.compress(
+        json.dumps(
+            {
+                "documents": [doc_to_json(doc) for doc in documents],
+                "base_nodes": [doc_to_json(node) for node in base_nodes],
+                "objects": [doc_to_json(node) for node in objects],
+            }
+        ).encode()
+    )
+    try:
+        with transaction.atomic():
+            ParsedDocument.objects.create(
+                content_hash=content_hash, data=data, size=len(data)
+            )
+    except IntegrityError:
+        # Another worker parsed the same document at the same time
+        return
+    evict()
+
+
+def evict(max_bytes=None):
+    """
+    Deletes the least recently used entries until the cache fits in max_bytes
+    """
+    if max_bytes is None:
+        max_bytes = settings.DOCUMENT_CACHE_MAX_BYTES
+    total = ParsedDocument.objects.aggregate(total=Sum("size"))["total"] or 0
+    if total <= max_bytes:
+        return 0
+
+    evicted = 0
+    for pk, size in ParsedDocument.objects.order_by("last_used_at").values_list(
+        "pk", "size"
+    ):
+        if total <= max_bytes:
+            break
+        ParsedDocument.objects.filter(pk=pk).delete()
+        total -= size
+        evicted += 1
+    stats["evictions"] += evicted
+    logger.info("Evicted %s parsed documents from the cache", evicted)
+    return evicted
+
+
+def cache_stats():
+    """
+    Summary of the cache contents plus the counters of this process
+    """
+    summary = ParsedDocument.objects.aggregate(size=Sum("size"), hits=Sum("hits"))
+    return {
+        "entries": ParsedDocument.objects.count(),
+        "urls": DocumentSource.objects.count(),
+        "size": summary["size"] or 0,
+        "max_size": settings.DOCUMENT_CACHE_MAX_BYTES,
+        "total_hits": summary["hits"] or 0,
+        "process": dict(stats),
+    }
@@ -0,0 +1,324 @@
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import openai
+
+from .metrics import annotate
+
+logger = logging.getLogger(__name__)
+
+# Reused/embedded counters of this process
+stats = Counter()
+
+# Errors worth retrying, anything else is a bug on our side
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Chunk embeddings of one model keyed by the sha256 of the embedded text. The vectors
+    are appended to a float32 file read back through a NumPy memmap and a SQLite table
+    next to it maps each hash to its row. Both live in the same directory so they always
+    describe the same machine's file, whatever database Django is using.
+    """
+
+    def __init__(self, path, model):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.path / f"{model}.f32"
+        self.vectors_path.touch()
+        self.db_path = self.path / f"{model}.sqlite3"
+        self.lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._vectors = None
+
+    @property
+    def db(self):
+        # SQLite connections must not be shared with forked worker processes
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (text_hash TEXT PRIMARY KEY, row INTEGER NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    @property
+    def dim(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        return row[0] if row else None
+
+    def vectors(self, min_rows=0):
+        """
+        Memmap of every stored vector, reopened when other processes appended rows
+        """
+        dim = self.dim
+        if dim is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self._vectors is None or len(self._vectors) < min_rows:
+            rows = self.vectors_path.stat().st_size // (dim * 4)
+            if rows == 0:
+                return np.zeros((0, dim), dtype=np.float32)
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r", shape=(rows, dim)
+            )
+        return self._vectors
+
+    def get_many(self, hashes):
+        """
+        Returns {hash: vector} for the hashes that are already stored
+        """
+        hashes = list(set(hashes))
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(
+                    self.db.execute(
+                        f"SELECT text_hash, row FROM embeddings WHERE text_hash IN ({placeholders})",
+                        chunk,
+                    ).fetchall()
+                )
+            if not found:
+                return {}
+            vectors = self.vectors(min_rows=max(found.values()) + 1)
+        return {h: vectors[row] for h, row in found.items()}
+
+    def add_many(self, embeddings):
+        """
+        Appends {hash: vector} to the store
+        """
+        if not embeddings:
+            return
+        hashes = list(embeddings)
+        matrix = np.asarray([embeddings[h] for h in hashes], dtype=np.float32)
+        with self.lock, open(self.vectors_path, "ab") as output:
+            # Other processes append to the same file
+            fcntl.flock(output, fcntl.LOCK_EX)
+            try:
+                dim = self.dim
+                if dim is None:
+                    dim = matrix.shape[1]
+                    self.db.execute(
+                        "INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)",
+                        (dim,),
+                    )
+                if matrix.shape[1] != dim:
+                    raise ValueError(
+                        f"Expected embeddings of size {dim}, got {matrix.shape[1]}"
+                    )
+                first_row = output.seek(0, 2) // (dim * 4)
+                output.write(matrix.tobytes())
+                output.flush()
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO embeddings (text_hash, row) VALUES (?, ?)",
+                    [(h, first_row + i) for i, h in enumerate(hashes)],
+                )
+                self.db.commit()
+            finally:
+                fcntl.flock(output, fcntl.LOCK_UN)
+
+    def embed(self, texts, embed_batch):
+        """
+        Returns the embeddings of the texts, calling embed_batch only for the texts
+        the store has never seen
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = self.get_many(hashes)
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in found:
+                missing[h] = text
+
+        stats["reused"] += len(texts) - len(missing)
+        stats["embedded"] += len(missing)
+        if missing:
+            new = dict(zip(missing, embed_batch(list(missing.values()))))
+            self.add_many(new)
+            found.update(new)
+        return [found[h] for h in hashes]
+
+
+@dataclass
+class BatchTiming:
+    batch: int
+    texts: int
+    tokens: int
+    seconds: float
+    retries: int
+
+
+class EmbeddingPipeline:
+    """
+    Embeds texts through an OpenAI compatible /embeddings endpoint. The texts are packed
+    into batches bounded by max_batch_tokens and max_batch_size, and up to max_in_flight
+    batches are sent at once, backing off exponentially on rate limits.
+    """
+
+    def __init__(
+        self,
+        model,
+        api_key=None,
+        api_base=None,
+        max_batch_tokens=20000,
+        max_batch_size=256,
+        max_in_flight=4,
+        max_retries=6,
+        backoff=1.0,
+        timeout=60,
+        count_tokens=None,
+    ):
+        self.model = model
+        self.api_key = api_key
+        self.api_base = api_base
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._count_tokens = count_tokens
+
+    def count_tokens(self, text):
+        if self._count_tokens is None:
+            import tiktoken
+
+            encoding = tiktoken.encoding_for_model(self.model)
+            self._count_tokens = lambda text: len(encoding.encode(text))
+        return self._count_tokens(text)
+
+    def batches(self, texts):
+        """
+        Splits the texts into lists of (position, text, tokens), a text bigger than
+        max_batch_tokens gets a batch of its own
+        """
+        batches = []
+        current, current_tokens = [], 0
+        for position, text in enumerate(texts):
+            tokens = self.count_tokens(text)
+            if current and (
+                current_tokens + tokens > self.max_batch_tokens
+                or len(current) == self.max_batch_size
+            ):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append((position, text, tokens))
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _embed_batch(self, client, semaphore, number, batch):
+        inputs = [text for _, text, _ in batch]
+        retries = 0
+        async with semaphore:
+            start = time.perf_counter()
+            while True:
+                try:
+                    response = await client.embeddings.create(
+                        model=self.model, input=inputs
+                    )
+                    break
+                except RETRYABLE_ERRORS as e:
+                    if retries >= self.max_retries:
+                        raise
+                    delay = self.backoff * 2**retries * (1 + random.random())
+                    if isinstance(e, openai.APIStatusError):
+                        # Honour the wait the server asked for
+                        retry_after = e.response.headers.get("retry-after", "")
+                        if retry_after.replace(".", "", 1).isdigit():
+                            delay = max(delay, float(retry_after))
+                    retries += 1
+                    logger.warning(
+                        "Embedding batch %s failed (%r), retrying in %.1fs",
+                        number,
+                        e,
+                        delay,
+                    )
+                    await asyncio.sleep(delay)
+            seconds = time.perf_counter() - start
+
+        vectors = [
+            item.embedding for item in sorted(response.data, key=lambda d: d.index)
+        ]
+        timing = BatchTiming(
+            batch=number,
+            texts=len(batch),
+            tokens=sum(tokens for _, _, tokens in batch),
+            seconds=seconds,
+            retries=retries,
+        )
+        return [position for position, _, _ in batch], vectors, timing
+
+    async def aembed(self, texts):
+        """
+        Returns the embeddings in the order of the texts and the timing of every batch
+        """
+        embeddings = [None] * len(texts)
+        if not texts:
+            return embeddings, []
+
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        # Retries are handled here so the client must not retry on its own
+        async with openai.AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.api_base,
+            max_retries=0,
+            timeout=self.timeout,
+        ) as client:
+            results = await asyncio.gather(
+                *(
+                    self._embed_batch(client, semaphore, number, batch)
+                    for number, batch in enumerate(self.batches(texts))
+                )
+            )
+
+        timings = []
+        for positions, vectors, timing in results:
+            for position, vector in zip(positions, vectors):
+                embeddings[position] = vector
+            timings.append(timing)
+        return embeddings, timings
+
+    def embed_with_timings(self, texts):
+        return asyncio.run(self.aembed(texts))
+
+    def __call__(self, texts):
+        embeddings, timings = self.embed_with_timings(texts)
+        annotate(
+            embedding_tokens=sum(timing.tokens for timing in timings),
+            batches=len(timings),
+        )
+        logger.info(
+            "Embedded %s texts in %s batches (%.2fs of batch time)",
+            len(texts),
+            len(timings),
+            sum(timing.seconds for timing in timings),
+        )
+        return embeddings
@@ -0,0 +1,146 @@
+import csv
+import io
+import json
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from .models import Card, Session
+
+SESSION_FIELDS = ["id", "url", "created_at", "description"]
+CARD_FIELDS = [
+    "id",
+    "session_id",
+    "question",
+    "answer",
+    "state",
+    "created_at",
+    "due_at",
+    "interval",
+    "ease_factor",
+    "repetitions",
+    "lapses",
+    "last_reviewed_at",
+]
+# Anki's text import, the file says how to read it (Anki 2.1.55 and later)
+ANKI_HEADER = "#separator:tab\n#html:false\n#deck column:3\n#tags column:4\n"
+
+# Exports of this process by format
+stats = Counter()
+
+
+def chunks(queryset, fields, size=None):
+    """
+    The rows of the queryset in (created_at, id) order as lists of dicts, each list
+    its own query seeking past the last row, so nothing is held between them
+    """
+    size = size or settings.EXPORT_CHUNK_SIZE
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(
+                Q(created_at__gt=last[0]) | Q(created_at=last[0], id__gt=last[1])
+            )
+        rows = list(page.order_by("created_at", "id").values(*fields)[:size])
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]["created_at"], rows[-1]["id"]
+
+
+def csv_lines(rows, **options):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, **options)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def json_lines(kind, rows):
+    return "".join(
+        json.dumps({"type": kind, **row}, cls=DjangoJSONEncoder) + "\n" for row in rows
+    )
+
+
+class Export:
+    """
+    The sessions and cards of a user, or of one of their sessions, as CSV (a card
+    per row), JSON Lines (the sessions, then the cards) or an Anki text import (a
+    deck per session). Written EXPORT_CHUNK_SIZE rows at a time.
+    """
+
+    formats = {
+        "csv": ("text/csv", "csv"),
+        "jsonl": ("application/x-ndjson", "jsonl"),
+        "anki": ("text/plain", "txt"),
+    }
+
+    def __init__(self, author, kind, session=None):
+        self.kind = kind
+        self.sessions = Session.objects.filter(author=author)
+        self.cards = Card.objects.filter(author=author)
+        if session is not None:
+            self.sessions = self.sessions.filter(pk=session)
+            self.cards = self.cards.filter(session=session)
+
+    @property
+    def content_type(self):
+        return self.formats[self.kind][0]
+
+    @property
+    def filename(self):
+        return f"cards.{self.formats[self.kind][1]}"
+
+    def parts(self):
+        stats[self.kind] += 1
+        yield from getattr(self, self.kind)()
+
+    def csv(self):
+        fields = CARD_FIELDS + ["session_description"]
+        yield csv_lines([fields])
+        for rows in chunks(self.cards, CARD_FIELDS + ["session__description"]):
+            yield csv_lines(row.values() for row in rows)
+
+    def jsonl(self):
+        for rows in chunks(self.sessions, SESSION_FIELDS):
+            yield json_lines("session", rows)
+        for rows in chunks(self.cards, CARD_FIELDS):
+            yield json_lines("card", rows)
+
+    def anki(self):
+        yield ANKI_HEADER
+        fields = [
+            "id",
+            "created_at",
+            "question",
+            "answer",
+            "state",
+            "session__description",
+        ]
+        for rows in chunks(self.cards, fields):
+            yield csv_lines(
+                (
+                    (
+                        row["question"],
+                        row["answer"],
+                        row["session__description"] or "StudyFast",
+                        row["state"],
+                    )
+                    for row in rows
+                ),
+                delimiter="\t",
+                lineterminator="\n",
+            )
+
+    async def __aiter__(self):
+        # Under ASGI a synchronous iterator would be read whole before the first byte
+        parts = self.parts()
+        next_part = sync_to_async(next)
+        while True:
+            part = await next_part(parts, None)
+            if part is None:
+                return
+            yield part.encode()
@@ -0,0 +1,128 @@
+import json
+import re
+import time
+from typing import Any
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.llms.types import (
+    CompletionResponse,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+
+from .backends import StudySession
+
+# Roughly what a BPE tokenizer makes of English text
+CHARS_PER_TOKEN = 4
+
+
+def tokenize(text):
+    return [text[i : i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+def fake_session(prompt, cards=None):
+    """
+    The StudySession JSON the fake LLM answers with. A session already written in the
+    prompt (the formatting call) is returned as is, otherwise the cards (as many as the
+    prompt asks for) ask about the longest words of the retrieved context.
+    """
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r'\{\s*"description"', prompt):
+        try:
+            value, _ = decoder.raw_decode(prompt, match.start())
+            session = StudySession.model_validate(value)
+        except ValueError:
+            continue
+        if session.cards:
+            return session.model_dump_json()
+
+    if cards is None:
+        asked = re.search(r"You must create (\d+) of those", prompt)
+        cards = int(asked.group(1)) if asked else 10
+    # The query templates put the context before the query
+    context = prompt.split("Query:")[0]
+    words = []
+    for word in re.findall(r"[a-z]{6,}", context.lower()):
+        if word not in words:
+            words.append(word)
+    words = sorted(words, key=len, reverse=True)[:cards]
+    return json.dumps(
+        {
+            "description": "Fake session",
+            "cards": [
+                {"question": f"What is {word}?", "answer": f"{word} is in the document"}
+                for word in words
+            ],
+        }
+    )
+
+
+class FakeLLM(CustomLLM):
+    """
+    Answers after `latency` seconds at `tokens_per_second`, see api.backends.FakeBackend
+    """
+
+    latency: float = 0.0
+    tokens_per_second: float = 0.0
+
+    @classmethod
+    def class_name(cls):
+        return "FakeLLM"
+
+    @property
+    def metadata(self):
+        # Same window as gpt-3.5-turbo so the prompts are packed the same way
+        return LLMMetadata(model_name="fake", context_window=16385, num_output=4096)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        text = fake_session(prompt)
+        delay = self.latency
+        if self.tokens_per_second:
+            delay += len(tokenize(text)) / self.tokens_per_second
+        time.sleep(delay)
+        return CompletionResponse(text=text)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        def gen() -> CompletionResponseGen:
+            time.sleep(self.latency)
+            # Like OpenAI, open with an empty chunk. llama_index's response events
+            # swallow the first chunk of a stream.
+            yield CompletionResponse(text="", delta="")
+            text = ""
+            for token in tokenize(fake_session(prompt)):
+                if self.tokens_per_second:
+                    time.sleep(1 / self.tokens_per_second)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+
+class FakeEmbedding(BaseEmbedding):
+    """
+    Query embeddings of the FakeBackend, same vectors as its chunk embeddings
+    """
+
+    _backend: Any = PrivateAttr()
+
+    def __init__(self, backend, **kwargs):
+        super().__init__(model_name=backend.embedding_model, **kwargs)
+        self._backend = backend
+
+    @classmethod
+    def class_name(cls):
+        return "FakeEmbedding"
+
+    def _get_query_embedding(self, query):
+        return self._backend.embed([query])[0]
+
+    def _get_text_embedding(self, text):
+        return self._backend.embed([text])[0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
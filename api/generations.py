@@ -0,0 +1,154 @@
+import hashlib
+import re
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import CachedGeneration, DocumentSource
+from .selection import parse_pages
+
+# Lookups of this process: "hits", "similar_hits", "misses", "stores", "evictions"
+stats = Counter()
+
+
+def normalize(requirement):
+    """
+    "  Chapter 3: KEY terms!" -> "chapter 3 key terms"
+    """
+    return " ".join(re.findall(r"\w+", requirement.lower()))
+
+
+def document_key(content_hash, pages=None, section=None, num_cards=None):
+    """
+    Everything besides the requirement that changes the generated session: the
+    document and the part of it that was used, the number of cards and the backend
+    that wrote them
+    """
+    parts = [
+        content_hash,
+        ",".join(map(str, parse_pages(pages))) if pages else "",
+        normalize(section or ""),
+        settings.GENERATION_BACKEND,
+        str(num_cards or settings.SESSION_DEFAULT_CARDS),
+    ]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def requirement_key(requirement):
+    return hashlib.sha256(normalize(requirement).encode()).hexdigest()
+
+
+def expires_before():
+    return timezone.now() - timedelta(seconds=settings.GENERATION_CACHE_TTL)
+
+
+def lookup(key, requirement, embedding=None):
+    """
+    Returns the cached output for the document key and requirement, or for the most
+    similar requirement of that document when an embedding is given and that one is
+    at least GENERATION_CACHE_SIMILARITY similar. None on a miss.
+    """
+    entries = CachedGeneration.objects.filter(
+        document_key=key, created_at__gte=expires_before()
+    )
+    entry = entries.filter(requirement_key=requirement_key(requirement)).first()
+    if entry is not None:
+        stats["hits"] += 1
+    elif embedding is not None:
+        entry = most_similar(entries, embedding)
+        if entry is not None:
+            stats["similar_hits"] += 1
+    if entry is None:
+        stats["misses"] += 1
+        return None
+
+    CachedGeneration.objects.filter(pk=entry.pk).update(
+        hits=F("hits") + 1, last_used_at=timezone.now()
+    )
+    return entry.output
+
+
+def most_similar(entries, embedding):
+    import numpy as np
+
+    candidates = list(entries.exclude(embedding=None).only("pk", "embedding", "output"))
+    if not candidates:
+        return None
+    query = np.asarray(embedding, dtype=np.float32)
+    vectors = np.stack(
+        [np.frombuffer(entry.embedding, dtype=np.float32) for entry in candidates]
+    )
+    similarities = vectors @ query
+    similarities /= np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12
+    best = int(np.argmax(similarities))
+    if similarities[best] < settings.GENERATION_CACHE_SIMILARITY:
+        return None
+    return candidates[best]
+
+
+def lookup_url(url, requirement, pages=None, section=None, num_cards=None):
+    """
+    The cached output for a url that was checked recently enough to trust its known
+    content, without touching the network. Exact requirements only.
+    """
+    source = DocumentSource.objects.filter(
+        url=url,
+        checked_at__gte=timezone.now()
+        - timedelta(seconds=settings.DOCUMENT_CACHE_REVALIDATE_AFTER),
+    ).first()
+    if source is None:
+        return None
+    key = document_key(source.content_hash, pages, section, num_cards)
+    return lookup(key, requirement)
+
+
+def store(key, requirement, output, embedding=None):
+    """
+    Caches a generated output, replacing the previous one of the same requirement,
+    and evicts the expired and least recently used entries
+    """
+    if embedding is not None:
+        import numpy as np
+
+        embedding = np.asarray(embedding, dtype=np.float32).tobytes()
+    try:
+        with transaction.atomic():
+            CachedGeneration.objects.update_or_create(
+                document_key=key,
+                requirement_key=requirement_key(requirement),
+                defaults={
+                    "requirement": requirement,
+                    "embedding": embedding,
+                    "output": output,
+                    "created_at": timezone.now(),
+                    "last_used_at": timezone.now(),
+                },
+            )
+    except IntegrityError:
+        # Another worker stored the same generation at the same time
+        return
+    stats["stores"] += 1
+    evict()
+
+
+def evict(max_entries=None):
+    """
+    Deletes the expired entries and the least recently used ones over max_entries
+    """
+    if max_entries is None:
+        max_entries = settings.GENERATION_CACHE_MAX_ENTRIES
+    evicted, _ = CachedGeneration.objects.filter(
+        created_at__lt=expires_before()
+    ).delete()
+    stale = CachedGeneration.objects.order_by("-last_used_at").values_list(
+        "pk", flat=True
+    )[max_entries:]
+    if stale:
+        deleted, _ = CachedGeneration.objects.filter(pk__in=list(stale)).delete()
+        evicted += deleted
+    stats["evictions"] += evicted
+    return evicted
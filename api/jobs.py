@@ -0,0 +1,324 @@
+import logging
+import signal
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .caching import invalidate, invalidate_cards
+from .dedup import deduplicate
+from .generations import lookup_url
+from .models import Session, Card, GenerationJob
+from .search import embed_cards, embed_pending
+from .utils import cardify_pdf, cardify_pdfs
+
+logger = logging.getLogger(__name__)
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def enqueue_session(
+    author,
+    url,
+    requirement,
+    pages=None,
+    section=None,
+    num_cards=None,
+    bypass_cache=False,
+):
+    """
+    Creates a pending session and the job that will generate its cards in the background.
+    A session already generated for a url checked recently is created right away.
+    """
+    if not bypass_cache:
+        output = lookup_url(url, requirement, pages, section, num_cards)
+        if output is not None:
+            return create_session(author, url, output)
+
+    payload = {"url": url, "requirement": requirement}
+    if pages:
+        payload["pages"] = pages
+    if section:
+        payload["section"] = section
+    if num_cards:
+        payload["num_cards"] = num_cards
+    if bypass_cache:
+        payload["bypass_cache"] = True
+    with transaction.atomic():
+        job = GenerationJob.objects.create(author=author, payload=payload)
+        session = Session.objects.create(
+            url=url, author=author, description="", job=job
+        )
+    return session
+
+
+def enqueue_batch(author, urls, requirements):
+    """
+    Creates one pending session per requirement and the single job that will generate
+    all of them from the given urls
+    """
+    with transaction.atomic():
+        job = GenerationJob.objects.create(
+            author=author, payload={"urls": urls, "requirements": requirements}
+        )
+        sessions = [
+            Session.objects.create(
+                url="\n".join(urls), author=author, description="", job=job
+            )
+            for _ in requirements
+        ]
+        # Which requirement each session answers, sessions may be deleted meanwhile
+        job.payload["sessions"] = [session.pk for session in sessions]
+        job.save(update_fields=["payload"])
+    return job, sessions
+
+
+def create_session(author, url, output, embed=False):
+    """
+    Creates a session straight from the output of cardify_pdf. With embed, its cards
+    are embedded for semantic search right away, otherwise by the worker.
+    """
+    session = Session(url=url, author=author, description=output["description"])
+    cards = deduplicate(card_rows(session, output["cards"]))
+    session.cards = cards_json(cards)
+    with transaction.atomic():
+        session.save()
+        Card.objects.bulk_create(cards, batch_size=500)
+        invalidate_cards(cards)
+    if embed:
+        embed_new_cards(cards)
+    return session
+
+
+def complete_sessions(completed):
+    """
+    Stores the outputs of cardify_pdf in their pending sessions, given as (session,
+    output) pairs, and creates all of their cards with one INSERT in one transaction.
+    The cards the user already has are left out, see api/dedup.py. Returns the cards.
+    """
+    cards = []
+    for session, output in completed:
+        session.description = output["description"]
+        cards += card_rows(session, output["cards"])
+    cards = deduplicate(cards)
+    for session, output in completed:
+        session.cards = cards_json([card for card in cards if card.session is session])
+    with transaction.atomic():
+        Session.objects.bulk_update(
+            [session for session, output in completed], ["description", "cards"]
+        )
+        Card.objects.bulk_create(cards, batch_size=500)
+        # Bulk writes send no signals, see api/caching.py
+        invalidate(
+            users=[session.author_id for session, output in completed],
+            sessions=[session.pk for session, output in completed],
+        )
+    return cards
+
+
+def embed_new_cards(cards):
+    """
+    Embeds new cards for semantic search (see api/search.py). The ones it fails on
+    are left to the worker.
+    """
+    try:
+        embed_cards(cards)
+    except Exception:
+        logger.exception("Could not embed %s new cards", len(cards))
+
+
+def embed_pending_cards():
+    """
+    Embeds the next EMBEDDING_BATCH_SIZE cards still without an embedding, edited
+    ones included. Returns how many there were.
+    """
+    try:
+        return embed_pending(limit=settings.EMBEDDING_BATCH_SIZE)
+    except Exception:
+        logger.exception("Could not embed pending cards")
+        return 0
+
+
+def cards_json(cards):
+    # The Card rows are the source of truth, the JSON copy is optional
+    if not settings.SESSION_STORE_CARDS_JSON:
+        return None
+    return [{"question": card.question, "answer": card.answer} for card in cards]
+
+
+def card_rows(session, cards):
+    return [
+        Card(
+            question=card["question"],
+            answer=card["answer"],
+            session=session,
+            author_id=session.author_id,
+        )
+        for card in cards
+    ]
+
+
+def claim_next_job():
+    """
+    Locks the next runnable job for this worker, or returns None when the queue is empty.
+    Running jobs whose lease expired (the worker died or hung) are picked up again.
+    """
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            job = (
+                GenerationJob.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(status="pending", run_after__lte=now)
+                    | Q(status="running", locked_until__lt=now)
+                )
+                .order_by("run_after", "id")
+                .first()
+            )
+            if job is None:
+                return None
+
+            if job.attempts >= settings.GENERATION_JOB_MAX_ATTEMPTS:
+                job.status = "failed"
+                job.error = job.error or "Timed out"
+                job.locked_until = None
+                job.save(
+                    update_fields=["status", "error", "locked_until", "updated_at"]
+                )
+                continue
+
+            job.status = "running"
+            job.attempts += 1
+            # The lease outlives the timeout so the alarm fires before anyone reclaims it
+            job.locked_until = now + timedelta(
+                seconds=settings.GENERATION_JOB_TIMEOUT + 30
+            )
+            job.save(update_fields=["status", "attempts", "locked_until", "updated_at"])
+            return job
+
+
+@contextmanager
+def job_timeout(seconds):
+    """
+    Raises JobTimeout inside the block after the given seconds. Only the main thread
+    can receive signals, elsewhere the lease expiry in claim_next_job takes over.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise JobTimeout(f"Timed out after {seconds} seconds")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _finish(job, attempt, **fields):
+    """
+    Saves the outcome of an attempt unless the lease was lost in the meantime.
+    Must be called inside a transaction.
+    """
+    current = (
+        GenerationJob.objects.select_for_update()
+        .filter(pk=job.pk, status="running", attempts=attempt)
+        .first()
+    )
+    if current is None:
+        logger.warning("Discarding result of job %s attempt %s", job.pk, attempt)
+        return None
+    for name, value in fields.items():
+        setattr(current, name, value)
+    current.locked_until = None
+    current.save()
+    return current
+
+
+def run_job(job):
+    """
+    Generates the sessions of a claimed job, retrying with backoff on failure
+    """
+    attempt = job.attempts
+    if not job.sessions.exists():
+        # The pending session was deleted before we got to it
+        with transaction.atomic():
+            _finish(job, attempt, status="done")
+        return
+
+    try:
+        with job_timeout(settings.GENERATION_JOB_TIMEOUT):
+            if "urls" in job.payload:
+                outputs = cardify_pdfs(
+                    remote_urls=job.payload["urls"],
+                    requirements=job.payload["requirements"],
+                )
+            else:
+                output = cardify_pdf(
+                    remote_url=job.payload["url"],
+                    requirement=job.payload["requirement"],
+                    pages=job.payload.get("pages"),
+                    section=job.payload.get("section"),
+                    num_cards=job.payload.get("num_cards"),
+                    use_cache=not job.payload.get("bypass_cache"),
+                )
+    except Exception as e:
+        logger.exception("Job %s failed on attempt %s", job.pk, attempt)
+        _retry_or_fail(job, attempt, e)
+        return
+
+    cards = []
+    try:
+        with transaction.atomic():
+            current = _finish(job, attempt, status="done", error="")
+            if current is not None:
+                sessions = list(current.sessions.all())
+                if "urls" in job.payload:
+                    outputs = dict(zip(job.payload["sessions"], outputs))
+                    completed = [(session, outputs[session.pk]) for session in sessions]
+                else:
+                    completed = [(session, output) for session in sessions]
+                cards = complete_sessions(completed)
+    except Exception as e:
+        # Rolled back, the job is still running under this attempt
+        logger.exception("Could not store the sessions of job %s", job.pk)
+        _retry_or_fail(job, attempt, e)
+        return
+    # Once committed, the job does not wait on the embeddings
+    embed_new_cards(cards)
+
+
+def _retry_or_fail(job, attempt, error):
+    with transaction.atomic():
+        if attempt < settings.GENERATION_JOB_MAX_ATTEMPTS:
+            delay = settings.GENERATION_JOB_RETRY_DELAY * 2 ** (attempt - 1)
+            _finish(
+                job,
+                attempt,
+                status="pending",
+                error=repr(error),
+                run_after=timezone.now() + timedelta(seconds=delay),
+            )
+        else:
+            _finish(job, attempt, status="failed", error=repr(error))
+
+
+def run_pending_jobs():
+    """
+    Runs jobs until the queue is empty, returns how many were processed
+    """
+    count = 0
+    while (job := claim_next_job()) is not None:
+        run_job(job)
+        count += 1
+    return count
@@ -0,0 +1,102 @@
+import json
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from api.benchmark import Benchmark
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds users, sessions and cards and reports the p50/p95/p99 latency and "
+        "throughput of every API route as JSON. Runs in process against a throwaway "
+        "test database unless --base-url points at a server, which should then run "
+        "with GENERATION_BACKEND=api.backends.FakeBackend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=5)
+        parser.add_argument("--sessions", type=int, default=20, help="Per user")
+        parser.add_argument("--cards", type=int, default=10, help="Per session")
+        parser.add_argument("--requests", type=int, default=100, help="Per route")
+        parser.add_argument(
+            "--generation-requests",
+            type=int,
+            default=10,
+            help="Streamed session creations, each runs the whole generation",
+        )
+        parser.add_argument(
+            "--generation-latency",
+            type=float,
+            default=0.0,
+            help="Seconds per provider call of the fake backend (in process)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Concurrent requests, only with --base-url",
+        )
+        parser.add_argument("--base-url", help="e.g. http://localhost:8000")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the JSON report to this file")
+
+    def handle(self, *args, **options):
+        benchmark = Benchmark(
+            users=options["users"],
+            sessions=options["sessions"],
+            cards=options["cards"],
+            requests=options["requests"],
+            generation_requests=options["generation_requests"],
+            concurrency=options["concurrency"],
+            base_url=options["base_url"],
+            seed=options["seed"],
+        )
+        if options["base_url"]:
+            # The users are seeded in the database the server uses
+            report = benchmark.run()
+        else:
+            report = self.run_in_process(benchmark, options["generation_latency"])
+
+        report["meta"]["commit"] = git_commit()
+        report["meta"]["date"] = datetime.now(timezone.utc).isoformat()
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        self.stdout.write(output)
+
+    def run_in_process(self, benchmark, generation_latency):
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with tempfile.TemporaryDirectory() as store, override_settings(
+                # DEBUG would record every query
+                DEBUG=False,
+                ALLOWED_HOSTS=["testserver"],
+                GENERATION_BACKEND="api.backends.FakeBackend",
+                FAKE_BACKEND_LATENCY=generation_latency,
+                FAKE_BACKEND_TOKENS_PER_SECOND=0,
+                EMBEDDING_STORE_DIR=store,
+            ):
+                return benchmark.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
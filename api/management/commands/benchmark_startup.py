@@ -0,0 +1,56 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+# Runs in a fresh interpreter, prints the seconds, peak RSS (KiB) and whether
+# llama_index got imported
+PROBE = """
+import os, resource, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+import api.urls
+if {engine}:
+    from api.backends import get_backend
+    get_backend()
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      "llama_index.core" in sys.modules)
+"""
+
+
+def probe(engine, settings_module):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(engine=engine)],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    return float(output[0]), int(output[1]), output[2] == "True"
+
+
+class Command(BaseCommand):
+    help = "Measures the cold start time and memory of a process with and without the generation engine"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--runs", type=int, default=5, help="Fresh interpreters per scenario"
+        )
+
+    def handle(self, *args, **options):
+        settings_module = os.environ["DJANGO_SETTINGS_MODULE"]
+        report = {}
+        for name, engine in (("crud", False), ("generation", True)):
+            runs = [probe(engine, settings_module) for _ in range(options["runs"])]
+            report[name] = {
+                "seconds_median": round(statistics.median(r[0] for r in runs), 3),
+                "seconds_max": round(max(r[0] for r in runs), 3),
+                "max_rss_mb": round(max(r[1] for r in runs) / 1024, 1),
+                "imports_llama_index": any(r[2] for r in runs),
+            }
+        self.stdout.write(json.dumps(report, indent=2))
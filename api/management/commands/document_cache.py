@@ -0,0 +1,28 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.documents import cache_stats, evict
+from api.models import DocumentSource, ParsedDocument
+
+
+class Command(BaseCommand):
+    help = "Shows the hit/miss stats of the parsed document cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clear", action="store_true", help="Delete every cached document"
+        )
+        parser.add_argument(
+            "--evict",
+            action="store_true",
+            help="Evict the least recently used documents over the size limit",
+        )
+
+    def handle(self, *args, **options):
+        if options["clear"]:
+            ParsedDocument.objects.all().delete()
+            DocumentSource.objects.all().delete()
+        elif options["evict"]:
+            evict()
+        self.stdout.write(json.dumps(cache_stats(), indent=2))
@@ -0,0 +1,91 @@
+import logging
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from api.jobs import claim_next_job, embed_pending_cards, run_job
+from api.backends import get_backend
+from api.search import forget_stale_embeddings
+
+logger = logging.getLogger("api.jobs")
+
+
+def work(once):
+    # Pay for the llama_index stack before the first job rather than during it
+    get_backend()
+    forget_stale_embeddings()
+    while True:
+        try:
+            job = claim_next_job()
+            if job is not None:
+                run_job(job)
+                continue
+            # Between jobs, the cards that are still not embedded (see api/search.py)
+            if embed_pending_cards():
+                continue
+            if once:
+                break
+        except Exception:
+            # A lost connection or a failed write must not stop the worker, a job it
+            # was running is picked up again once its lease expires
+            logger.exception("Generation worker iteration failed")
+            close_old_connections()
+        time.sleep(settings.GENERATION_JOB_POLL_INTERVAL)
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Runs the background workers that generate pending study sessions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.GENERATION_WORKERS,
+            help="Number of worker processes",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of polling for new jobs",
+        )
+
+    def handle(self, *args, **options):
+        once = options["once"]
+        if options["workers"] <= 1:
+            work(once)
+            return
+
+        # Each worker gets its own process and database connection
+        connections.close_all()
+        processes = {}
+
+        def start():
+            process = multiprocessing.Process(target=work, args=(once,))
+            process.start()
+            processes[process.sentinel] = process
+
+        for _ in range(options["workers"]):
+            start()
+        self.stdout.write(f"Started {len(processes)} generation workers")
+        try:
+            while processes:
+                for sentinel in wait(list(processes)):
+                    process = processes.pop(sentinel)
+                    process.join()
+                    if once and process.exitcode == 0:
+                        continue
+                    # Crashed, or stopped while it should keep polling
+                    self.stderr.write(
+                        f"Worker {process.pid} exited with {process.exitcode}, "
+                        "starting another one"
+                    )
+                    time.sleep(settings.GENERATION_JOB_POLL_INTERVAL)
+                    start()
+        except KeyboardInterrupt:
+            for process in processes.values():
+                process.terminate()
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.caching import invalidate
+from api.jobs import cards_json
+from api.models import Card, Session
+
+
+class Command(BaseCommand):
+    help = (
+        "Brings the JSON copies of the cards of the sessions in line with "
+        "SESSION_STORE_CARDS_JSON: drops them all when it is off, writes the missing "
+        "ones from the Card rows when it is on"
+    )
+
+    def handle(self, *args, **options):
+        if not settings.SESSION_STORE_CARDS_JSON:
+            # Served from their rows already, no response changes
+            count = Session.objects.filter(cards__isnull=False).update(cards=None)
+            self.stdout.write(f"Dropped the JSON copy of {count} sessions")
+            return
+
+        count = 0
+        missing = Session.objects.filter(cards__isnull=True, card__isnull=False)
+        rows = missing.distinct().values_list("pk", "author_id")
+        for pk, author_id in list(rows):
+            cards = Card.objects.filter(session_id=pk).order_by("id")
+            cards = cards.only("question", "answer")
+            Session.objects.filter(pk=pk).update(cards=cards_json(cards))
+            invalidate(users=[author_id], sessions=[pk])
+            count += 1
+        self.stdout.write(f"Wrote the JSON copy of {count} sessions")
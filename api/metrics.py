@@ -0,0 +1,196 @@
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram(
+    "cardify_stage_seconds",
+    "Duration of each stage of cardify_pdf",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 300),
+)
+STAGE_FAILURES = Counter(
+    "cardify_stage_failures", "Stages of cardify_pdf that raised", ["stage"]
+)
+STAGE_TOKENS = Histogram(
+    "cardify_stage_tokens",
+    "Tokens sent (prompt, embedding) or received (completion) by each stage",
+    ["stage", "kind"],
+    buckets=(100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000),
+)
+STAGE_NODES = Histogram(
+    "cardify_stage_nodes",
+    "Nodes produced or consumed by each stage",
+    ["stage"],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+CONTEXT_TOKENS = Histogram(
+    "cardify_context_tokens",
+    "Tokens of retrieved context sent with a query, and what the fixed top 15 would "
+    "have sent (baseline)",
+    ["kind"],
+    buckets=(500, 1000, 2000, 4000, 6000, 8000, 12000, 16000, 24000, 32000),
+)
+DOCUMENT_BYTES = Histogram(
+    "cardify_document_bytes",
+    "Size of the downloaded documents",
+    buckets=(1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7),
+)
+REQUEST_SECONDS = Histogram(
+    "api_request_seconds",
+    "Time to the response of each API route",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+TOKEN_KINDS = ("prompt_tokens", "completion_tokens", "embedding_tokens")
+
+_spans = threading.local()
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Times a stage of cardify_pdf. Counts (nodes, bytes, tokens...) can be set on the
+    yielded dict or added with annotate() from the code running inside. Nested spans
+    are kept in their parent and the outermost one is logged as one JSON line.
+    """
+    record = {"stage": stage, **fields}
+    stack = getattr(_spans, "stack", None)
+    if stack is None:
+        stack = _spans.stack = []
+    if stack:
+        stack[-1].setdefault("spans", []).append(record)
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = repr(e)
+        STAGE_FAILURES.labels(stage).inc()
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        stack.pop()
+        observe(record)
+        if not stack:
+            logger.info("cardify_pdf spans %s", json.dumps(record, default=str))
+
+
+@contextmanager
+def attached(record):
+    """
+    Nests the spans opened inside the block, in another thread, in `record`, a span
+    of the thread that started it
+    """
+    if record is None:
+        yield
+        return
+    stack = getattr(_spans, "stack", None)
+    if stack is None:
+        stack = _spans.stack = []
+    stack.append(record)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def annotate(**counts):
+    """
+    Adds counts to the innermost span of this thread, if any
+    """
+    stack = getattr(_spans, "stack", None)
+    if stack:
+        for name, value in counts.items():
+            stack[-1][name] = stack[-1].get(name, 0) + value
+
+
+def observe(record):
+    stage = record["stage"]
+    STAGE_SECONDS.labels(stage).observe(record["seconds"])
+    for kind in TOKEN_KINDS:
+        if record.get(kind):
+            STAGE_TOKENS.labels(stage, kind.removesuffix("_tokens")).observe(
+                record[kind]
+            )
+    if "nodes" in record:
+        STAGE_NODES.labels(stage).observe(record["nodes"])
+    if "context_tokens" in record:
+        CONTEXT_TOKENS.labels("context").observe(record["context_tokens"])
+        CONTEXT_TOKENS.labels("baseline").observe(record["baseline_context_tokens"])
+    if record.get("bytes"):
+        DOCUMENT_BYTES.observe(record["bytes"])
+
+
+class StatsCollector:
+    """
+    Exposes the in-process Counters of the generation, document cache and embeddings.
+    Modules this process never imported have nothing to count and are not imported.
+    """
+
+    counters = (
+        ("cardify_generations", "Sessions generated by mode", "mode"),
+        ("document_cache_events", "Parsed document cache lookups", "event"),
+        ("embedding_chunks", "Chunks embedded or reused from the store", "kind"),
+        ("generation_cache_events", "Generated session cache lookups", "event"),
+        ("search_events", "Cards embedded and embedding matrices loaded", "event"),
+        ("card_dedup_events", "New cards found to repeat another card", "event"),
+        ("view_cache_events", "Read view cache lookups and invalidations", "event"),
+        ("exports", "Card exports by format", "format"),
+    )
+    sources = (
+        ("api.utils", "generation_stats"),
+        ("api.documents", "stats"),
+        ("api.embeddings", "stats"),
+        ("api.generations", "stats"),
+        ("api.search", "stats"),
+        ("api.dedup", "stats"),
+        ("api.caching", "stats"),
+        ("api.export", "stats"),
+    )
+
+    def describe(self):
+        for name, documentation, label in self.counters:
+            yield CounterMetricFamily(name, documentation, labels=[label])
+
+    def collect(self):
+        for (name, documentation, label), (module, attribute) in zip(
+            self.counters, self.sources
+        ):
+            family = CounterMetricFamily(name, documentation, labels=[label])
+            stats = getattr(sys.modules.get(module), attribute, {})
+            for key, value in sorted(stats.items()):
+                family.add_metric([key], value)
+            yield family
+
+
+REGISTRY.register(StatsCollector())
+
+
+def render_metrics(multiprocess_dir=None):
+    """
+    Prometheus text format of this process, or of every process sharing
+    PROMETHEUS_MULTIPROC_DIR (gunicorn workers and generation workers)
+    """
+    if multiprocess_dir:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=multiprocess_dir)
+        registry.register(StatsCollector())
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
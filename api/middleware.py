@@ -0,0 +1,42 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .metrics import REQUEST_SECONDS
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request by route pattern (api/sessions/<int:pk>/, not the actual id)
+    into the api_request_seconds histogram. Works under WSGI and ASGI so the async
+    views are not pushed to a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    def observe(self, request, response, start):
+        match = request.resolver_match
+        route = match.route if match is not None else "unmatched"
+        REQUEST_SECONDS.labels(request.method, route, response.status_code).observe(
+            time.perf_counter() - start
+        )
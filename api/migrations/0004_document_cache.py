@@ -0,0 +1,61 @@
+# Generated by Django 5.0.6 on 2026-10-17 17:34
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_generationjob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DocumentSource",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("url", models.TextField(unique=True)),
+                ("etag", models.CharField(blank=True, default="", max_length=255)),
+                (
+                    "last_modified",
+                    models.CharField(blank=True, default="", max_length=255),
+                ),
+                ("content_hash", models.CharField(max_length=64)),
+                ("checked_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ParsedDocument",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("content_hash", models.CharField(max_length=64, unique=True)),
+                ("data", models.BinaryField()),
+                ("size", models.PositiveIntegerField()),
+                ("hits", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "last_used_at",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Data migration: the Card rows become the source of truth for the cards of a session.
+# Keeping or dropping the JSON copies per SESSION_STORE_CARDS_JSON is up to
+# manage.py sync_cards_json.
+
+from django.db import migrations
+
+
+def drop_stale_cards_json(apps, schema_editor):
+    """
+    Every session with cards already has their Card rows, one with a JSON copy but
+    no rows had them all deleted: its stale copy goes
+    """
+    Session = apps.get_model("api", "Session")
+
+    Session.objects.filter(cards__isnull=False, card__isnull=True).update(cards=None)
+
+
+def restore_cards_json(apps, schema_editor):
+    """
+    Rebuilds the JSON copy from the Card rows
+    """
+    Session = apps.get_model("api", "Session")
+    Card = apps.get_model("api", "Card")
+
+    for session in Session.objects.filter(cards__isnull=True).iterator():
+        cards = [
+            {"question": question, "answer": answer}
+            for question, answer in Card.objects.filter(session_id=session.id)
+            .order_by("id")
+            .values_list("question", "answer")
+        ]
+        if cards:
+            Session.objects.filter(id=session.id).update(cards=cards)
+
+
+class Migration(migrations.Migration):
+
+    # Named 0005_backfill_card_rows where it was applied already
+    replaces = [("api", "0005_backfill_card_rows")]
+
+    dependencies = [
+        ("api", "0004_document_cache"),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_stale_cards_json, restore_cards_json),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-17 17:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0005_drop_stale_cards_json"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                fields=["author", "created_at", "id"], name="card_author_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                fields=["author", "state", "created_at"], name="card_author_state_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                fields=["session", "state"], name="card_session_state_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="session",
+            index=models.Index(
+                fields=["author", "created_at", "id"], name="session_author_created_idx"
+            ),
+        ),
+    ]
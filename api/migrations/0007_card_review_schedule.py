@@ -0,0 +1,64 @@
+# Generated by Django 5.0.6 on 2026-10-17 17:46
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def cards_due_since_creation(apps, schema_editor):
+    """
+    Existing cards are due from the moment they were created
+    """
+    Card = apps.get_model("api", "Card")
+    Card.objects.update(due_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0006_card_session_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="card",
+            name="due_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="ease_factor",
+            field=models.FloatField(default=2.5),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="interval",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="lapses",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="last_reviewed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="repetitions",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(cards_due_since_creation, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                condition=models.Q(("state", "useless"), _negated=True),
+                fields=["author", "due_at"],
+                name="card_author_due_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.6 on 2026-10-17 18:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0007_card_review_schedule"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CachedGeneration",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("document_key", models.CharField(max_length=64)),
+                ("requirement_key", models.CharField(max_length=64)),
+                ("requirement", models.TextField()),
+                ("embedding", models.BinaryField(null=True)),
+                ("output", models.JSONField()),
+                ("hits", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "last_used_at",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="cachedgeneration",
+            constraint=models.UniqueConstraint(
+                fields=("document_key", "requirement_key"), name="cached_generation_key"
+            ),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 5.0.6 on 2026-10-17 18:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+# api/search.py queries these, keep them in sync. Postgres only uses the index for
+# the exact same expression.
+POSTGRES_SEARCH_INDEX = """
+CREATE INDEX card_search_idx ON api_card USING GIN (
+    to_tsvector('english', coalesce(question, '') || ' ' || coalesce(answer, ''))
+)
+"""
+# External content FTS5 table, the triggers keep it in sync with api_card. Stemmed
+# like the english configuration of Postgres. Migrations that make SQLite rebuild
+# api_card drop the triggers and must create them again (see 0010).
+SQLITE_SEARCH_TABLE = [
+    """
+    CREATE VIRTUAL TABLE api_card_fts USING fts5(
+        question, answer, content='api_card', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER api_card_fts_insert AFTER INSERT ON api_card BEGIN
+        INSERT INTO api_card_fts(rowid, question, answer)
+        VALUES (new.id, new.question, new.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER api_card_fts_delete AFTER DELETE ON api_card BEGIN
+        INSERT INTO api_card_fts(api_card_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER api_card_fts_update AFTER UPDATE OF question, answer ON api_card
+    BEGIN
+        INSERT INTO api_card_fts(api_card_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+        INSERT INTO api_card_fts(rowid, question, answer)
+        VALUES (new.id, new.question, new.answer);
+    END
+    """,
+    "INSERT INTO api_card_fts(api_card_fts) VALUES ('rebuild')",
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    """
+    Full text index of the cards, other databases search them with a scan
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute(POSTGRES_SEARCH_INDEX)
+    elif vendor == "sqlite":
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("PRAGMA compile_options")
+            if ("ENABLE_FTS5",) not in cursor.fetchall():
+                return
+        for statement in SQLITE_SEARCH_TABLE:
+            schema_editor.execute(statement)
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS card_search_idx")
+    elif vendor == "sqlite":
+        for trigger in ("insert", "delete", "update"):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS api_card_fts_{trigger}")
+        schema_editor.execute("DROP TABLE IF EXISTS api_card_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_cached_generation"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="card",
+            name="embedding",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                condition=models.Q(("embedding", None)),
+                fields=["author"],
+                name="card_author_unembedded_idx",
+            ),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,145 @@
+# Generated by Django 5.0.6 on 2026-10-17 18:36
+
+import hashlib
+import re
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Copies of api/dedup.py and of the triggers of 0009 as they were when this was written,
+# so later changes to them do not change what this migration does
+WORD = re.compile(r"\w+")
+SQLITE_SEARCH_TRIGGERS = [
+    """
+    CREATE TRIGGER api_card_fts_insert AFTER INSERT ON api_card BEGIN
+        INSERT INTO api_card_fts(rowid, question, answer)
+        VALUES (new.id, new.question, new.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER api_card_fts_delete AFTER DELETE ON api_card BEGIN
+        INSERT INTO api_card_fts(api_card_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER api_card_fts_update AFTER UPDATE OF question, answer ON api_card
+    BEGIN
+        INSERT INTO api_card_fts(api_card_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+        INSERT INTO api_card_fts(rowid, question, answer)
+        VALUES (new.id, new.question, new.answer);
+    END
+    """,
+    "INSERT INTO api_card_fts(api_card_fts) VALUES ('rebuild')",
+]
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def fingerprint(question, answer):
+    text = " ".join(words(question)) + "\n" + " ".join(words(answer))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def simhash(question, answer):
+    tokens = words(question) + words(answer)
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    weights = [0] * 64
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    value = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def restore_search_triggers(apps, schema_editor):
+    """
+    SQLite adds a column by copying api_card to a new table, dropping the triggers
+    that keep api_card_fts in sync with it
+    """
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    if "api_card_fts" not in schema_editor.connection.introspection.table_names():
+        return
+    for trigger in ("insert", "delete", "update"):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS api_card_fts_{trigger}")
+    for statement in SQLITE_SEARCH_TRIGGERS:
+        schema_editor.execute(statement)
+
+
+def fingerprint_cards(apps, schema_editor):
+    """
+    Fingerprints the existing cards so new ones are checked against them. Duplicates
+    among them are left as they are.
+    """
+    Card = apps.get_model("api", "Card")
+    cards = Card.objects.filter(simhash=None).only("id", "question", "answer")
+    batch = []
+    for card in cards.iterator(chunk_size=2000):
+        card.fingerprint = fingerprint(card.question, card.answer)
+        card.simhash = simhash(card.question, card.answer)
+        batch.append(card)
+        if len(batch) == 2000:
+            Card.objects.bulk_update(batch, ["fingerprint", "simhash"])
+            batch = []
+    Card.objects.bulk_update(batch, ["fingerprint", "simhash"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0009_card_search"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="card",
+            name="card_author_due_idx",
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="duplicate_of",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="duplicates",
+                to="api.card",
+            ),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="fingerprint",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="simhash",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                condition=models.Q(
+                    ("state__in", ["useless", "duplicate"]), _negated=True
+                ),
+                fields=["author", "due_at"],
+                name="card_author_due_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="card",
+            index=models.Index(
+                fields=["author", "fingerprint"], name="card_author_fingerprint_idx"
+            ),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+        migrations.RunPython(fingerprint_cards, migrations.RunPython.noop),
+    ]
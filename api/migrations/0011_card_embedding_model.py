@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-17 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0010_card_dedup"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="card",
+            name="embedding_dimensions",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="card",
+            name="embedding_model",
+            field=models.CharField(max_length=100, null=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 
 # Create your models here.
@@ -11,6 +12,21 @@ class Session(models.Model):
     )
     description = models.TextField(max_length=255)
     cards = models.JSONField(null=True)
+    job = models.ForeignKey(
+        "GenerationJob",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="sessions",
+    )
+
+    class Meta:
+        indexes = [
+            # Sessions of a user, newest first (keyset pagination)
+            models.Index(
+                fields=["author", "created_at", "id"], name="session_author_created_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.description}"
@@ -24,8 +40,130 @@ class Card(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="card")
     state = models.CharField(
         max_length=50, default="pending"
-    )  # will either be "pending", "useless", "done"
+    )  # will either be "pending", "useless", "done", "duplicate"
     created_at = models.DateTimeField(auto_now_add=True)
+    # Spaced repetition schedule (SM-2) - see api/review.py
+    due_at = models.DateTimeField(default=timezone.now)
+    interval = models.PositiveIntegerField(default=0)  # days
+    ease_factor = models.FloatField(default=2.5)
+    repetitions = models.PositiveIntegerField(default=0)  # successful reviews in a row
+    lapses = models.PositiveIntegerField(default=0)
+    last_reviewed_at = models.DateTimeField(null=True, blank=True)
+    # Semantic search (float16, normalized) - see api/search.py
+    embedding = models.BinaryField(null=True)
+    embedding_model = models.CharField(max_length=100, null=True)
+    embedding_dimensions = models.PositiveIntegerField(null=True)  # 0 when not cut
+    # Deduplication of the cards of a user - see api/dedup.py
+    fingerprint = models.CharField(max_length=64, blank=True, default="")
+    simhash = models.BigIntegerField(null=True)
+    duplicate_of = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="duplicates",
+    )
+
+    class Meta:
+        indexes = [
+            # Cards of a user, newest first (keyset pagination)
+            models.Index(
+                fields=["author", "created_at", "id"], name="card_author_created_idx"
+            ),
+            # Cards of a user in a given state
+            models.Index(
+                fields=["author", "state", "created_at"], name="card_author_state_idx"
+            ),
+            # Cards of a session in a given state
+            models.Index(fields=["session", "state"], name="card_session_state_idx"),
+            # Review queue of a user, useless and duplicate cards are never reviewed
+            models.Index(
+                fields=["author", "due_at"],
+                name="card_author_due_idx",
+                condition=~models.Q(state__in=["useless", "duplicate"]),
+            ),
+            # Exact duplicates among the cards of a user
+            models.Index(
+                fields=["author", "fingerprint"], name="card_author_fingerprint_idx"
+            ),
+            # Cards of a user written or edited since their last semantic search
+            models.Index(
+                fields=["author"],
+                name="card_author_unembedded_idx",
+                condition=models.Q(embedding=None),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.question}"
+
+
+# Background generation of the sessions, picked up by the worker command
+class GenerationJob(models.Model):
+    author = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="generation_job"
+    )
+    payload = models.JSONField(default=dict)  # url, requirement
+    status = models.CharField(
+        max_length=50, default="pending"
+    )  # will either be "pending", "running", "done", "failed"
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+
+# Last known version of a remote url, used to revalidate it with ETag/Last-Modified
+class DocumentSource(models.Model):
+    url = models.TextField(unique=True)
+    etag = models.CharField(max_length=255, blank=True, default="")
+    last_modified = models.CharField(max_length=255, blank=True, default="")
+    content_hash = models.CharField(max_length=64)  # sha256 of the downloaded bytes
+    checked_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.url}"
+
+
+# Parsed documents and nodes, shared by every url serving the same bytes
+class ParsedDocument(models.Model):
+    content_hash = models.CharField(max_length=64, unique=True)
+    data = models.BinaryField()  # zlib compressed JSON
+    size = models.PositiveIntegerField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.content_hash}"
+
+
+# Generated sessions by document and requirement, see api/generations.py
+class CachedGeneration(models.Model):
+    document_key = models.CharField(max_length=64)  # document, pages, section, backend
+    requirement_key = models.CharField(max_length=64)  # sha256 of the normalized text
+    requirement = models.TextField()
+    embedding = models.BinaryField(null=True)  # float32, for near duplicates
+    output = models.JSONField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["document_key", "requirement_key"],
+                name="cached_generation_key",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.requirement}"
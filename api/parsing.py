@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+# The functions submitted to the pool run in spawned processes that never set up
+# Django, this module must not import the models.
+
+# Nothing to gain from another process for these, they are decoded in place
+TEXT_CONTENT_TYPES = ("text/html", "text/plain")
+
+_pool = None
+_pool_pid = None
+_slots = None
+_pool_lock = threading.Lock()
+
+
+def temp_name(remote_url):
+    # The file name ends up in the metadata of every document, hence in their embeddings
+    return "temp" + Path(urlparse(remote_url).path).suffix
+
+
+def read_file(remote_url, path, content_type):
+    """
+    Turns a downloaded file into documents the same way llama_index's RemoteReader does
+    """
+    from llama_index.core import SimpleDirectoryReader
+    from llama_index.core.schema import Document
+
+    extra_info = {"Source": remote_url}
+    if content_type in TEXT_CONTENT_TYPES:
+        text = Path(path).read_text(encoding="utf-8-sig")
+        return [Document(text=text, extra_info=extra_info)]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The reader picks the parser from the file name
+        os.symlink(path, f"{temp_dir}/{temp_name(remote_url)}")
+        loader = SimpleDirectoryReader(temp_dir, file_metadata=(lambda _: extra_info))
+        return loader.load_data()
+
+
+def read_pdf_pages(remote_url, path, pages):
+    """
+    Documents of the given pages (0-based) of a PDF, as the PDFReader of
+    SimpleDirectoryReader makes them for the whole file
+    """
+    from llama_index.core.schema import Document
+    from pypdf import PdfReader
+
+    pdf = PdfReader(path)
+    return [
+        Document(
+            text=pdf.pages[page].extract_text(),
+            metadata={
+                "page_label": pdf.page_labels[page],
+                "file_name": temp_name(remote_url),
+                "Source": remote_url,
+            },
+        )
+        for page in pages
+    ]
+
+
+def is_pdf(remote_url, download):
+    return download.content_type == "application/pdf" or (
+        Path(urlparse(remote_url).path).suffix.lower() == ".pdf"
+    )
+
+
+def get_pool():
+    """
+    Returns the process pool of this process (DOCUMENT_PARSE_PROCESSES) and the
+    semaphore bounding its queue. The workers are spawned rather than forked so they do
+    not inherit the threads and connections of a gunicorn or generation worker.
+    """
+    global _pool, _pool_pid, _slots
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                settings.DOCUMENT_PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _pool_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(settings.DOCUMENT_PARSE_MAX_PENDING)
+        return _pool, _slots
+
+
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def read_documents(remote_url, download, pages=None):
+    """
+    Reads a download into documents, only the given pages (0-based) of a PDF when
+    there are some. PDFs and other binary files are read in the process pool, a long
+    PDF in runs of DOCUMENT_PARSE_PAGES_PER_TASK pages spread over the processes.
+    Submitting waits while DOCUMENT_PARSE_MAX_PENDING tasks are queued and TimeoutError
+    is raised after DOCUMENT_PARSE_TIMEOUT seconds, though a task that already started
+    keeps its process until it is done.
+    """
+    if download.content_type in TEXT_CONTENT_TYPES:
+        return read_file(remote_url, download.path, download.content_type)
+
+    tasks = [(read_file, remote_url, download.path, download.content_type)]
+    if is_pdf(remote_url, download):
+        from pypdf import PdfReader
+
+        count = len(PdfReader(download.path).pages)
+        selected = [page for page in pages or range(count) if page < count]
+        step = settings.DOCUMENT_PARSE_PAGES_PER_TASK
+        if pages is not None or count > step:
+            tasks = [
+                (read_pdf_pages, remote_url, download.path, selected[i : i + step])
+                for i in range(0, len(selected), step)
+            ]
+    if not settings.DOCUMENT_PARSE_PROCESSES:
+        return [document for function, *args in tasks for document in function(*args)]
+
+    deadline = time.monotonic() + settings.DOCUMENT_PARSE_TIMEOUT
+    pool, slots = get_pool()
+    futures = []
+    try:
+        for function, *args in tasks:
+            if not slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                raise TimeoutError(f"No parsing process freed up for {remote_url}")
+            try:
+                future = pool.submit(function, *args)
+            except BaseException:
+                slots.release()
+                raise
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+        _, pending = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        if pending:
+            raise TimeoutError(
+                f"Reading {remote_url} took more than "
+                f"{settings.DOCUMENT_PARSE_TIMEOUT} seconds"
+            )
+        return [document for future in futures for document in future.result()]
+    except BrokenProcessPool:
+        # A worker died (out of memory on a huge file?), the next call starts afresh
+        reset_pool()
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,158 @@
+import numpy as np
+from django.conf import settings
+from llama_index.core import Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode
+
+from .backends import get_backend
+from .metrics import annotate, span
+
+# The fixed similarity_top_k this replaced, the prompt tokens it would have cost are
+# reported next to the ones that were actually sent
+BASELINE_TOP_K = 15
+
+_rerankers = {}
+
+
+def get_reranker(model):
+    if model not in _rerankers:
+        from llama_index.postprocessor.flag_embedding_reranker import (
+            FlagEmbeddingReranker,
+        )
+
+        _rerankers[model] = FlagEmbeddingReranker(
+            model=model, top_n=max(settings.RETRIEVAL_CANDIDATES, BASELINE_TOP_K)
+        )
+    return _rerankers[model]
+
+
+def normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=-1, keepdims=True) + 1e-12)
+
+
+def mmr(relevance, similarity, diversity, duplicate):
+    """
+    Orders the candidates by maximal marginal relevance: the next one is the most
+    relevant once its similarity to those already picked is weighed in. Candidates at
+    least `duplicate` similar to a picked one are left out. Returns their indices.
+    """
+    remaining = list(range(len(relevance)))
+    order = []
+    while remaining:
+        redundancy = (
+            similarity[np.ix_(remaining, order)].max(axis=1)
+            if order
+            else np.zeros(len(remaining))
+        )
+        scores = diversity * relevance[remaining] - (1 - diversity) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        order.append(best)
+        # Taken out first, a zero vector is not similar to itself
+        remaining.remove(best)
+        remaining = [i for i in remaining if similarity[best, i] < duplicate]
+    return order
+
+
+def pack(chunks, budget, min_chunks, max_chunks):
+    """
+    Indices of the first chunks (given as token counts) that fit in the budget,
+    skipping those too long for what is left. At least min_chunks are kept.
+    """
+    kept = []
+    used = 0
+    for i, tokens in enumerate(chunks):
+        if len(kept) >= max_chunks:
+            break
+        if used + tokens <= budget or len(kept) < min_chunks:
+            kept.append(i)
+            used += tokens
+    return kept
+
+
+class AdaptiveRetriever(BaseRetriever):
+    """
+    Retrieves RETRIEVAL_CANDIDATES chunks by similarity, drops the ones far less
+    relevant than the best and the near duplicates, orders the rest by MMR (or by the
+    RETRIEVAL_RERANKER cross-encoder) and keeps as many as fit RETRIEVAL_TOKEN_BUDGET.
+    A short document or a narrow requirement gets a few chunks, a long one up to
+    RETRIEVAL_MAX_CHUNKS. Retrieved nodes come without their embeddings, hence the
+    nodes the index was built from.
+    """
+
+    def __init__(self, index, nodes):
+        super().__init__()
+        self.index = index
+        self.embeddings = {node.node_id: node.embedding for node in nodes}
+
+    def _retrieve(self, query_bundle):
+        with span("retrieve") as record:
+            if query_bundle.embedding is None:
+                query_bundle.embedding = Settings.embed_model.get_query_embedding(
+                    query_bundle.query_str
+                )
+            candidates = self.index.as_retriever(
+                similarity_top_k=max(settings.RETRIEVAL_CANDIDATES, BASELINE_TOP_K)
+            ).retrieve(query_bundle)
+            tokenize = get_backend().tokenize
+            tokens = [
+                len(
+                    tokenize(candidate.node.get_content(metadata_mode=MetadataMode.LLM))
+                )
+                for candidate in candidates
+            ]
+            selected = self.select(candidates, query_bundle)
+            if settings.RETRIEVAL_RERANKER and len(selected) > 1:
+                with span("rerank", nodes=len(selected)):
+                    reranked = get_reranker(
+                        settings.RETRIEVAL_RERANKER
+                    ).postprocess_nodes([candidates[i] for i in selected], query_bundle)
+                positions = {c.node.node_id: i for i, c in enumerate(candidates)}
+                selected = [positions[c.node.node_id] for c in reranked]
+            kept = [
+                selected[i]
+                for i in pack(
+                    [tokens[i] for i in selected],
+                    settings.RETRIEVAL_TOKEN_BUDGET,
+                    settings.RETRIEVAL_MIN_CHUNKS,
+                    settings.RETRIEVAL_MAX_CHUNKS,
+                )
+            ]
+            context_tokens = sum(tokens[i] for i in kept)
+            baseline_tokens = sum(tokens[:BASELINE_TOP_K])
+            record.update(
+                candidates=len(candidates),
+                nodes=len(kept),
+                context_tokens=context_tokens,
+                baseline_context_tokens=baseline_tokens,
+            )
+            annotate(saved_prompt_tokens=baseline_tokens - context_tokens)
+            return [candidates[i] for i in kept]
+
+    def select(self, candidates, query_bundle):
+        """
+        Indices of the candidates relevant enough and not duplicates, in MMR order
+        """
+        vectors = [self.embeddings.get(c.node.node_id) for c in candidates]
+        if not candidates or any(vector is None for vector in vectors):
+            return list(range(len(candidates)))
+        vectors = normalized(vectors)
+        relevance = vectors @ normalized(query_bundle.embedding)
+        threshold = relevance.max() * settings.RETRIEVAL_MIN_SCORE_RATIO
+        ranked = np.argsort(-relevance)
+        relevant = sorted(
+            i
+            for rank, i in enumerate(ranked)
+            if relevance[i] >= threshold or rank < settings.RETRIEVAL_MIN_CHUNKS
+        )
+        order = mmr(
+            relevance[relevant],
+            vectors[relevant] @ vectors[relevant].T,
+            settings.RETRIEVAL_MMR_LAMBDA,
+            settings.RETRIEVAL_DUPLICATE_SIMILARITY,
+        )
+        annotate(
+            irrelevant_nodes=len(candidates) - len(relevant),
+            duplicate_nodes=len(relevant) - len(order),
+        )
+        return [relevant[i] for i in order]
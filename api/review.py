@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import invalidate_cards
+from .models import Card
+
+# Never reviewed, see card_author_due_idx
+UNREVIEWED_STATES = ["useless", "duplicate"]
+# Answers graded below this are forgotten and start over
+PASSING_QUALITY = 3
+MIN_EASE_FACTOR = 1.3
+SCHEDULE_FIELDS = [
+    "due_at",
+    "interval",
+    "ease_factor",
+    "repetitions",
+    "lapses",
+    "last_reviewed_at",
+]
+
+
+def schedule(card, quality, now=None):
+    """
+    Applies one SM-2 review graded from 0 (blackout) to 5 (perfect) to the card
+    """
+    if now is None:
+        now = timezone.now()
+
+    if quality < PASSING_QUALITY:
+        card.repetitions = 0
+        card.interval = 1
+        card.lapses += 1
+    else:
+        card.repetitions += 1
+        if card.repetitions == 1:
+            card.interval = 1
+        elif card.repetitions == 2:
+            card.interval = 6
+        else:
+            card.interval = round(card.interval * card.ease_factor)
+
+    miss = 5 - quality
+    card.ease_factor = max(
+        MIN_EASE_FACTOR, card.ease_factor + 0.1 - miss * (0.08 + miss * 0.02)
+    )
+    card.last_reviewed_at = now
+    card.due_at = now + timedelta(days=card.interval)
+    return card
+
+
+def due_cards(author, limit, now=None):
+    """
+    The next cards the user has to review, a single range scan of card_author_due_idx
+    """
+    if now is None:
+        now = timezone.now()
+    return (
+        Card.objects.filter(author=author, due_at__lte=now)
+        .exclude(state__in=UNREVIEWED_STATES)
+        .order_by("due_at")[:limit]
+    )
+
+
+def submit_reviews(author, reviews, now=None):
+    """
+    Schedules every {"id": ..., "quality": ...} review in order and saves the cards
+    with a single UPDATE. Raises Card.DoesNotExist when one of them is not the user's.
+    """
+    if now is None:
+        now = timezone.now()
+    ids = {review["id"] for review in reviews}
+    with transaction.atomic():
+        cards = Card.objects.select_for_update().filter(author=author, id__in=ids)
+        cards = {card.id: card for card in cards}
+        missing = ids - cards.keys()
+        if missing:
+            raise Card.DoesNotExist(f"Cards not found: {sorted(missing)}")
+        for review in reviews:
+            schedule(cards[review["id"]], review["quality"], now=now)
+        Card.objects.bulk_update(cards.values(), SCHEDULE_FIELDS, batch_size=500)
+        invalidate_cards(cards.values())
+    return list(cards.values())
@@ -0,0 +1,255 @@
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+from .models import Card
+
+# Same expression as card_search_idx (migration 0009), or Postgres scans the table
+SEARCH_DOCUMENT = (
+    "to_tsvector('english', coalesce(question, '') || ' ' || coalesce(answer, ''))"
+)
+SEARCH_QUERY = "websearch_to_tsquery('english', %s)"
+TERM = re.compile(r"\w+")
+
+# Semantic search in this process: "embedded" cards, "loads"/"hits" of the matrices
+stats = Counter()
+
+# Card embeddings of the last authors searched: (author id, model, dimensions) ->
+# (loaded at, ids, matrix)
+_matrices = OrderedDict()
+_matrices_lock = threading.Lock()
+_has_fts5 = None
+
+
+def has_fts5():
+    global _has_fts5
+    if _has_fts5 is None:
+        _has_fts5 = "api_card_fts" in connection.introspection.table_names()
+    return _has_fts5
+
+
+def fts5_query(query):
+    """
+    'cell "membrane' -> '"cell" "membrane"*', every word must appear and the last one
+    may be the start of a word. None without any word.
+    """
+    terms = [f'"{term}"' for term in TERM.findall(query)]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def ranked(cards, scores):
+    """
+    The cards of the given (id, score) pairs in that order, with their score
+    """
+    found = cards.in_bulk([pk for pk, _ in scores])
+    results = []
+    for pk, score in scores:
+        if pk in found:
+            found[pk].score = score
+            results.append(found[pk])
+    return results
+
+
+def full_text(author, query, limit):
+    """
+    The cards of the author with every word of the query, best first: through the
+    card_search_idx GIN index on Postgres, the api_card_fts FTS5 table on SQLite and
+    a scan anywhere else
+    """
+    cards = Card.objects.filter(author=author)
+    if connection.vendor == "postgresql":
+        return list(
+            cards.filter(
+                RawSQL(
+                    f"{SEARCH_DOCUMENT} @@ {SEARCH_QUERY}",
+                    [query],
+                    output_field=BooleanField(),
+                )
+            )
+            .annotate(
+                score=RawSQL(
+                    f"ts_rank({SEARCH_DOCUMENT}, {SEARCH_QUERY})",
+                    [query],
+                    output_field=FloatField(),
+                )
+            )
+            .order_by("-score", "-id")[:limit]
+        )
+
+    if connection.vendor == "sqlite" and has_fts5():
+        match = fts5_query(query)
+        if match is None:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT api_card_fts.rowid, -bm25(api_card_fts) FROM api_card_fts "
+                "JOIN api_card ON api_card.id = api_card_fts.rowid "
+                "WHERE api_card_fts MATCH %s AND api_card.author_id = %s "
+                "ORDER BY bm25(api_card_fts) LIMIT %s",
+                [match, author.pk, limit],
+            )
+            return ranked(cards, cursor.fetchall())
+
+    condition = Q()
+    for term in TERM.findall(query):
+        condition &= Q(question__icontains=term) | Q(answer__icontains=term)
+    return list(cards.filter(condition).order_by("-created_at", "-id")[:limit])
+
+
+def card_text(card):
+    return f"{card.question}\n{card.answer}"
+
+
+def vector_bytes(vector):
+    """
+    The first SEARCH_EMBEDDING_DIMENSIONS dimensions of an embedding, normalized, as
+    float16. text-embedding-3 models are trained to be cut like that.
+    """
+    import numpy as np
+
+    vector = np.asarray(vector, dtype=np.float32)
+    if settings.SEARCH_EMBEDDING_DIMENSIONS:
+        vector = vector[: settings.SEARCH_EMBEDDING_DIMENSIONS]
+    vector = vector / (np.linalg.norm(vector) + 1e-12)
+    return vector.astype(np.float16).tobytes()
+
+
+def current_embedding():
+    """
+    The model and dimensions the card embeddings are made with now, as stored with
+    each of them. Vectors made otherwise cannot be compared with a query.
+    """
+    from .backends import get_backend
+
+    return {
+        "embedding_model": get_backend().embedding_model or "",
+        "embedding_dimensions": settings.SEARCH_EMBEDDING_DIMENSIONS,
+    }
+
+
+def embed_cards(cards):
+    """
+    Stores the embeddings of the given cards, texts embedded before are served by
+    the embedding store. Returns how many there were.
+    """
+    from .backends import get_backend
+
+    cards = [card for card in cards if card.pk is not None]
+    if not cards:
+        return 0
+    backend = get_backend()
+    vectors = backend.embedding_store.embed(list(map(card_text, cards)), backend.embed)
+    version = current_embedding()
+    for card, vector in zip(cards, vectors):
+        card.embedding = vector_bytes(vector)
+        for name, value in version.items():
+            setattr(card, name, value)
+    Card.objects.bulk_update(cards, ["embedding", *version], batch_size=500)
+    stats["embedded"] += len(cards)
+    with _matrices_lock:
+        for author_id in {card.author_id for card in cards}:
+            _matrices.pop((author_id, *version.values()), None)
+    return len(cards)
+
+
+def embed_pending(author=None, limit=None):
+    """
+    Embeds up to `limit` cards without an embedding (of the author), new ones the
+    generation missed and edited ones, found through card_author_unembedded_idx.
+    Returns how many there were.
+    """
+    cards = Card.objects.filter(embedding=None)
+    if author is not None:
+        cards = cards.filter(author=author)
+    cards = cards.order_by("id").only("id", "author", "question", "answer")
+    return embed_cards(cards[:limit] if limit else cards)
+
+
+def forget_stale_embeddings():
+    """
+    Clears the embeddings made with another model or number of dimensions, so they
+    are embedded again. Returns how many there were.
+    """
+    version = current_embedding()
+    return (
+        Card.objects.exclude(embedding=None)
+        .exclude(**version)
+        .update(embedding=None, embedding_model=None, embedding_dimensions=None)
+    )
+
+
+def card_matrix(author):
+    """
+    The ids and embeddings (one float32 row per card) of the cards of the author
+    embedded the current way, kept for SEARCH_MATRIX_TTL seconds for the
+    SEARCH_MATRIX_CACHE_SIZE last authors. Cards edited through another process may
+    be matched on their old text meanwhile.
+    """
+    import numpy as np
+
+    version = current_embedding()
+    key = (author.pk, *version.values())
+    with _matrices_lock:
+        cached = _matrices.get(key)
+        if cached and time.monotonic() - cached[0] < settings.SEARCH_MATRIX_TTL:
+            _matrices.move_to_end(key)
+            stats["hits"] += 1
+            return cached[1:]
+
+    ids = []
+    vectors = bytearray()
+    rows = (
+        Card.objects.filter(author=author, **version)
+        .exclude(embedding=None)
+        .values_list("id", "embedding")
+    )
+    for pk, embedding in rows.iterator(chunk_size=2000):
+        ids.append(pk)
+        vectors += embedding
+    matrix = np.frombuffer(vectors, dtype=np.float16).astype(np.float32)
+    matrix = matrix.reshape(len(ids), -1) if ids else matrix.reshape(0, 0)
+    ids = np.array(ids, dtype=np.int64)
+    with _matrices_lock:
+        _matrices[key] = (time.monotonic(), ids, matrix)
+        while len(_matrices) > settings.SEARCH_MATRIX_CACHE_SIZE:
+            _matrices.popitem(last=False)
+    stats["loads"] += 1
+    return ids, matrix
+
+
+def semantic(author, query, limit):
+    """
+    The cards of the author closest in meaning to the query, best first: a single
+    matrix product over their stored embeddings. The generation worker embeds the
+    cards, the ones it has not got to yet are left out (or the first
+    SEARCH_EMBED_BATCH of them embedded here).
+    """
+    import numpy as np
+
+    from .backends import get_backend
+
+    if settings.SEARCH_EMBED_BATCH:
+        embed_pending(author, settings.SEARCH_EMBED_BATCH)
+    ids, matrix = card_matrix(author)
+    if not len(ids):
+        return []
+    backend = get_backend()
+    vector = backend.embedding_store.embed([query], backend.embed)[0]
+    query = np.frombuffer(vector_bytes(vector), dtype=np.float16).astype(np.float32)
+    scores = matrix @ query
+    k = min(limit, len(ids))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return ranked(
+        Card.objects.filter(author=author),
+        [(int(ids[i]), float(scores[i])) for i in top],
+    )
@@ -0,0 +1,132 @@
+import logging
+import math
+import re
+from collections import Counter
+
+from .metrics import annotate
+
+logger = logging.getLogger(__name__)
+
+# A markdown heading, or a line opening a chapter/section of a PDF
+HEADING = re.compile(
+    r"^[ \t]*(?:#{1,6}[ \t]+\S.*|(?:chapter|section|part|unit|lesson)[ \t]+\w+.*)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+WORD = re.compile(r"[a-z0-9]{3,}")
+STOPWORDS = frozenset(
+    "the and for with about from that this these those into over under what which "
+    "when where how why are was were been being have has had not but all any some "
+    "questions question cards card study focus focusing topic topics please make "
+    "create document chapter section page pages".split()
+)
+MAX_PAGE = 100000
+
+
+def parse_pages(spec):
+    """
+    "1-20, 35" -> [0, 1, ..., 19, 34], the 0-based indices of the listed pages.
+    Raises ValueError on anything else.
+    """
+    pages = set()
+    for part in spec.split(","):
+        part = part.strip()
+        match = re.fullmatch(r"(\d+)(?:\s*-\s*(\d+))?", part)
+        if match is None:
+            raise ValueError(f"Invalid page range {part!r}, use e.g. 1-20,35")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if not 1 <= first <= last <= MAX_PAGE:
+            raise ValueError(f"Invalid page range {part!r}")
+        pages.update(range(first - 1, last))
+    return sorted(pages)
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def heading_matches(heading, section):
+    return re.search(rf"\b{re.escape(section)}\b", heading, re.IGNORECASE) is not None
+
+
+def select_section(nodes, section):
+    """
+    The nodes under the headings that mention `section`, in document order. The text
+    of a node before its first heading belongs to the section of the previous node.
+    """
+    selected = []
+    inside = False
+    for node in nodes:
+        text = node.get_content()
+        headings = list(HEADING.finditer(text))
+        if not headings:
+            if inside:
+                selected.append(node)
+            continue
+        continues = inside and text[: headings[0].start()].strip()
+        if continues or any(heading_matches(h.group(0), section) for h in headings):
+            selected.append(node)
+        inside = heading_matches(headings[-1].group(0), section)
+    return selected
+
+
+def prefilter(nodes, query, max_nodes):
+    """
+    Keeps the max_nodes nodes sharing the most (tf-idf weighted) words with the query,
+    in document order. Cheap enough to run before any embedding.
+    """
+    if not max_nodes or len(nodes) <= max_nodes:
+        return nodes
+    terms = set(words(query)) - STOPWORDS
+    counts = [Counter(words(node.get_content())) for node in nodes]
+    frequency = Counter(term for count in counts for term in terms if count[term])
+
+    def score(count):
+        return sum(
+            (1 + math.log(count[term])) * math.log(len(nodes) / frequency[term])
+            for term in terms
+            if count[term]
+        )
+
+    scores = [score(count) for count in counts]
+    ranked = sorted(range(len(nodes)), key=lambda i: scores[i], reverse=True)
+    return [nodes[i] for i in sorted(ranked[:max_nodes])]
+
+
+def split_sections(nodes, parts):
+    """
+    Splits nodes into at most `parts` runs of about the same length, in document
+    order. A run starts at the node opening a section when there is one close by.
+    """
+    parts = max(1, min(parts, len(nodes)))
+    size = len(nodes) / parts
+    starts = [i for i, node in enumerate(nodes) if HEADING.match(node.get_content())]
+    bounds = [0]
+    for part in range(1, parts):
+        target = round(part * size)
+        near = [i for i in starts if bounds[-1] < i and abs(i - target) <= size / 2]
+        bound = min(near, key=lambda i: abs(i - target)) if near else target
+        if bound > bounds[-1]:
+            bounds.append(bound)
+    bounds.append(len(nodes))
+    return [nodes[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def select_nodes(base_nodes, objects, requirement, section=None, max_nodes=0):
+    """
+    Narrows a document down to the nodes worth embedding for a requirement: those of
+    the requested section, if it can be found, then the best max_nodes of them
+    """
+    total = len(base_nodes) + len(objects)
+    query = requirement
+    if section:
+        selected = select_section(base_nodes, section)
+        if selected:
+            base_nodes = selected
+        else:
+            logger.warning("No heading mentions %r, keeping every section", section)
+            query = f"{section} {requirement}"
+    nodes = base_nodes + objects
+    kept = prefilter(nodes, query, max_nodes)
+    annotate(dropped_nodes=total - len(kept))
+    return kept
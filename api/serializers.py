@@ -1,10 +1,38 @@
+from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import serializers
-from .models import Session, Card
-from .utils import cardify_pdf
+from .models import Session, Card, GenerationJob
+from .dedup import fingerprint, simhash
+from .jobs import enqueue_batch, enqueue_session
+from .selection import parse_pages
 import json
 
 
+def requested_fields(request):
+    """
+    Field names listed in ?fields=, or None when the client wants every field
+    """
+    if request is None or request.method != "GET":
+        return None
+    fields = request.query_params.get("fields")
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(",") if name.strip()}
+
+
+class SparseFieldsMixin:
+    """
+    Leaves out the fields that are not listed in ?fields=id,description on reads
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get("request"))
+        if fields:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -17,8 +45,23 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class SessionSerializer(serializers.ModelSerializer):
+class SessionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     requirement = serializers.CharField(write_only=True)
+    # Narrow a long document down, see api/selection.py
+    pages = serializers.CharField(write_only=True, required=False)
+    section = serializers.CharField(write_only=True, required=False)
+    # More than GENERATION_CARDS_PER_CALL cards are generated in parallel parts
+    num_cards = serializers.IntegerField(
+        write_only=True,
+        required=False,
+        min_value=1,
+        max_value=settings.SESSION_MAX_CARDS,
+    )
+    # Generate again instead of reusing the cards of the same request
+    bypass_cache = serializers.BooleanField(write_only=True, default=False)
+    # Sessions from before the job queue were generated synchronously
+    status = serializers.CharField(source="job.status", read_only=True, default="done")
+    cards = serializers.SerializerMethodField()
 
     class Meta:
         model = Session
@@ -30,32 +73,91 @@ class SessionSerializer(serializers.ModelSerializer):
             "author",
             "cards",
             "requirement",
+            "pages",
+            "section",
+            "num_cards",
+            "bypass_cache",
+            "job",
+            "status",
         ]
         extra_kwargs = {
+            # Nullable in the table, but a session always comes from a document
+            "url": {"required": True, "allow_null": False},
             "description": {"read_only": True},
-            "cards": {"read_only": True},
             "author": {"read_only": True},
+            "job": {"read_only": True},
         }
 
+    def validate_pages(self, value):
+        try:
+            parse_pages(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+    def get_cards(self, obj):
+        # The JSON copy when sessions keep one (SESSION_STORE_CARDS_JSON), a pending
+        # or failed session has none. Otherwise the rows, prefetched by the views.
+        if settings.SESSION_STORE_CARDS_JSON:
+            return obj.cards
+        cards = [
+            {"question": card.question, "answer": card.answer}
+            for card in obj.card_set.all()
+        ]
+        return cards or None
+
+    def create(self, validated_data):
+        # The cards are generated by the worker, see api/jobs.py
+        return enqueue_session(
+            author=validated_data["author"],
+            url=validated_data["url"],
+            requirement=validated_data["requirement"],
+            pages=validated_data.get("pages"),
+            section=validated_data.get("section"),
+            num_cards=validated_data.get("num_cards"),
+            bypass_cache=validated_data["bypass_cache"],
+        )
+
+
+class SessionBatchSerializer(serializers.Serializer):
+    """
+    Many documents studied together, one session per requirement
+    """
+
+    urls = serializers.ListField(
+        child=serializers.CharField(),
+        min_length=1,
+        max_length=settings.SESSION_BATCH_MAX_URLS,
+    )
+    requirements = serializers.ListField(
+        child=serializers.CharField(),
+        required=False,
+        min_length=1,
+        max_length=settings.SESSION_BATCH_MAX_REQUIREMENTS,
+    )
+    requirement = serializers.CharField(required=False)
+
+    def validate(self, data):
+        requirements = data.pop("requirements", [])
+        if "requirement" in data:
+            requirements.insert(0, data.pop("requirement"))
+        if not requirements:
+            raise serializers.ValidationError("Give a requirement or requirements")
+        # The same document twice would only weigh more in the retrieval
+        data["urls"] = list(dict.fromkeys(data["urls"]))
+        data["requirements"] = requirements
+        return data
+
     def create(self, validated_data):
-        requirement = validated_data.pop("requirement")
-        session_instance = Session(**validated_data)
-        output = cardify_pdf(remote_url=validated_data["url"], requirement=requirement)
-        session_instance.description = output["description"]
-        session_instance.cards = output["cards"]
-        session_instance.save()
-
-        for card in output["cards"]:
-            Card.objects.create(
-                question=card["question"],
-                answer=card["answer"],
-                session=session_instance,
-                author=session_instance.author,
-            )
-        return session_instance
-
-
-class CardSerializer(serializers.ModelSerializer):
+        # The sessions are generated by the worker, see api/jobs.py
+        return enqueue_batch(
+            author=validated_data["author"],
+            urls=validated_data["urls"],
+            requirements=validated_data["requirements"],
+        )
+
+
+class CardSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Card
         fields = [
@@ -66,5 +168,74 @@ class CardSerializer(serializers.ModelSerializer):
             "question",
             "answer",
             "state",
+            "due_at",
+            "interval",
+            "ease_factor",
+            "repetitions",
+            "lapses",
+            "last_reviewed_at",
+            "duplicate_of",
+        ]
+        # The schedule only changes through reviews, see api/review.py
+        read_only_fields = [
+            "author",
+            "due_at",
+            "interval",
+            "ease_factor",
+            "repetitions",
+            "lapses",
+            "last_reviewed_at",
+            "duplicate_of",
+        ]
+
+    def update(self, instance, validated_data):
+        # Edited cards are embedded again by the worker or the next semantic search,
+        # and compared with the new cards by their new text
+        if "question" in validated_data or "answer" in validated_data:
+            instance.embedding = None
+            question = validated_data.get("question", instance.question)
+            answer = validated_data.get("answer", instance.answer)
+            instance.fingerprint = fingerprint(question, answer)
+            instance.simhash = simhash(question, answer)
+        return super().update(instance, validated_data)
+
+
+class CardSearchSerializer(CardSerializer):
+    score = serializers.FloatField(read_only=True, default=None)
+
+    class Meta(CardSerializer.Meta):
+        fields = CardSerializer.Meta.fields + ["score"]
+
+
+class ReviewSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    quality = serializers.IntegerField(min_value=0, max_value=5)
+
+
+class CardChangeSerializer(serializers.Serializer):
+    """
+    One card of a bulk update, only the fields given are changed
+    """
+
+    id = serializers.IntegerField()
+    state = serializers.ChoiceField(["pending", "useless", "done"], required=False)
+    question = serializers.CharField(max_length=1000, required=False)
+    answer = serializers.CharField(max_length=1000, required=False)
+
+
+class GenerationJobSerializer(serializers.ModelSerializer):
+    sessions = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = GenerationJob
+        fields = [
+            "id",
+            "status",
+            "attempts",
+            "error",
+            "run_after",
+            "created_at",
+            "updated_at",
+            "sessions",
         ]
-        extra_kwargs = {"author": {"read_only": True}}
+        read_only_fields = fields
@@ -0,0 +1,59 @@
+import json
+
+
+def sse_event(event, data):
+    """
+    Formats one Server-Sent Event
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class CardStreamParser:
+    """
+    Pulls complete {"question": ..., "answer": ...} objects out of a JSON document
+    while the LLM is still writing it, so each card can be sent as soon as it closes
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.starts = []
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        """
+        Adds a chunk of the LLM output and returns the cards it completed
+        """
+        self.text += chunk
+        cards = []
+        while self.position < len(self.text):
+            char = self.text[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.starts.append(self.position)
+            elif char == "}" and self.starts:
+                start = self.starts.pop()
+                card = self._parse(self.text[start : self.position + 1])
+                if card is not None:
+                    cards.append(card)
+            self.position += 1
+        return cards
+
+    @staticmethod
+    def _parse(text):
+        try:
+            value = json.loads(text)
+        except ValueError:
+            return None
+        if isinstance(value, dict) and {"question", "answer"} <= value.keys():
+            return {"question": str(value["question"]), "answer": str(value["answer"])}
+        return None
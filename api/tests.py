@@ -1,3 +1,1535 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib.util import find_spec
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import backends, caching, dedup, documents, generations, parsing, search, urls
+from .benchmark import Benchmark
+from .documents import Download, DocumentTooLarge, fetch_document, fetch_documents
+from .embeddings import EmbeddingPipeline, EmbeddingStore
+from .management.commands.benchmark_startup import probe
+from .management.commands.run_generation_worker import work
+from .jobs import (
+    JobTimeout,
+    claim_next_job,
+    create_session,
+    embed_pending_cards,
+    enqueue_session,
+    job_timeout,
+    run_job,
+    run_pending_jobs,
+)
+from .models import Session, Card, DocumentSource, GenerationJob, ParsedDocument
+from .review import due_cards, schedule
+from .search import embed_pending, forget_stale_embeddings
+from .selection import parse_pages, prefilter, select_section
+from .utils import cardify_pdf, embed_nodes
+
 
 # Create your tests here.
+class FakeEmbeddingServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OpenAI /embeddings endpoint. Every text gets the vector
+    [len(text), 1.0, 0.0], requests take `latency` seconds and the first
+    `rate_limited` requests answer 429. The first requests wait (5 seconds at most)
+    until `gather` of them are in flight together.
+    """
+
+    def __init__(self, latency=0.0, rate_limited=0, gather=0):
+        super().__init__(("127.0.0.1", 0), FakeEmbeddingHandler)
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.gather = gather
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Condition()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeEmbeddingHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append(body["input"])
+            limited = server.rate_limited > 0
+            server.rate_limited -= 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.lock.notify_all()
+            server.lock.wait_for(
+                lambda: server.max_in_flight >= server.gather, timeout=5
+            )
+        time.sleep(server.latency)
+        with server.lock:
+            server.in_flight -= 1
+
+        if limited:
+            error = {"error": {"message": "Rate limit reached", "type": "requests"}}
+            return self.reply(429, error, [("retry-after", "0")])
+        data = [
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": [float(len(text)), 1.0, 0.0],
+            }
+            for i, text in enumerate(body["input"])
+        ]
+        self.reply(
+            200,
+            {
+                "object": "list",
+                "data": data,
+                "model": body["model"],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            },
+        )
+
+
+class DocumentServer(ThreadingHTTPServer):
+    """
+    Serves /<seconds>/<name>.txt after sleeping that many seconds
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), DocumentHandler)
+
+    def url(self, seconds, name):
+        return f"http://127.0.0.1:{self.server_address[1]}/{seconds}/{name}.txt"
+
+    __enter__ = FakeEmbeddingServer.__enter__
+    __exit__ = FakeEmbeddingServer.__exit__
+
+
+class DocumentHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        seconds, name = self.path.strip("/").split("/")
+        time.sleep(float(seconds))
+        content = f"Notes about {name}".encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        try:
+            self.wfile.write(content)
+        except BrokenPipeError:
+            pass
+
+
+class EmbeddingPipelineTests(SimpleTestCase):
+    def pipeline(self, server, **kwargs):
+        options = {
+            "model": "text-embedding-3-small",
+            "api_key": "test",
+            "api_base": server.url,
+            "backoff": 0.01,
+            # One token per word keeps tiktoken (and its download) out of the tests
+            "count_tokens": lambda text: len(text.split()),
+        }
+        options.update(kwargs)
+        return EmbeddingPipeline(**options)
+
+    def test_batches_are_token_bounded(self):
+        pipeline = EmbeddingPipeline(
+            model="m", max_batch_tokens=9, max_batch_size=3, count_tokens=len
+        )
+        batches = pipeline.batches(["aaaa", "bbbb", "cc", "d", "e", "f", "g" * 20])
+        self.assertEqual(
+            [[text for _, text, _ in batch] for batch in batches],
+            [["aaaa", "bbbb"], ["cc", "d", "e"], ["f"], ["g" * 20]],
+        )
+
+    def test_embeddings_keep_the_order_of_the_texts(self):
+        texts = ["word " * (i % 7 + 1) for i in range(50)]
+        with FakeEmbeddingServer() as server:
+            embeddings, timings = self.pipeline(
+                server, max_batch_tokens=20
+            ).embed_with_timings(texts)
+        self.assertEqual([e[0] for e in embeddings], [float(len(t)) for t in texts])
+        self.assertEqual(len(timings), len(server.requests))
+        self.assertEqual(sum(timing.texts for timing in timings), len(texts))
+
+    def test_rate_limits_are_retried(self):
+        with FakeEmbeddingServer(rate_limited=2) as server:
+            embeddings, timings = self.pipeline(
+                server, max_in_flight=1
+            ).embed_with_timings(["a b", "c"])
+        self.assertEqual(embeddings, [[3.0, 1.0, 0.0], [1.0, 1.0, 0.0]])
+        self.assertEqual(timings[0].retries, 2)
+
+    def test_batches_run_concurrently(self):
+        texts = [f"chunk number {i}" for i in range(400)]
+        for max_in_flight in (1, 8):
+            # The server holds the first requests until as many as allowed arrived,
+            # no more may come in meanwhile
+            with FakeEmbeddingServer(gather=max_in_flight) as server:
+                self.pipeline(
+                    server, max_batch_size=25, max_in_flight=max_in_flight
+                ).embed_with_timings(texts)
+            self.assertEqual(server.max_in_flight, max_in_flight)
+
+
+class EmbeddingStoreTests(SimpleTestCase):
+    def test_stored_vectors_are_reused(self):
+        calls = []
+
+        def embed(texts):
+            calls.append(texts)
+            return [[float(len(text)), 1.0] for text in texts]
+
+        with tempfile.TemporaryDirectory() as path:
+            store = EmbeddingStore(path, "model")
+            first = store.embed(["a", "bb", "a"], embed)
+            self.assertEqual(calls, [["a", "bb"]])
+            self.assertEqual(
+                [list(vector) for vector in first], [[1, 1], [2, 1], [1, 1]]
+            )
+
+            # Another process opening the same directory finds them too
+            again = EmbeddingStore(path, "model").embed(["bb", "ccc", "a"], embed)
+            self.assertEqual(calls, [["a", "bb"], ["ccc"]])
+            self.assertEqual(
+                [list(vector) for vector in again], [[2, 1], [3, 1], [1, 1]]
+            )
+
+    def test_chunks_of_different_documents_share_their_embedding(self):
+        from llama_index.core.schema import MetadataMode, TextNode
+
+        calls = []
+
+        def embed(texts):
+            calls.append(texts)
+            return [[1.0, 0.0] for text in texts]
+
+        text = "Enzymes lower activation energy."
+        nodes = [
+            TextNode(text=text, metadata={"Source": url, "page_label": page})
+            for url, page in [("https://a.com/x.pdf", "1"), ("https://b.com/y", "7")]
+        ]
+        with tempfile.TemporaryDirectory() as path:
+            backend = mock.Mock(embedding_store=EmbeddingStore(path, "model"))
+            backend.embed = embed
+            with mock.patch("api.utils.get_backend", return_value=backend):
+                embed_nodes(nodes)
+        self.assertEqual(calls, [[text]])
+        self.assertEqual(nodes[0].embedding, nodes[1].embedding)
+        # The LLM still sees where the chunk comes from
+        self.assertIn("https://b.com/y", nodes[1].get_content(MetadataMode.LLM))
+
+
+class StartupTests(SimpleTestCase):
+    def test_crud_workers_do_not_import_llama_index(self):
+        seconds, max_rss, imports_llama_index = probe(
+            engine=False, settings_module="makeflashcards.settings"
+        )
+        self.assertFalse(imports_llama_index)
+
+
+class DocumentLoadingTests(TestCase):
+    @override_settings(DOCUMENT_FETCH_TIMEOUT=1, DOCUMENT_FETCH_CONCURRENCY=4)
+    def test_a_slow_host_only_delays_its_document(self):
+        with DocumentServer() as server:
+            urls = [server.url(0.3, f"fast-{i}") for i in range(4)]
+            slow = server.url(3, "slow")
+            start = time.perf_counter()
+            results = fetch_documents(urls + [slow])
+            elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 2)
+        self.assertIsInstance(results[slow], TimeoutError)
+        for url in urls:
+            content_hash, download = results[url]
+            self.assertTrue(download.content.startswith(b"Notes about fast"))
+
+    @override_settings(DOCUMENT_MAX_BYTES=10)
+    def test_large_documents_are_refused(self):
+        with DocumentServer() as server:
+            url = server.url(0, "long")
+            with self.assertRaises(DocumentTooLarge):
+                fetch_document(url)
+
+    def test_unchanged_documents_are_revalidated(self):
+        import httpx
+
+        requests = []
+        served = {"etag": '"v1"', "content": b"Enzymes lower the activation energy"}
+
+        def handler(request):
+            requests.append(request.headers.get("If-None-Match"))
+            if request.headers.get("If-None-Match") == served["etag"]:
+                return httpx.Response(304)
+            return httpx.Response(
+                200,
+                content=served["content"],
+                headers={"ETag": served["etag"], "Content-Type": "text/plain"},
+            )
+
+        AsyncClient = httpx.AsyncClient
+
+        def client(**kwargs):
+            return AsyncClient(transport=httpx.MockTransport(handler), **kwargs)
+
+        url = "https://example.com/notes.txt"
+        with mock.patch.object(httpx, "AsyncClient", client):
+            content_hash, download = fetch_document(url)
+            self.assertEqual(download.content, served["content"])
+            # Recently checked, the network is skipped
+            self.assertEqual(fetch_document(url), (content_hash, None))
+            self.assertEqual(requests, [None])
+
+            with override_settings(DOCUMENT_CACHE_REVALIDATE_AFTER=0):
+                self.assertEqual(fetch_document(url), (content_hash, None))
+                served.update(etag='"v2"', content=b"Enzymes are proteins")
+                changed_hash, download = fetch_document(url)
+            self.assertEqual(requests, [None, '"v1"', '"v1"'])
+            self.assertNotEqual(changed_hash, content_hash)
+            self.assertEqual(download.content, b"Enzymes are proteins")
+
+    def test_least_recently_used_documents_are_evicted(self):
+        now = timezone.now()
+        for i in range(4):
+            ParsedDocument.objects.create(
+                content_hash=str(i),
+                data=b"",
+                size=100,
+                last_used_at=now - timedelta(hours=i),
+            )
+        self.assertEqual(documents.evict(max_bytes=400), 0)
+        self.assertEqual(documents.evict(max_bytes=250), 2)
+        self.assertEqual(
+            set(ParsedDocument.objects.values_list("content_hash", flat=True)),
+            {"0", "1"},
+        )
+
+    @skipUnless(find_spec("llama_index.readers.file"), "llama-index-readers-file")
+    @override_settings(DOCUMENT_PARSE_PROCESSES=2, DOCUMENT_PARSE_MAX_PENDING=2)
+    def test_binary_files_are_read_in_the_process_pool(self):
+        self.addCleanup(parsing.reset_pool)
+        url = "https://example.com/notes.md"
+        download = Download.from_content(
+            b"# Enzymes\n\nCatalysts of the cell", "text/markdown"
+        )
+        documents = parsing.read_documents(url, download)
+        self.assertIsNotNone(parsing._pool)
+        inline = parsing.read_file(url, download.path, download.content_type)
+        self.assertEqual(
+            [(d.text, d.metadata) for d in documents],
+            [(d.text, d.metadata) for d in inline],
+        )
+
+
+class SelectionTests(SimpleTestCase):
+    def nodes(self, *texts):
+        from llama_index.core.schema import TextNode
+
+        return [TextNode(text=text) for text in texts]
+
+    def test_pages_are_parsed(self):
+        self.assertEqual(parse_pages("3-5, 1"), [0, 2, 3, 4])
+        for spec in ("5-2", "0", "a", "1-"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                parse_pages(spec)
+
+    def test_section_follows_headings(self):
+        nodes = self.nodes(
+            "# Introduction\nWhy cells",
+            "More introduction",
+            "End of it\n## Chapter 3 Enzymes\nCatalysts",
+            "Still chapter three",
+            "## Chapter 30\nSomething else",
+        )
+        self.assertEqual(select_section(nodes, "chapter 3"), nodes[2:4])
+
+    def test_prefilter_keeps_the_relevant_nodes_in_order(self):
+        nodes = self.nodes(
+            "enzymes lower the activation energy",
+            "the cell membrane",
+            "enzymes and substrates, enzymes everywhere",
+            "ribosomes make proteins",
+        )
+        kept = prefilter(nodes, "Questions about enzymes", max_nodes=2)
+        self.assertEqual(kept, [nodes[0], nodes[2]])
+        self.assertEqual(prefilter(nodes, "enzymes", max_nodes=0), nodes)
+
+    def test_retrieval_skips_duplicates_and_fits_the_budget(self):
+        from .retrieval import mmr, normalized, pack
+
+        vectors = normalized([[1, 0, 0], [1, 0.01, 0], [0.8, 0.6, 0], [0, 0, 1]])
+        relevance = vectors @ normalized([1, 0, 0.1])
+        order = mmr(relevance, vectors @ vectors.T, diversity=0.7, duplicate=0.97)
+        # The second chunk repeats the first, the last one is off topic
+        self.assertEqual(order, [0, 2, 3])
+
+        # A chunk without any text to embed
+        vectors = normalized([[1, 0, 0], [0, 0, 0]])
+        order = mmr(vectors @ [1, 0, 0], vectors @ vectors.T, 0.7, 0.97)
+        self.assertEqual(order, [0, 1])
+
+        self.assertEqual(pack([400, 900, 300, 200], 1000, 1, 10), [0, 2, 3])
+        self.assertEqual(pack([1500, 900], 1000, 1, 10), [0])
+        self.assertEqual(pack([100] * 5, 1000, 1, 3), [0, 1, 2])
+
+
+@override_settings(GENERATION_JOB_RETRY_DELAY=10, GENERATION_JOB_MAX_ATTEMPTS=3)
+class JobTests(TestCase):
+    output = {
+        "description": "Enzymes",
+        "cards": [{"question": "What do enzymes lower?", "answer": "Activation"}],
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user("student", password="secret")
+        self.session = enqueue_session(
+            self.user, "https://example.com/notes.pdf", "Enzymes", bypass_cache=True
+        )
+        self.job = self.session.job
+
+    def test_failures_are_retried_with_backoff(self):
+        failing = mock.patch("api.jobs.cardify_pdf", side_effect=RuntimeError("down"))
+        with failing, self.assertLogs("api.jobs", "ERROR"):
+            for attempt, delay in enumerate([10, 20], start=1):
+                before = timezone.now()
+                run_job(claim_next_job())
+                self.job.refresh_from_db()
+                self.assertEqual(
+                    (self.job.status, self.job.attempts), ("pending", attempt)
+                )
+                self.assertIn("down", self.job.error)
+                self.assertGreaterEqual(
+                    self.job.run_after, before + timedelta(seconds=delay)
+                )
+                # Not due yet
+                self.assertIsNone(claim_next_job())
+                GenerationJob.objects.update(run_after=timezone.now())
+
+            run_job(claim_next_job())
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.attempts), ("failed", 3))
+        self.assertIsNone(claim_next_job())
+
+    def test_expired_leases_are_reclaimed(self):
+        later = timezone.now() + timedelta(minutes=1)
+        GenerationJob.objects.update(status="running", attempts=1, locked_until=later)
+        self.assertIsNone(claim_next_job())
+
+        earlier = timezone.now() - timedelta(seconds=1)
+        GenerationJob.objects.update(locked_until=earlier)
+        job = claim_next_job()
+        self.assertEqual(
+            (job.pk, job.status, job.attempts), (self.job.pk, "running", 2)
+        )
+        self.assertGreater(job.locked_until, timezone.now())
+
+        # The last attempt hung as well
+        GenerationJob.objects.update(attempts=3, locked_until=earlier)
+        self.assertIsNone(claim_next_job())
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.error), ("failed", "Timed out"))
+
+    def test_results_of_a_lost_lease_are_discarded(self):
+        def reclaimed(**kwargs):
+            # Another worker took the job over meanwhile
+            GenerationJob.objects.update(attempts=2)
+            return self.output
+
+        job = claim_next_job()
+        with mock.patch("api.jobs.cardify_pdf", side_effect=reclaimed):
+            with self.assertLogs("api.jobs", "WARNING"):
+                run_job(job)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.description, "")
+        self.assertFalse(self.session.card_set.exists())
+
+    def test_failures_storing_the_sessions_are_retried(self):
+        generate = mock.patch("api.jobs.cardify_pdf", return_value=self.output)
+        failing = mock.patch(
+            "api.jobs.complete_sessions", side_effect=IntegrityError("constraint")
+        )
+        with generate, failing, self.assertLogs("api.jobs", "ERROR"):
+            run_job(claim_next_job())
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.attempts), ("pending", 1))
+        self.assertIn("constraint", self.job.error)
+
+    def test_the_worker_survives_database_errors(self):
+        worker = "api.management.commands.run_generation_worker"
+        patches = [
+            mock.patch(f"{worker}.get_backend"),
+            mock.patch(f"{worker}.forget_stale_embeddings"),
+            mock.patch(f"{worker}.embed_pending_cards", return_value=0),
+            mock.patch(f"{worker}.connections"),
+            mock.patch(f"{worker}.time.sleep"),
+            mock.patch(
+                f"{worker}.claim_next_job",
+                side_effect=[OperationalError("gone"), self.job, None],
+            ),
+            mock.patch(f"{worker}.run_job", side_effect=IntegrityError("constraint")),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        with mock.patch(f"{worker}.close_old_connections") as close:
+            with self.assertLogs("api.jobs", "ERROR") as logs:
+                work(once=True)
+        self.assertEqual(close.call_count, 2)
+        self.assertEqual(len(logs.records), 2)
+
+    @override_settings(GENERATION_JOB_TIMEOUT=0.05)
+    def test_attempts_time_out(self):
+        with self.assertRaises(JobTimeout), job_timeout(0.05):
+            time.sleep(1)
+
+        def hang(**kwargs):
+            time.sleep(1)
+
+        with mock.patch("api.jobs.cardify_pdf", side_effect=hang):
+            with self.assertLogs("api.jobs", "ERROR"):
+                run_job(claim_next_job())
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "pending")
+        self.assertIn("JobTimeout", self.job.error)
+
+    def test_status_is_served_to_its_author(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        generate = mock.patch("api.jobs.cardify_pdf", return_value=self.output)
+        with generate, mock.patch("api.jobs.embed_cards") as embed:
+            run_pending_jobs()
+        embed.assert_called_once()
+        job = client.get(f"/api/jobs/{self.job.pk}/").json()
+        self.assertEqual((job["status"], job["sessions"]), ("done", [self.session.pk]))
+        self.assertEqual(self.session.card_set.count(), 1)
+
+        client.force_authenticate(User.objects.create_user("other"))
+        self.assertEqual(client.get(f"/api/jobs/{self.job.pk}/").status_code, 404)
+
+
+class GenerationCacheTests(TestCase):
+    output = {"description": "Cells", "cards": [{"question": "Q", "answer": "A"}]}
+
+    def test_similar_requirements_share_their_output(self):
+        key = generations.document_key("hash")
+        generations.store(key, "Key terms", self.output, embedding=[1.0, 0.0])
+        with self.settings(GENERATION_CACHE_SIMILARITY=0.95):
+            self.assertEqual(
+                generations.lookup(key, "Terms", embedding=[0.99, 0.05]), self.output
+            )
+            self.assertIsNone(generations.lookup(key, "Other", embedding=[0.5, 0.5]))
+        self.assertIsNone(
+            generations.lookup(generations.document_key("x"), "Key terms")
+        )
+
+    def test_entries_expire_and_the_least_recently_used_go(self):
+        key = generations.document_key("hash")
+        for requirement in ("one", "two", "three"):
+            generations.store(key, requirement, self.output)
+        generations.lookup(key, "one")
+        generations.evict(max_entries=2)
+        self.assertIsNotNone(generations.lookup(key, "one"))
+        self.assertIsNone(generations.lookup(key, "two"))
+        with self.settings(GENERATION_CACHE_TTL=0):
+            self.assertIsNone(generations.lookup(key, "three"))
+
+
+@override_settings(SESSION_STORE_CARDS_JSON=False)
+class CardRowsTests(TestCase):
+    """
+    Sessions without the JSON copy of their cards
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user("student", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        create_session(
+            self.user,
+            "x",
+            {
+                "description": "First",
+                "cards": [
+                    {"question": f"Question {i}", "answer": f"Answer {i}"}
+                    for i in range(3)
+                ],
+            },
+        )
+        self.cards = [{"question": "Other question", "answer": "Other answer"}]
+        self.session = create_session(
+            self.user, "x", {"description": "Second", "cards": self.cards}
+        )
+
+    def test_cards_are_read_from_their_rows(self):
+        self.assertTrue(
+            all(
+                cards is None
+                for cards in Session.objects.values_list("cards", flat=True)
+            )
+        )
+        # The sessions, then the cards of all of them
+        with self.assertNumQueries(2):
+            sessions = self.client.get("/api/sessions/").json()["results"]
+        self.assertEqual(sessions[0]["cards"], self.cards)
+        self.assertEqual(len(sessions[1]["cards"]), 3)
+
+        session = self.client.get(f"/api/sessions/{self.session.id}/").json()
+        self.assertEqual(session["cards"], self.cards)
+        Card.objects.filter(session=self.session).delete()
+        session = self.client.get(f"/api/sessions/{self.session.id}/").json()
+        self.assertIsNone(session["cards"])
+
+    def test_the_json_copies_follow_the_setting(self):
+        pending = enqueue_session(self.user, "x", "Terms", bypass_cache=True)
+        with self.settings(SESSION_STORE_CARDS_JSON=True):
+            call_command("sync_cards_json", stdout=io.StringIO())
+            session = self.client.get(f"/api/sessions/{self.session.id}/").json()
+            self.assertEqual(session["cards"], self.cards)
+            self.assertEqual(Session.objects.filter(cards__isnull=False).count(), 2)
+        pending.refresh_from_db()
+        self.assertIsNone(pending.cards)
+
+        call_command("sync_cards_json", stdout=io.StringIO())
+        self.assertFalse(Session.objects.filter(cards__isnull=False).exists())
+
+
+class PaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+        for i in range(3):
+            create_session(
+                cls.user,
+                "https://example.com/notes.pdf",
+                {
+                    "description": f"Session {i}",
+                    "cards": [{"question": f"Question {i}", "answer": "Answer"}],
+                },
+            )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_pages_go_back_and_forth(self):
+        first = self.client.get("/api/sessions/?page_size=2").json()
+        self.assertEqual(
+            [session["description"] for session in first["results"]],
+            ["Session 2", "Session 1"],
+        )
+        self.assertIsNone(first["previous"])
+        second = self.client.get(first["next"]).json()
+        self.assertEqual(len(second["results"]), 1)
+        self.assertIsNone(second["next"])
+        back = self.client.get(second["previous"]).json()
+        self.assertEqual(back["results"], first["results"])
+
+        response = self.client.get("/api/sessions/?cursor=nonsense")
+        self.assertEqual(response.status_code, 404)
+
+    def test_sparse_fields(self):
+        page = self.client.get("/api/sessions/?fields=id,description").json()
+        self.assertEqual(set(page["results"][0]), {"id", "description"})
+
+    def test_unchanged_pages_are_not_sent_again(self):
+        response = self.client.get("/api/cards/")
+        etag = response["ETag"]
+        response = self.client.get("/api/cards/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+        card = Card.objects.filter(author=self.user).first()
+        self.client.patch(f"/api/cards/{card.id}/", {"state": "done"})
+        response = self.client.get("/api/cards/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class QueryPlanTests(TestCase):
+    """
+    Query counts of the hot endpoints, and their plans on Postgres and SQLite
+    so a sequential scan on these paths shows up as a failure
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+        other = User.objects.create_user("other", password="secret")
+        for author in (cls.user, other):
+            for i in range(3):
+                create_session(
+                    author,
+                    "https://example.com/notes.pdf",
+                    {
+                        "description": f"Session {i}",
+                        "cards": [
+                            {"question": f"Question {j}", "answer": f"Answer {j}"}
+                            for j in range(10)
+                        ],
+                    },
+                )
+        cls.session = Session.objects.filter(author=cls.user).first()
+        cls.card = Card.objects.filter(session=cls.session).first()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_query_counts(self):
+        # The repeated sessions keep their cards, as duplicates
+        self.assertEqual(Card.objects.filter(author=self.user).count(), 30)
+        # Pending sessions have no cards yet, nothing is looked up for them
+        for i in range(5):
+            enqueue_session(self.user, f"https://example.com/{i}.pdf", "Terms")
+        urls = [
+            "/api/sessions/",
+            "/api/sessions/?fields=id,description",
+            f"/api/sessions/{self.session.id}/",
+            f"/api/sessions/{self.session.id}/cards/",
+            f"/api/sessions/{self.session.id}/cards/?state=pending",
+            f"/api/sessions/{self.session.id}/cards/{self.card.id}/",
+            "/api/cards/",
+            "/api/cards/?state=done",
+            f"/api/cards/{self.card.id}/",
+        ]
+        for url in urls:
+            with self.subTest(url=url), self.assertNumQueries(1):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+
+    def test_pages_follow_each_other(self):
+        ids = []
+        url = "/api/cards/?page_size=7&fields=id"
+        while url:
+            with self.assertNumQueries(1):
+                page = self.client.get(url).json()
+            ids += [card["id"] for card in page["results"]]
+            url = page["next"]
+        expected = Card.objects.filter(author=self.user).order_by("-created_at", "-id")
+        self.assertEqual(ids, list(expected.values_list("id", flat=True)))
+
+    def assertUsesIndex(self, queryset):
+        if connection.vendor == "postgresql":
+            # The test tables are tiny, only refuse seq scans when an index can do it
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                plan = queryset.explain()
+            self.assertNotIn("Seq Scan", plan)
+        elif connection.vendor == "sqlite":
+            plan = queryset.explain()
+            self.assertNotRegex(plan, r"SCAN api_\w+(?! USING)")
+        else:
+            self.skipTest(f"No plan checks for {connection.vendor}")
+
+    def test_hot_queries_use_indexes(self):
+        querysets = [
+            Card.objects.filter(author=self.user).order_by("-created_at", "-id")[:51],
+            Card.objects.filter(author=self.user, state="done").order_by("created_at"),
+            Card.objects.filter(session=self.session.id),
+            Card.objects.filter(session=self.session.id, state="pending"),
+            Card.objects.filter(session=self.session.id, id=self.card.id),
+            due_cards(self.user, 20),
+            Session.objects.filter(author=self.user).order_by("-created_at", "-id")[
+                :51
+            ],
+        ]
+        for queryset in querysets:
+            with self.subTest(query=str(queryset.query)):
+                self.assertUsesIndex(queryset)
+
+
+class ReviewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+        cls.session = create_session(
+            cls.user,
+            "https://example.com/notes.pdf",
+            {
+                "description": "Session",
+                "cards": [
+                    {"question": f"Question {j}", "answer": f"Answer {j}"}
+                    for j in range(30)
+                ],
+            },
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_sm2_intervals(self):
+        card = Card(question="q", answer="a")
+        intervals = [schedule(card, 4).interval for _ in range(4)]
+        self.assertEqual(intervals, [1, 6, 15, 38])
+        schedule(card, 1)
+        self.assertEqual((card.interval, card.repetitions, card.lapses), (1, 0, 1))
+        self.assertAlmostEqual(card.ease_factor, 1.96)
+
+    def test_next_skips_useless_and_future_cards(self):
+        cards = list(Card.objects.filter(session=self.session).order_by("id"))
+        cards[0].state = "useless"
+        cards[0].save()
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/review/next/?limit=20")
+        ids = [card["id"] for card in response.json()]
+        self.assertEqual(len(ids), 20)
+        self.assertNotIn(cards[0].id, ids)
+
+    def test_submit_reschedules_the_batch(self):
+        ids = list(Card.objects.values_list("id", flat=True)[:3])
+        response = self.client.post(
+            "/api/review/",
+            [{"id": ids[0], "quality": 5}, {"id": ids[1], "quality": 0}],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        due = self.client.get("/api/review/next/?limit=100&fields=id").json()
+        self.assertNotIn(ids[0], [card["id"] for card in due])
+        self.assertNotIn(ids[1], [card["id"] for card in due])
+        self.assertIn(ids[2], [card["id"] for card in due])
+
+        response = self.client.post(
+            "/api/review/", [{"id": 0, "quality": 5}], format="json"
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class BulkUpdateTests(TestCase):
+    url = "/api/cards/bulk/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+        cls.session = create_session(
+            cls.user,
+            "https://example.com/notes.pdf",
+            {
+                "description": "Session",
+                "cards": [
+                    {"question": f"Question {j}", "answer": f"Answer {j}"}
+                    for j in range(20)
+                ],
+            },
+        )
+        cls.ids = list(cls.session.card_set.order_by("id").values_list("id", flat=True))
+        other = User.objects.create_user("other")
+        cls.foreign = create_session(
+            other,
+            "x",
+            {"description": "Other", "cards": [{"question": "q", "answer": "a"}]},
+        ).card_set.get()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_many_cards_change_in_one_update(self):
+        Card.objects.filter(id__in=self.ids).update(embedding=b"vector")
+        changes = [{"id": pk, "state": "done"} for pk in self.ids]
+        changes[0].update(question="Edited question", answer="Edited answer")
+        # SELECT and UPDATE, in a savepoint
+        with self.assertNumQueries(4):
+            response = self.client.patch(self.url, changes, format="json")
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual([result["status"] for result in results], ["updated"] * 20)
+        self.assertEqual(results[0]["card"]["question"], "Edited question")
+        self.assertEqual(Card.objects.filter(id__in=self.ids, state="done").count(), 20)
+
+        edited = Card.objects.get(id=self.ids[0])
+        self.assertEqual(
+            edited.fingerprint, dedup.fingerprint("Edited question", "Edited answer")
+        )
+        self.assertIsNone(edited.embedding)
+        self.assertEqual(bytes(Card.objects.get(id=self.ids[1]).embedding), b"vector")
+
+    def test_cards_of_other_users_are_not_found(self):
+        changes = [
+            {"id": self.ids[0], "state": "useless"},
+            {"id": self.foreign.id, "state": "useless"},
+            {"id": 0, "state": "useless"},
+        ]
+        response = self.client.patch(self.url, changes, format="json")
+        self.assertEqual(
+            [(result["id"], result["status"]) for result in response.json()],
+            [
+                (self.ids[0], "updated"),
+                (self.foreign.id, "not_found"),
+                (0, "not_found"),
+            ],
+        )
+        self.foreign.refresh_from_db()
+        self.assertEqual(self.foreign.state, "pending")
+
+    @override_settings(CARD_BULK_MAX_ITEMS=5)
+    def test_requests_are_validated(self):
+        changes = [{"id": pk, "state": "done"} for pk in self.ids[:6]]
+        response = self.client.patch(self.url, changes, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.patch(self.url, changes[:5], format="json")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.patch(
+            self.url, [{"id": self.ids[0], "state": "lost"}], format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Card.objects.filter(state="lost").count(), 0)
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+        cards = [
+            {
+                "question": "What do enzymes lower?",
+                "answer": "The activation energy of a reaction",
+            },
+            {"question": "Where is ATP made?", "answer": "In the mitochondria"},
+            {
+                "question": "What is a substrate?",
+                "answer": "The molecule an enzyme acts on",
+            },
+        ]
+        cls.session = create_session(
+            cls.user,
+            "https://example.com/biology.pdf",
+            {"description": "Biology", "cards": cards},
+        )
+        other = User.objects.create_user("other")
+        create_session(other, "x", {"description": "Other", "cards": cards[:1]})
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get("/api/cards/search/", params)
+        self.assertEqual(response.status_code, 200)
+        return [card["question"] for card in response.data]
+
+    def test_words_and_prefixes_match(self):
+        self.assertEqual(self.search(q="enzyme activation"), ["What do enzymes lower?"])
+        self.assertEqual(len(self.search(q="enzym")), 2)
+        self.assertEqual(self.search(q='"mitochondria'), ["Where is ATP made?"])
+        self.assertEqual(self.search(q="photosynthesis"), [])
+        response = self.client.get("/api/cards/search/", {"q": " "})
+        self.assertEqual(response.status_code, 400)
+
+        # The index follows edits and deletes
+        card = Card.objects.get(author=self.user, question="Where is ATP made?")
+        self.client.patch(f"/api/cards/{card.pk}/", {"answer": "In chloroplasts too"})
+        self.assertEqual(self.search(q="mitochondria"), [])
+        self.assertEqual(self.search(q="chloroplasts"), ["Where is ATP made?"])
+        card.delete()
+        self.assertEqual(self.search(q="chloroplasts"), [])
+
+    def use_fake_backend(self):
+        store = tempfile.TemporaryDirectory()
+        self.addCleanup(store.cleanup)
+        overrides = override_settings(
+            GENERATION_BACKEND="api.backends.FakeBackend",
+            FAKE_BACKEND_LATENCY=0,
+            EMBEDDING_STORE_DIR=store.name,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        backends._backend_key = None
+        self.addCleanup(setattr, backends, "_backend_key", None)
+        # Kept in memory, while the rows of the other tests are rolled back
+        search._matrices.clear()
+
+    def test_semantic_search_ranks_by_embedding(self):
+        self.use_fake_backend()
+        # Not embedded yet, the search does not call the embedding API for them
+        query = "Where is ATP made?\nIn the mitochondria"
+        self.assertEqual(self.search(q=query, mode="semantic"), [])
+        embed_pending_cards()
+        # The fake embeddings only know identical texts
+        found = self.search(q=query, mode="semantic", limit=2)
+        self.assertEqual(found[0], "Where is ATP made?")
+        self.assertEqual(len(found), 2)
+        self.assertFalse(Card.objects.filter(author=self.user, embedding=None).exists())
+        card = Card.objects.get(author=self.user, question="Where is ATP made?")
+        self.client.patch(f"/api/cards/{card.pk}/", {"answer": "In chloroplasts"})
+        self.assertIsNone(Card.objects.get(pk=card.pk).embedding)
+        # Unless told to embed a few itself
+        with self.settings(SEARCH_EMBED_BATCH=1):
+            found = self.search(
+                q="Where is ATP made?\nIn chloroplasts", mode="semantic"
+            )
+        self.assertEqual(found[0], "Where is ATP made?")
+
+    def test_the_worker_embeds_new_and_edited_cards(self):
+        self.use_fake_backend()
+        session = enqueue_session(self.user, "x", "Cells", bypass_cache=True)
+        output = {
+            "description": "Cells",
+            "cards": [{"question": "What is a cell?", "answer": "A unit of life"}],
+        }
+        with mock.patch("api.jobs.cardify_pdf", return_value=output):
+            run_job(claim_next_job())
+        card = session.card_set.get()
+        self.assertEqual(
+            (card.embedding_model, card.embedding_dimensions), ("fake-embedding", 256)
+        )
+
+        # Edited cards are left out of the search until the worker gets to them
+        self.client.patch(f"/api/cards/{card.pk}/", {"answer": "The unit of life"})
+        found = self.search(q="What is a cell?\nThe unit of life", mode="semantic")
+        self.assertNotIn("What is a cell?", found)
+        self.assertEqual(embed_pending_cards(), 5)
+        self.assertEqual(embed_pending_cards(), 0)
+        found = self.search(q="What is a cell?\nThe unit of life", mode="semantic")
+        self.assertEqual(found[0], "What is a cell?")
+
+    def test_embeddings_made_otherwise_are_not_compared(self):
+        self.use_fake_backend()
+        embed_pending(self.user)
+        cards = Card.objects.filter(author=self.user)
+        cards.filter(question="Where is ATP made?").update(
+            embedding=b"\0" * 64, embedding_model="text-embedding-3-small"
+        )
+        found = self.search(q="Where is ATP made?", mode="semantic")
+        self.assertEqual(len(found), 2)
+        self.assertNotIn("Where is ATP made?", found)
+
+        # The worker embeds them again, the same goes for other dimensions
+        with self.settings(SEARCH_EMBEDDING_DIMENSIONS=32):
+            self.assertEqual(forget_stale_embeddings(), 3)
+            self.assertEqual(cards.filter(embedding=None).count(), 3)
+            self.assertEqual(embed_pending_cards(), 4)
+            found = self.search(
+                q="Where is ATP made?\nIn the mitochondria", mode="semantic"
+            )
+        self.assertEqual(found[0], "Where is ATP made?")
+        self.assertEqual(len(bytes(cards.first().embedding)), 64)
+
+
+class DedupTests(TestCase):
+    cards = [
+        {"question": "What do enzymes lower?", "answer": "The activation energy"},
+        {"question": "Where is ATP made?", "answer": "In the mitochondria"},
+    ]
+
+    def setUp(self):
+        self.user = User.objects.create_user("student", password="secret")
+        create_session(self.user, "x", {"description": "First", "cards": self.cards})
+
+    @override_settings(CARD_DEDUP="skip")
+    def test_repeated_cards_are_skipped(self):
+        cards = [
+            {"question": "what do Enzymes lower", "answer": "The activation energy."},
+            {"question": "What is a substrate?", "answer": "What an enzyme acts on"},
+            {"question": "What is a substrate?", "answer": "What an enzyme acts on"},
+        ]
+        session = create_session(
+            self.user, "x", {"description": "Second", "cards": cards}
+        )
+        self.assertEqual(
+            [card["question"] for card in session.cards],
+            ["What is a substrate?"],
+        )
+        self.assertEqual(Card.objects.filter(author=self.user).count(), 3)
+
+        other = User.objects.create_user("other")
+        create_session(other, "x", {"description": "Other", "cards": self.cards})
+        self.assertEqual(Card.objects.filter(author=other).count(), 2)
+
+    def test_a_repeated_session_still_lists_its_cards(self):
+        again = create_session(
+            self.user, "x", {"description": "Again", "cards": self.cards}
+        )
+        self.assertEqual(len(again.cards), 2)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        cards = client.get(f"/api/sessions/{again.pk}/cards/").json()["results"]
+        self.assertEqual(
+            sorted(card["question"] for card in cards),
+            sorted(card["question"] for card in self.cards),
+        )
+        self.assertEqual({card["state"] for card in cards}, {"duplicate"})
+
+    def test_flagged_duplicates_are_not_reviewed(self):
+        original = Card.objects.get(author=self.user, question__startswith="Where")
+        create_session(self.user, "x", {"description": "Again", "cards": self.cards})
+        duplicates = Card.objects.filter(author=self.user, state="duplicate")
+        self.assertEqual(len(duplicates), 2)
+        self.assertIn(original, [card.duplicate_of for card in duplicates])
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        due = client.get("/api/review/next/?limit=100&fields=id").json()
+        self.assertEqual(len(due), 2)
+
+
+# Local memory is shared here, the tests run in one process
+@override_settings(VIEW_CACHE_TTL=300)
+class ViewCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+        cls.session = create_session(
+            cls.user,
+            "https://example.com/notes.pdf",
+            {
+                "description": "Session",
+                "cards": [
+                    {"question": "What do enzymes lower?", "answer": "Activation"},
+                    {"question": "Where is ATP made?", "answer": "Mitochondria"},
+                ],
+            },
+        )
+
+    def setUp(self):
+        caches["views"].clear()
+        token = self.client.post(
+            "/api/token/", {"username": "student", "password": "secret"}
+        ).json()["access"]
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_polling_is_served_from_the_cache(self):
+        urls = [
+            f"/api/sessions/{self.session.id}/",
+            f"/api/sessions/{self.session.id}/cards/",
+            "/api/cards/",
+        ]
+        first = [self.client.get(url).json() for url in urls]
+        hits = caching.stats["hits"]
+        with self.assertNumQueries(0):
+            self.assertEqual([self.client.get(url).json() for url in urls], first)
+        self.assertEqual(caching.stats["hits"], hits + 3)
+
+        # Edits, reviews and deletes show up right away
+        card = first[2]["results"][0]
+        self.client.patch(f"/api/cards/{card['id']}/", {"state": "done"})
+        cards = self.client.get(f"/api/sessions/{self.session.id}/cards/").json()
+        self.assertEqual(cards["results"][0]["state"], "done")
+        self.client.post("/api/review/", [{"id": card["id"], "quality": 5}], "json")
+        cards = self.client.get("/api/cards/").json()
+        self.assertEqual(cards["results"][0]["repetitions"], 1)
+        self.client.delete(f"/api/cards/{card['id']}/")
+        cards = self.client.get(f"/api/sessions/{self.session.id}/cards/").json()
+        self.assertEqual(len(cards["results"]), 1)
+
+        # Deactivated users are logged out
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get("/api/cards/").status_code, 401)
+
+
+class SessionStreamTests(TestCase):
+    url = "/api/sessions/stream/"
+    output = {
+        "description": "Enzymes",
+        "cards": [{"question": "What do enzymes lower?", "answer": "Activation"}],
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+
+    def setUp(self):
+        token = self.client.post(
+            "/api/token/", {"username": "student", "password": "secret"}
+        ).json()["access"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def post(self, data, headers=None):
+        return await self.async_client.post(
+            self.url,
+            data,
+            content_type="application/json",
+            headers=self.headers if headers is None else headers,
+        )
+
+    async def events(self, cardify_pdf):
+        # The generation thread has its own connection, the session is not saved
+        session = Session(id=1, url="https://example.com/notes.pdf", author=self.user)
+        with mock.patch("api.views.cardify_pdf", cardify_pdf), mock.patch(
+            "api.views.create_session", return_value=session
+        ):
+            response = await self.post(
+                {"url": "https://example.com/notes.pdf", "requirement": "Enzymes"}
+            )
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            body = b"".join([chunk async for chunk in response.streaming_content])
+        return [
+            line.removeprefix("event: ")
+            for line in body.decode().splitlines()
+            if line.startswith("event: ")
+        ]
+
+    async def test_requests_are_checked(self):
+        response = await self.post({}, headers={})
+        self.assertEqual(response.status_code, 401)
+        response = await self.post({}, headers={"Authorization": "Bearer nonsense"})
+        self.assertEqual(response.status_code, 401)
+        response = await self.post("{not json")
+        self.assertEqual(response.status_code, 400)
+        response = await self.post({"requirement": "Enzymes"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("url", json.loads(response.content))
+
+    async def test_events_end_with_the_session(self):
+        def cardify_pdf(emit, **kwargs):
+            emit("stage", {"stage": "fetch"})
+            emit("card", self.output["cards"][0])
+            return self.output
+
+        self.assertEqual(await self.events(cardify_pdf), ["stage", "card", "session"])
+
+    async def test_failures_end_with_an_error(self):
+        def cardify_pdf(emit, **kwargs):
+            emit("stage", {"stage": "fetch"})
+            raise RuntimeError("down")
+
+        with self.assertLogs("api.views", "ERROR"):
+            self.assertEqual(await self.events(cardify_pdf), ["stage", "error"])
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("student", password="secret")
+        for i in range(2):
+            create_session(
+                cls.user,
+                "https://example.com/notes.pdf",
+                {
+                    "description": f"Session {i}",
+                    "cards": [
+                        {"question": f"Question {i}.{j}", "answer": f"Line\tbreak\n{j}"}
+                        for j in range(5)
+                    ],
+                },
+            )
+
+    def setUp(self):
+        token = self.client.post(
+            "/api/token/", {"username": "student", "password": "secret"}
+        ).json()["access"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def export(self, url):
+        response = await self.async_client.get(url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        chunks = [chunk async for chunk in response.streaming_content]
+        return response, b"".join(chunks).decode()
+
+    @override_settings(EXPORT_CHUNK_SIZE=3)
+    async def test_formats_stream_every_card(self):
+        response, content = await self.export("/api/export/csv/")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[0]["answer"], "Line\tbreak\n0")
+        self.assertEqual(rows[-1]["session_description"], "Session 1")
+
+        response, content = await self.export("/api/export/jsonl/")
+        lines = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(
+            Counter(line["type"] for line in lines), {"session": 2, "card": 10}
+        )
+
+        response, content = await self.export("/api/export/anki/")
+        header, body = content.split("#tags column:4\n")
+        rows = list(csv.reader(io.StringIO(body), delimiter="\t"))
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(
+            rows[0], ["Question 0.0", "Line\tbreak\n0", "Session 0", "pending"]
+        )
+
+        session = await Session.objects.filter(author=self.user).afirst()
+        response, content = await self.export(f"/api/export/csv/?session={session.id}")
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual({row["session_id"] for row in rows}, {str(session.id)})
+        self.assertEqual(len(rows), 5)
+
+    async def test_anonymous_users_are_refused(self):
+        response = await self.async_client.get("/api/export/csv/")
+        self.assertEqual(response.status_code, 401)
+
+
+class FakeBackendTests(TestCase):
+    """
+    The whole generation pipeline, offline
+    """
+
+    def setUp(self):
+        store = tempfile.TemporaryDirectory()
+        self.addCleanup(store.cleanup)
+        overrides = override_settings(
+            GENERATION_BACKEND="api.backends.FakeBackend",
+            FAKE_BACKEND_LATENCY=0,
+            FAKE_BACKEND_TOKENS_PER_SECOND=0,
+            EMBEDDING_STORE_DIR=store.name,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # Drop the backend built by another test
+        backends._backend_key = None
+        self.addCleanup(setattr, backends, "_backend_key", None)
+
+    def test_sessions_are_generated_offline(self):
+        url = "https://example.com/biology.pdf"
+        for mode in ("single", "two_stage"):
+            with self.subTest(mode=mode), override_settings(GENERATION_MODE=mode):
+                output = cardify_pdf(url, "Cell biology", use_cache=False)
+                self.assertEqual(len(output["cards"]), 10)
+                self.assertEqual(
+                    output, cardify_pdf(url, "Cell biology", use_cache=False)
+                )
+
+    def test_generations_are_reused(self):
+        url = "https://example.com/genetics.pdf"
+        first = cardify_pdf(url, "Chapter 3: key terms")
+        with self.assertLogs("api.metrics") as logs:
+            self.assertEqual(cardify_pdf(url, "  chapter 3 KEY terms!"), first)
+            cardify_pdf(url, "Chapter 3: key terms", use_cache=False)
+        cached, bypassed = [
+            {child["stage"]: child for child in json.loads(record.args[0])["spans"]}
+            for record in logs.records
+        ]
+        self.assertTrue(cached["result_cache"]["hit"])
+        self.assertNotIn("index", cached)
+        self.assertIn("index", bypassed)
+
+        # A url checked recently gets its session without waiting for the worker
+        content_hash, _ = backends.get_backend().download(url)
+        DocumentSource.objects.create(url=url, content_hash=content_hash)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user("student"))
+        body = {"url": url, "requirement": "chapter 3 key terms"}
+        response = client.post("/api/sessions/", body)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["cards"], first["cards"])
+        response = client.post("/api/sessions/", {**body, "bypass_cache": True})
+        self.assertEqual(response.status_code, 202)
+
+    def test_streamed_cards_match_the_session(self):
+        events = []
+        output = cardify_pdf(
+            "https://example.com/chemistry.pdf",
+            "Redox",
+            emit=lambda event, data: events.append((event, data)),
+        )
+        streamed = [data for event, data in events if event == "card"]
+        self.assertEqual(streamed, output["cards"])
+
+    @override_settings(SESSION_BATCH_WORKERS=1)
+    def test_batch_shares_one_index(self):
+        user = User.objects.create_user("student", password="secret")
+        client = APIClient()
+        client.force_authenticate(user)
+        urls = [f"https://example.com/course-{i}.pdf" for i in range(3)]
+        response = client.post(
+            "/api/sessions/batch/",
+            {"urls": urls, "requirements": ["Enzymes", "Cells"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(response.data["sessions"]), 2)
+
+        with self.assertLogs("api.metrics") as logs:
+            self.assertEqual(run_pending_jobs(), 1)
+        run = json.loads(logs.records[-1].args[0])
+        stages = Counter(child["stage"] for child in run["spans"])
+        self.assertEqual(stages["fetch"], 3)
+        self.assertEqual(stages["index"], 1)
+        self.assertEqual(stages["structured_query"], 2)
+        # Both requirements get cards from the same chunks, the repeats are skipped
+        sessions = Session.objects.filter(author=user).order_by("id")
+        self.assertEqual(sessions[0].card_set.count(), 10)
+        fingerprints = Card.objects.filter(author=user).values_list(
+            "fingerprint", flat=True
+        )
+        self.assertEqual(len(fingerprints), len(set(fingerprints)))
+
+    def test_pages_and_section_narrow_the_document(self):
+        url = "https://example.com/textbook.pdf"
+        with self.assertLogs("api.metrics") as logs:
+            cardify_pdf(url, "Enzymes", pages="2-13")
+            cardify_pdf(url, "Enzymes", pages="3-5", section="Chapter 3")
+        whole, narrowed = [
+            {child["stage"]: child for child in json.loads(record.args[0])["spans"]}
+            for record in logs.records
+            if record.args and json.loads(record.args[0])["stage"] == "cardify"
+        ]
+        # A different selection of pages is parsed again
+        self.assertFalse(narrowed["fetch"]["cached"])
+        self.assertEqual(whole["select"]["dropped_nodes"], 0)
+        self.assertEqual(
+            narrowed["embed"]["nodes"],
+            narrowed["select"]["nodes"] - narrowed["select"]["dropped_nodes"],
+        )
+        self.assertLess(narrowed["embed"]["nodes"], narrowed["select"]["nodes"])
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user("student"))
+        response = client.post(
+            "/api/sessions/", {"url": url, "requirement": "x", "pages": "9-1"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("pages", response.data)
+
+    def test_stages_are_measured(self):
+        with self.assertLogs("api.metrics") as logs:
+            cardify_pdf("https://example.com/physics.pdf", "Electrons")
+        run = json.loads(logs.records[-1].args[0])
+        self.assertEqual(run["stage"], "cardify")
+        stages = {child["stage"]: child for child in run["spans"]}
+        self.assertGreater(stages["fetch"]["bytes"], 0)
+        self.assertGreater(stages["parse"]["nodes"], 0)
+        self.assertGreater(stages["embed"]["embedding_tokens"], 0)
+        self.assertGreater(stages["structured_query"]["completion_tokens"], 0)
+
+        user = User.objects.create_user("student", password="secret")
+        client = APIClient()
+        client.force_authenticate(user)
+        client.get("/api/cards/")
+        metrics = client.get("/metrics").content.decode()
+        self.assertIn('cardify_stage_seconds_count{stage="embed"}', metrics)
+        self.assertIn(
+            'cardify_stage_tokens_count{kind="prompt",stage="structured_query"', metrics
+        )
+        self.assertIn('route="api/cards/",status="200"', metrics)
+        self.assertIn('cardify_generations_total{mode="single"}', metrics)
+
+    def test_large_sessions_are_generated_in_parts(self):
+        url = "https://example.com/history.pdf"
+        events = []
+        with self.assertLogs("api.metrics") as logs:
+            output = cardify_pdf(
+                url,
+                "Empires",
+                emit=lambda event, data: events.append((event, data)),
+                num_cards=25,
+            )
+        run = json.loads(logs.records[-1].args[0])
+        merge = {child["stage"]: child for child in run["spans"]}["merge"]
+        parts = [child for child in merge["spans"] if child["stage"] == "part"]
+        self.assertEqual([part["cards"] for part in parts], [9, 8, 8])
+        for part in parts:
+            self.assertIn(
+                "structured_query", [child["stage"] for child in part["spans"]]
+            )
+
+        questions = [card["question"] for card in output["cards"]]
+        self.assertLessEqual(len(questions), 25)
+        self.assertEqual(len(questions), len(set(questions)))
+        self.assertIn("duplicate_cards", merge)
+        streamed = [data for event, data in events if event == "card"]
+        self.assertEqual(streamed, output["cards"])
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user("student"))
+        body = {"url": url, "requirement": "Empires", "num_cards": 1000}
+        response = client.post("/api/sessions/", body)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("num_cards", response.data)
+
+    def test_context_fits_the_token_budget(self):
+        url = "https://example.com/astronomy.pdf"
+        with self.assertLogs("api.metrics") as logs:
+            cardify_pdf(url, "Planets", use_cache=False)
+            with override_settings(RETRIEVAL_TOKEN_BUDGET=1000):
+                cardify_pdf(url, "Planets", use_cache=False)
+        full, budgeted = [
+            {child["stage"]: child for child in json.loads(record.args[0])["spans"]}
+            for record in logs.records
+        ]
+        retrieve = budgeted["retrieve"]
+        self.assertLessEqual(retrieve["context_tokens"], 1000)
+        self.assertLess(retrieve["nodes"], retrieve["candidates"])
+        self.assertEqual(
+            retrieve["saved_prompt_tokens"],
+            retrieve["baseline_context_tokens"] - retrieve["context_tokens"],
+        )
+        self.assertLess(
+            budgeted["structured_query"]["prompt_tokens"],
+            full["structured_query"]["prompt_tokens"],
+        )
+
+    def test_latency_and_throughput(self):
+        backend = backends.FakeBackend(latency=0.05, tokens_per_second=2000)
+        start = time.perf_counter()
+        text = backend.llm.complete("What is photosynthesis in chlorophyll?").text
+        elapsed = time.perf_counter() - start
+        self.assertGreaterEqual(elapsed, 0.05 + len(text) / 4 / 2000)
+
+
+class BenchmarkTests(TestCase):
+    @override_settings(
+        GENERATION_BACKEND="api.backends.FakeBackend",
+        FAKE_BACKEND_LATENCY=0,
+        FAKE_BACKEND_TOKENS_PER_SECOND=0,
+    )
+    def test_every_route_answers(self):
+        backends._backend_key = None
+        self.addCleanup(setattr, backends, "_backend_key", None)
+        with tempfile.TemporaryDirectory() as store, self.settings(
+            EMBEDDING_STORE_DIR=store, SESSION_BATCH_WORKERS=1
+        ):
+            # The streamed generation runs in another thread that cannot see the
+            # rows of this test's transaction
+            report = Benchmark(
+                users=2, sessions=3, cards=2, requests=3, generation_requests=0
+            ).run()
+        routes = report["routes"]
+        self.assertEqual(routes["generation jobs"]["jobs"], 6)
+        # Named "<method> <path>[?query][ (variant)]" after the patterns of api/urls.py
+        timed = {name.split()[1].split("?")[0] for name in routes if "/" in name}
+        patterns = {
+            "/api/" + re.sub(r"<\w+:(\w+)>", r"<\1>", str(pattern.pattern))
+            for pattern in urls.urlpatterns
+            if "drf_format_suffix" not in str(pattern.pattern)
+        }
+        patterns.remove("/api/docs/")
+        self.assertEqual(timed, patterns)
+        for name, result in routes.items():
+            if "errors" in result:
+                self.assertEqual(result["errors"], 0, name)
+        self.assertEqual(routes["DELETE /api/sessions/<pk>/"]["requests"], 9)
+        self.assertFalse(User.objects.filter(username__startswith="bench-").exists())
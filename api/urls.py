@@ -6,6 +6,10 @@ from rest_framework.urlpatterns import format_suffix_patterns
 urlpatterns = [
     # Get all sessions - ListCreate
     path("sessions/", views.SessionCreate.as_view()),
+    # Create one session per requirement from many documents - Create
+    path("sessions/batch/", views.SessionBatch.as_view()),
+    # Create a session streaming its progress and cards - Server-Sent Events
+    path("sessions/stream/", views.SessionStream.as_view()),
     # Get a particular session - RetrieveDestroy
     path("sessions/<int:pk>/", views.SessionDetail.as_view()),
     # Get only cards of a particular session - List
@@ -14,8 +18,20 @@ urlpatterns = [
     path("sessions/<int:session>/cards/<int:pk>/", views.CardOfSession.as_view()),
     # Get all cards for the user - List
     path("cards/", views.AllCards.as_view()),
+    # Change the state or text of many cards at once - Update
+    path("cards/bulk/", views.CardBulkUpdate.as_view()),
+    # Search the cards of the user by words or meaning - List
+    path("cards/search/", views.CardSearch.as_view()),
     # Get a particular card - Retrieve
     path("cards/<int:pk>/", views.CardDetail.as_view()),
+    # Download the sessions and cards of the user as csv, jsonl or anki - Stream
+    path("export/<str:kind>/", views.CardExport.as_view()),
+    # Get the status of a session generation job - Retrieve
+    path("jobs/<int:pk>/", views.JobDetail.as_view()),
+    # Get the cards due for review - List
+    path("review/next/", views.ReviewNext.as_view()),
+    # Grade a batch of reviewed cards - Create
+    path("review/", views.ReviewSubmit.as_view()),
     # Documentation
     path("docs/", include_docs_urls(title="Sessions and Cards API")),
 ]
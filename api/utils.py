@@ -1,106 +1,46 @@
 from django.conf import settings
+from django.db import connection
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import nest_asyncio
+import logging
+import math
+from .backends import StudySession, get_backend
+from .documents import get_parsed, parsed_key, store_parsed
+from .generations import document_key, lookup, normalize, store
+from .metrics import annotate, attached, span
+from .selection import parse_pages, prefilter, select_nodes, split_sections
+from .streaming import CardStreamParser
 
-# API KEYS
-LLAMA_CLOUD_API_KEY = settings.LLAMA_CLOUD_API_KEY
-OPENAI_API_KEY = settings.OPENAI_API_KEY
+logger = logging.getLogger(__name__)
 
-# SETUP
-from llama_parse import LlamaParse
-from llama_index.core import VectorStoreIndex, Settings
-from llama_index.core.node_parser import MarkdownElementNodeParser
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
-
-# TWO remote reader options
-# from llama_index.readers.remote import RemoteReader
-from llama_index.readers.remote_depth import RemoteDepthReader
-
-nest_asyncio.apply()
-llm = OpenAI(model="gpt-3.5-turbo", temperature=0)
-node_parser = MarkdownElementNodeParser(
-    llm=OpenAI(model="gpt-3.5-turbo"), num_workers=8
-)
-Settings.llm = llm
-Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
-remote_loader = RemoteDepthReader(depth=0)
-
-# Check parser
-parser = LlamaParse(result_type="markdown")
-
-# PYDANTIC
-from pydantic import BaseModel, Field
-from typing import List
-from typing_extensions import TypedDict
-from llama_index.program.openai import OpenAIPydanticProgram
-from llama_index.core import ChatPromptTemplate
-from llama_index.core.llms import ChatMessage
-
-
-class StudySession(BaseModel):
-    """Data model for a study session."""
-
-    description: str = Field(
-        description="High-level summary of the given requirement for the session"
-    )
-    cards: List[TypedDict("cards", {"question": str, "answer": str})] = Field(
-        description="The questions and answers list of JSON objects from the study session"
-    )
+# How each session was generated in this process: "single", "fallback", "two_stage"
+generation_stats = Counter()
 
+# Metadata of where a chunk comes from (see api/parsing.py), left out of its embedding
+SOURCE_METADATA = ("Source", "page_label", "file_name", "file_path")
 
-session_prompt = ChatPromptTemplate(
-    message_templates=[
-        ChatMessage(
-            role="system",
-            content=(
-                "You are an expert assitant for formatting the structure of a study session with a description and a list of JSON objects called cards"
-            ),
-        ),
-        ChatMessage(
-            role="user",
-            content=(
-                "Here is the input I want you to format: \n"
-                "------\n"
-                "{input}\n"
-                "------"
-            ),
-        ),
-    ]
-)
-
-
-program = OpenAIPydanticProgram.from_defaults(
-    output_cls=StudySession,
-    llm=llm,
-    prompt=session_prompt,
-    verbose=True,
-)
+# API KEYS
+LLAMA_CLOUD_API_KEY = settings.LLAMA_CLOUD_API_KEY
+OPENAI_API_KEY = settings.OPENAI_API_KEY
 
 
 # PROMPT ROLES AND MODEL
-def get_cards_from_need(requirement):
-    assistant_role = """You are a helpful teaching assistant from which students seek help to create studying material.
+def get_cards_from_need(requirement, num_cards=10):
+    card = """{"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},"""
+    cards = "\n        ".join([card] * num_cards)
+    assistant_role = f"""You are a helpful teaching assistant from which students seek help to create studying material.
     You will be provided with a document and you need to create a JSON object which looks like such based on the requirement provided:
 
-    {
+    {{
         "description": A one or two word description about the document just to identify it,
         "cards": [
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
-        {"question": A question about specific keywords mentioned in the document, "answer": The answer to that question},
+        {cards}
         ]
-    }
+    }}
 
-    You must create 10 of those question:answer JSON objects but make sure to return them in a list format inside the global JSON object.
-    It is imperative you make only 10 of those question:answer JSON card objects. Remember, take your time to analyze the document 
+    You must create {num_cards} of those question:answer JSON objects but make sure to return them in a list format inside the global JSON object.
+    It is imperative you make only {num_cards} of those question:answer JSON card objects. Remember, take your time to analyze the document 
     before creating the questions which help students memorize the most. You need to target keywords that appear in the document. 
     This means that students seek to memorize the terms appearing in the document so make sure to focus your questions and answers 
     around specific terms, processes, keywords, initials, and so on.
@@ -126,16 +66,363 @@ def get_cards_from_need(requirement):
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
-def cardify_pdf(remote_url, requirement):
+def no_emit(event, data):
+    pass
+
+
+def load_nodes(remote_url, emit=no_emit, fetched=None, pages=None):
+    """
+    Returns the base nodes and objects of a remote document, of the given pages (0-based)
+    only when there are some. The parsed output is cached by content hash so a document
+    that was seen before is neither downloaded nor parsed. `fetched` is what
+    backend.fetch returned when the url was already fetched.
+    """
+    backend = get_backend()
+    with span("fetch") as record:
+        content_hash, download = fetched or backend.fetch(remote_url)
+        cached = get_parsed(parsed_key(content_hash, pages))
+        if cached is None and download is None:
+            # The url did not change but its parsed entry was evicted
+            content_hash, download = backend.fetch(remote_url, force=True)
+            cached = get_parsed(parsed_key(content_hash, pages))
+        record["bytes"] = download.size if download is not None else 0
+        record["cached"] = cached is not None
+    emit("stage", {"stage": "fetched", "cached": cached is not None})
+    if cached is not None:
+        if download is not None:
+            download.close()
+        documents, base_nodes, objects = cached
+        emit("stage", {"stage": "parsed", "cached": True})
+        return base_nodes, objects
+
+    try:
+        with span("parse") as record:
+            documents, base_nodes, objects = backend.parse(remote_url, download, pages)
+            record["nodes"] = len(base_nodes) + len(objects)
+    finally:
+        download.close()
+    with span("cache_store"):
+        store_parsed(parsed_key(content_hash, pages), documents, base_nodes, objects)
+    emit("stage", {"stage": "parsed", "cached": False})
+    return base_nodes, objects
+
+
+def load_all_nodes(remote_urls):
+    """
+    Returns the nodes of several documents. They are downloaded concurrently, then
+    parsed in parallel threads (SESSION_BATCH_WORKERS). A document that cannot be
+    fetched or parsed is left out, unless none of them can.
     """
-    Retrieves a remote url and feeds it to LlamaParse and generates the JSON object we need for each pdf
+    fetched = get_backend().fetch_many(remote_urls)
+
+    def load(remote_url):
+        try:
+            result = fetched[remote_url]
+            if isinstance(result, Exception):
+                raise result
+            base_nodes, objects = load_nodes(remote_url, fetched=result)
+            return base_nodes + objects
+        except Exception as e:
+            logger.warning("Leaving %s out of the batch", remote_url, exc_info=True)
+            return e
+
+    def load_in_thread(remote_url):
+        try:
+            return load(remote_url)
+        finally:
+            # Each thread opened its own database connection
+            connection.close()
+
+    workers = min(settings.SESSION_BATCH_WORKERS, len(remote_urls))
+    if workers <= 1:
+        loaded = list(map(load, remote_urls))
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            loaded = list(pool.map(load_in_thread, remote_urls))
+
+    failures = [result for result in loaded if isinstance(result, Exception)]
+    if len(failures) == len(loaded):
+        raise failures[0]
+    annotate(failed_documents=len(failures))
+    return [
+        node
+        for result in loaded
+        if not isinstance(result, Exception)
+        for node in result
+    ]
+
+
+def embed_nodes(nodes):
     """
-    documents = remote_loader.load_data(url=remote_url)
-    nodes = node_parser.get_nodes_from_documents(documents)
-    base_nodes, objects = node_parser.get_nodes_and_objects(nodes)
-    index = VectorStoreIndex(nodes=base_nodes + objects)
-    recursive_query_engine = index.as_query_engine(similarity_top_k=15, verbose=False)
-    response = recursive_query_engine.query(get_cards_from_need(requirement))
-    raw_pydantic = program(input=response)
+    Sets the embedding of every node, reusing the stored embedding of any chunk
+    that was embedded before so only new content reaches the embedding model.
+    Where a chunk comes from is left out of its embedding, the same chunk in another
+    document or page is the same text.
+    """
+    from llama_index.core.schema import MetadataMode
+
+    for node in nodes:
+        node.excluded_embed_metadata_keys = sorted(
+            set(node.excluded_embed_metadata_keys).union(SOURCE_METADATA)
+        )
+    backend = get_backend()
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    with span("embed", nodes=len(nodes)):
+        embeddings = backend.embedding_store.embed(texts, backend.embed)
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = list(map(float, embedding))
+    return nodes
+
+
+def stream_study_session(retriever, requirement, emit, num_cards=10):
+    """
+    Streams the query response and emits every card as soon as its JSON object is
+    complete. When the streamed JSON is valid it is used as is, which also saves the
+    formatting call of the program.
+    """
+    from llama_index.core.query_engine import RetrieverQueryEngine
+
+    query_engine = RetrieverQueryEngine.from_args(retriever, streaming=True)
+    with span("query", streaming=True) as record:
+        response = query_engine.query(get_cards_from_need(requirement, num_cards))
+        card_parser = CardStreamParser()
+        for token in response.response_gen:
+            for card in card_parser.feed(token):
+                emit("card", card)
+        record["nodes"] = len(response.source_nodes)
+
+    text = card_parser.text
+    try:
+        session = StudySession.model_validate_json(
+            text[text.index("{") : text.rindex("}") + 1]
+        )
+    except ValueError:
+        with span("structured"):
+            session = get_backend().structured(text)
+    return session.model_dump()
+
+
+def unique_cards(cards, seen):
+    """
+    The cards whose question is less than GENERATION_DUPLICATE_SIMILARITY similar to
+    the others and to `seen`, the normalized embeddings of the questions kept so far,
+    which the kept ones are added to
+    """
+    import numpy as np
+
+    backend = get_backend()
+    vectors = backend.embedding_store.embed(
+        [normalize(card["question"]) for card in cards], backend.embed
+    )
+    kept = []
+    for card, vector in zip(cards, vectors):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) + 1e-12)
+        if any(
+            vector @ other >= settings.GENERATION_DUPLICATE_SIMILARITY for other in seen
+        ):
+            continue
+        seen.append(vector)
+        kept.append(card)
+    annotate(duplicate_cards=len(cards) - len(kept))
+    return kept
+
+
+def generate_in_parts(nodes, requirement, num_cards, emit=no_emit):
+    """
+    Generates a large session from parts of the document, runs of whole sections
+    asked for GENERATION_CARDS_PER_CALL cards each, queried at the same time
+    (GENERATION_PARALLEL_CALLS) through an index of their own. The cards are merged
+    in document order, without the questions asked twice, and emitted part by part.
+    """
+    from llama_index.core import VectorStoreIndex
+    from .retrieval import AdaptiveRetriever
+
+    parts = split_sections(
+        nodes, math.ceil(num_cards / settings.GENERATION_CARDS_PER_CALL)
+    )
+    quotas = [
+        num_cards // len(parts) + (i < num_cards % len(parts))
+        for i in range(len(parts))
+    ]
+
+    def generate(parent, part, quota):
+        with attached(parent), span("part", nodes=len(part), cards=quota):
+            # The nodes are embedded already, building the index costs no call
+            retriever = AdaptiveRetriever(VectorStoreIndex(nodes=part), part)
+            return query_study_session(retriever, requirement, quota)
+
+    with span("merge") as record:
+        with ThreadPoolExecutor(settings.GENERATION_PARALLEL_CALLS) as pool:
+            futures = [
+                pool.submit(generate, record, part, quota)
+                for part, quota in zip(parts, quotas)
+            ]
+            description = None
+            cards = []
+            seen = []
+            for future in futures:
+                output = future.result()
+                description = description or output["description"]
+                new = unique_cards(output["cards"], seen)[: num_cards - len(cards)]
+                for card in new:
+                    emit("card", card)
+                cards += new
+    return {"description": description, "cards": cards}
+
+
+def cardify_pdf(
+    remote_url,
+    requirement,
+    emit=None,
+    pages=None,
+    section=None,
+    use_cache=True,
+    num_cards=None,
+):
+    """
+    Retrieves a remote url and feeds it to LlamaParse and generates the JSON object we need for each pdf.
+    When given, emit(event, data) receives the progress of each stage and the cards while
+    they are being written by the LLM. `pages` ("1-20,35") limits the document to those
+    pages and `section` to the part under the headings mentioning it. More than
+    GENERATION_CARDS_PER_CALL cards (num_cards, SESSION_DEFAULT_CARDS by default) are
+    generated in parts, see generate_in_parts. The output of an identical (or similar
+    enough) requirement on the same document is reused unless use_cache is False, see
+    api/generations.py.
+    """
+    from llama_index.core import VectorStoreIndex
+    from .retrieval import AdaptiveRetriever
+
+    emit = emit or no_emit
+    num_cards = num_cards or settings.SESSION_DEFAULT_CARDS
+    # Also installs the llama_index Settings (llm, embed_model) used by the index
+    backend = get_backend()
+    with span("cardify", url=remote_url, streaming=emit is not no_emit):
+        with span("download"):
+            fetched = backend.fetch(remote_url)
+        key = document_key(fetched[0], pages, section, num_cards)
+        embedding = None
+        if settings.GENERATION_CACHE_SIMILARITY:
+            embedding = backend.embedding_store.embed(
+                [normalize(requirement)], backend.embed
+            )[0]
+        with span("result_cache") as record:
+            output = lookup(key, requirement, embedding) if use_cache else None
+            record["hit"] = output is not None
+        if output is not None:
+            if fetched[1] is not None:
+                fetched[1].close()
+            emit("stage", {"stage": "cached"})
+            for card in output["cards"]:
+                emit("card", card)
+            return output
+
+        base_nodes, objects = load_nodes(
+            remote_url,
+            emit,
+            fetched=fetched,
+            pages=parse_pages(pages) if pages else None,
+        )
+        with span("select", nodes=len(base_nodes) + len(objects)):
+            nodes = select_nodes(
+                base_nodes,
+                objects,
+                requirement,
+                section,
+                settings.DOCUMENT_PREFILTER_MAX_NODES,
+            )
+        nodes = embed_nodes(nodes)
+        # Nodes that already have an embedding are not embedded again by the index
+        with span("index", nodes=len(nodes)):
+            index = VectorStoreIndex(nodes=nodes)
+        retriever = AdaptiveRetriever(index, nodes)
+        if emit is not no_emit:
+            emit("stage", {"stage": "indexed", "nodes": len(nodes)})
+            emit("stage", {"stage": "querying"})
+        if num_cards > settings.GENERATION_CARDS_PER_CALL:
+            output = generate_in_parts(nodes, requirement, num_cards, emit)
+        elif emit is not no_emit:
+            output = stream_study_session(retriever, requirement, emit, num_cards)
+        else:
+            output = query_study_session(retriever, requirement, num_cards)
+        with span("result_store"):
+            store(key, requirement, output, embedding)
+        return output
+
+
+def cardify_pdfs(remote_urls, requirements):
+    """
+    Generates one JSON object per requirement from several documents at once. They are
+    fetched and parsed in parallel, embedded together and put in a single index, so
+    every requirement costs one query whatever the number of documents.
+    """
+    from llama_index.core import VectorStoreIndex
+    from .retrieval import AdaptiveRetriever
+
+    get_backend()
+    with span(
+        "cardify_batch", documents=len(remote_urls), requirements=len(requirements)
+    ):
+        nodes = load_all_nodes(remote_urls)
+        with span("select", nodes=len(nodes)):
+            # The shared index keeps room for every requirement
+            nodes = prefilter(
+                nodes,
+                " ".join(requirements),
+                settings.DOCUMENT_PREFILTER_MAX_NODES * len(requirements),
+            )
+        nodes = embed_nodes(nodes)
+        with span("index", nodes=len(nodes)):
+            index = VectorStoreIndex(nodes=nodes)
+        retriever = AdaptiveRetriever(index, nodes)
+        return [
+            query_study_session(retriever, requirement) for requirement in requirements
+        ]
+
+
+def query_study_session(retriever, requirement, num_cards=10):
+    """
+    In the "single" generation mode the query engine answers with the StudySession
+    directly through function calling. The two stage path (free text query, then the
+    formatting program) is kept as the fallback when that answer does not validate.
+    The context of both comes from the retriever, see api/retrieval.py.
+    """
+    from llama_index.core import get_response_synthesizer
+    from llama_index.core.query_engine import RetrieverQueryEngine
+    from llama_index.core.schema import MetadataMode
+
+    if settings.GENERATION_MODE == "single":
+        # The synthesizer is called directly because the query engine wraps the answer
+        # in a pydantic v1 PydanticResponse that drops our pydantic v2 model
+        query = get_cards_from_need(requirement, num_cards)
+        synthesizer = get_response_synthesizer(output_cls=StudySession)
+        try:
+            chunks = [
+                node.get_content(metadata_mode=MetadataMode.LLM)
+                for node in retriever.retrieve(query)
+            ]
+            with span("structured_query"):
+                session = synthesizer.get_response(query, chunks)
+            if not isinstance(session, StudySession) or not session.cards:
+                raise ValueError(f"Unexpected structured answer: {session!r}")
+            generation_stats["single"] += 1
+            return session.model_dump()
+        except ValueError:
+            # Validation errors from the function call arguments end up here too
+            generation_stats["fallback"] += 1
+            logger.warning(
+                "Structured generation failed, using two stages", exc_info=True
+            )
+    else:
+        generation_stats["two_stage"] += 1
+
+    recursive_query_engine = RetrieverQueryEngine.from_args(retriever)
+    with span("query") as record:
+        response = recursive_query_engine.query(
+            get_cards_from_need(requirement, num_cards)
+        )
+        record["nodes"] = len(response.source_nodes)
+    with span("structured"):
+        raw_pydantic = get_backend().structured(str(response))
     output = raw_pydantic.model_dump()
     return output
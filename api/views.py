@@ -1,11 +1,44 @@
+import asyncio
+import json
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.contrib.auth.models import User
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from .serializers import UserSerializer
-from rest_framework import generics
+from rest_framework import generics, status
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from .models import Session, Card
-from .serializers import SessionSerializer, CardSerializer
-from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from .models import Session, Card, GenerationJob
+from .serializers import (
+    SessionSerializer,
+    SessionBatchSerializer,
+    CardSerializer,
+    CardSearchSerializer,
+    CardChangeSerializer,
+    GenerationJobSerializer,
+    ReviewSerializer,
+    requested_fields,
+)
+from .pagination import KeysetPagination
+from rest_framework.exceptions import AuthenticationFailed, NotFound, ValidationError
+from .bulk import update_cards
+from .caching import CachedReadMixin
+from .export import Export
+from .jobs import create_session
+from .metrics import render_metrics
+from .review import due_cards, submit_reviews
+from .search import full_text, semantic
+from .streaming import sse_event
+from .utils import cardify_pdf
+
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 
@@ -18,13 +51,34 @@ class CreateUserView(generics.CreateAPIView):
 
 
 # SESSION EXCLUSIVE VIEWS
+def with_cards(queryset, request):
+    fields = requested_fields(request)
+    if fields is not None and "cards" not in fields:
+        # The heavy JSON column is not even loaded
+        return queryset.defer("cards")
+    # Without the JSON copy the serializer reads the cards from their rows
+    if settings.SESSION_STORE_CARDS_JSON:
+        return queryset
+    return queryset.prefetch_related("card_set")
+
+
 class SessionCreate(generics.ListCreateAPIView):
     serializer_class = SessionSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         user = self.request.user
-        return Session.objects.filter(author=user)
+        sessions = Session.objects.filter(author=user).select_related("job")
+        return with_cards(sessions, self.request)
+
+    def create(self, request, *args, **kwargs):
+        # The session is returned right away and filled in by the worker, unless its
+        # cards came straight from the generation cache
+        response = super().create(request, *args, **kwargs)
+        if response.data.get("job") is not None:
+            response.status_code = status.HTTP_202_ACCEPTED
+        return response
 
     def perform_create(self, serializer):
         if serializer.is_valid():
@@ -33,20 +87,142 @@ class SessionCreate(generics.ListCreateAPIView):
             print(serializer.errors)
 
 
-class SessionDetail(generics.RetrieveDestroyAPIView):
+class SessionBatch(generics.GenericAPIView):
+    """
+    Queues one job generating a session per requirement from all the urls at once
+    """
+
+    serializer_class = SessionBatchSerializer
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job, sessions = serializer.save(author=request.user)
+        return Response(
+            {
+                "job": job.pk,
+                "sessions": SessionSerializer(sessions, many=True).data,
+            },
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+async def authenticate(request):
+    """
+    The user of the JWT of a plain async view, or the 401 response to send
+    """
+    try:
+        auth = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except AuthenticationFailed as e:
+        return None, JsonResponse({"detail": str(e.detail)}, status=401)
+    if auth is None:
+        return None, JsonResponse(
+            {"detail": "Authentication credentials were not provided."},
+            status=401,
+        )
+    return auth[0], None
+
+
+# Needs the ASGI server (makeflashcards/asgi.py), under WSGI the events are buffered
+@method_decorator(csrf_exempt, name="dispatch")
+class SessionStream(View):
+    """
+    Creates a session while streaming the progress of each stage and every card
+    as soon as the LLM writes it, as Server-Sent Events
+    """
+
+    async def post(self, request, *args, **kwargs):
+        user, error = await authenticate(request)
+        if error is not None:
+            return error
+
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({"detail": "Invalid JSON"}, status=400)
+        serializer = SessionSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+
+        events = self.events(user, **serializer.validated_data)
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    async def events(
+        self,
+        user,
+        url,
+        requirement,
+        pages=None,
+        section=None,
+        num_cards=None,
+        bypass_cache=False,
+    ):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def emit(event, data):
+            loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+        def generate():
+            # Runs in its own thread, the session is saved even if the client left
+            try:
+                output = cardify_pdf(
+                    remote_url=url,
+                    requirement=requirement,
+                    emit=emit,
+                    pages=pages,
+                    section=section,
+                    num_cards=num_cards,
+                    use_cache=not bypass_cache,
+                )
+                session = create_session(user, url, output, embed=True)
+                emit("session", SessionSerializer(session).data)
+            except Exception as e:
+                logger.exception("Streaming generation failed for %s", url)
+                emit("error", {"detail": str(e)})
+            finally:
+                connections.close_all()
+                emit(None, None)
+
+        task = asyncio.ensure_future(sync_to_async(generate, thread_sensitive=False)())
+        while True:
+            event, data = await queue.get()
+            if event is None:
+                break
+            yield sse_event(event, data)
+        await task
+
+
+class SessionDetail(CachedReadMixin, generics.RetrieveDestroyAPIView):
     serializer_class = SessionSerializer
     permission_classes = [IsAuthenticated]
-    queryset = Session.objects.all()
+
+    def get_queryset(self):
+        return with_cards(Session.objects.select_related("job"), self.request)
+
+    def cache_scopes(self):
+        return [("session", self.kwargs["pk"])]
 
 
 # CARDS EXCLUSIVE VIEWS - regardless of the session
-class AllCards(generics.ListAPIView):
+def by_state(queryset, request):
+    # ?state=pending|useless|done|duplicate, served by the (author|session, state) indexes
+    state = request.query_params.get("state")
+    return queryset.filter(state=state) if state else queryset
+
+
+class AllCards(CachedReadMixin, generics.ListAPIView):
     serializer_class = CardSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         user = self.request.user
-        return Card.objects.filter(author=user)
+        return by_state(Card.objects.filter(author=user), self.request)
 
 
 class CardDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -55,14 +231,68 @@ class CardDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = Card.objects.all()
 
 
+class CardBulkUpdate(generics.GenericAPIView):
+    """
+    Changes the state, question or answer of many cards in one UPDATE, with a result
+    per change: "updated" and the card, or "not_found"
+    """
+
+    serializer_class = CardChangeSerializer
+    permission_classes = [IsAuthenticated]
+
+    def patch(self, request, *args, **kwargs):
+        serializer = self.get_serializer(
+            data=request.data, many=True, max_length=settings.CARD_BULK_MAX_ITEMS
+        )
+        serializer.is_valid(raise_exception=True)
+        results = []
+        for pk, card in update_cards(request.user, serializer.validated_data):
+            if card is None:
+                results.append({"id": pk, "status": "not_found"})
+            else:
+                card = CardSerializer(card).data
+                results.append({"id": pk, "status": "updated", "card": card})
+        return Response(results)
+
+
+class CardSearch(generics.ListAPIView):
+    """
+    ?q= words of the questions and answers, or their meaning with ?mode=semantic
+    """
+
+    serializer_class = CardSearchSerializer
+    permission_classes = [IsAuthenticated]
+    default_limit = 20
+    max_limit = 100
+
+    def get_queryset(self):
+        query = self.request.query_params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": "This query parameter is required."})
+        mode = self.request.query_params.get("mode", "text")
+        if mode not in ("text", "semantic"):
+            raise ValidationError({"mode": 'Use "text" or "semantic".'})
+        try:
+            limit = int(self.request.query_params.get("limit", self.default_limit))
+        except ValueError:
+            limit = self.default_limit
+        limit = min(max(limit, 1), self.max_limit)
+        search = semantic if mode == "semantic" else full_text
+        return search(self.request.user, query, limit)
+
+
 # CARDS THROUGH SESSION
-class CardsOfSession(generics.ListAPIView):
+class CardsOfSession(CachedReadMixin, generics.ListAPIView):
     serializer_class = CardSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+
+    def cache_scopes(self):
+        return [("session", self.kwargs["pk"])]
 
     def get_queryset(self):
         session_id = self.kwargs["pk"]
-        return Card.objects.filter(session=session_id)
+        return by_state(Card.objects.filter(session=session_id), self.request)
 
 
 class CardOfSession(generics.RetrieveUpdateDestroyAPIView):
@@ -77,3 +307,76 @@ class CardOfSession(generics.RetrieveUpdateDestroyAPIView):
             return Card.objects.get(session=session_id, id=card_id)
         except Card.DoesNotExist:
             raise NotFound(detail="Card not found")
+
+
+# EXPORT VIEWS - see api/export.py
+class CardExport(View):
+    """
+    Streams the sessions and cards of the user as csv, jsonl or anki, only those of
+    one session with ?session=
+    """
+
+    async def get(self, request, kind, *args, **kwargs):
+        user, error = await authenticate(request)
+        if error is not None:
+            return error
+        if kind not in Export.formats:
+            return JsonResponse({"detail": f"Unknown format {kind}"}, status=404)
+        session = request.GET.get("session")
+        if session is not None and not session.isdigit():
+            return JsonResponse({"session": "Must be a session id."}, status=400)
+
+        export = Export(user, kind, session=session)
+        response = StreamingHttpResponse(export, content_type=export.content_type)
+        response["Content-Disposition"] = f'attachment; filename="{export.filename}"'
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+# JOB VIEWS
+class JobDetail(generics.RetrieveAPIView):
+    serializer_class = GenerationJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        user = self.request.user
+        return GenerationJob.objects.filter(author=user)
+
+
+# REVIEW VIEWS - spaced repetition, see api/review.py
+class ReviewNext(generics.ListAPIView):
+    serializer_class = CardSerializer
+    permission_classes = [IsAuthenticated]
+    default_limit = 20
+    max_limit = 500
+
+    def get_queryset(self):
+        try:
+            limit = int(self.request.query_params.get("limit", self.default_limit))
+        except ValueError:
+            limit = self.default_limit
+        limit = min(max(limit, 1), self.max_limit)
+        return due_cards(self.request.user, limit)
+
+
+class ReviewSubmit(generics.GenericAPIView):
+    serializer_class = ReviewSerializer
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        try:
+            cards = submit_reviews(request.user, serializer.validated_data)
+        except Card.DoesNotExist as e:
+            raise NotFound(detail=str(e))
+        return Response(CardSerializer(cards, many=True).data)
+
+
+# METRICS VIEWS - Prometheus text format, see api/metrics.py
+def metrics(request):
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse(status=401)
+    content, content_type = render_metrics(settings.PROMETHEUS_MULTIPROC_DIR)
+    return HttpResponse(content, content_type=content_type)
@@ -13,6 +13,155 @@ load_dotenv(os.path.join(BASE_DIR, ".env"))
 LLAMA_CLOUD_API_KEY = os.getenv("LLAMA_CLOUD_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# GENERATION JOBS - see api/jobs.py
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", 2))
+GENERATION_JOB_TIMEOUT = int(os.getenv("GENERATION_JOB_TIMEOUT", 300))  # seconds
+GENERATION_JOB_MAX_ATTEMPTS = int(os.getenv("GENERATION_JOB_MAX_ATTEMPTS", 3))
+GENERATION_JOB_RETRY_DELAY = int(os.getenv("GENERATION_JOB_RETRY_DELAY", 30))
+GENERATION_JOB_POLL_INTERVAL = float(os.getenv("GENERATION_JOB_POLL_INTERVAL", 2))
+# "single" asks for the StudySession in the query itself, "two_stage" formats the
+# free text answer with a second call - see api/utils.py
+GENERATION_MODE = os.getenv("GENERATION_MODE", "single")
+# Keep a JSON copy of the cards in Session.cards, the Card rows are always stored.
+# Run manage.py sync_cards_json after changing it.
+SESSION_STORE_CARDS_JSON = os.getenv("SESSION_STORE_CARDS_JSON", "True") == "True"
+# Cards of a session when the request does not say, and the most it can ask for
+SESSION_DEFAULT_CARDS = int(os.getenv("SESSION_DEFAULT_CARDS", 10))
+SESSION_MAX_CARDS = int(os.getenv("SESSION_MAX_CARDS", 100))
+# Larger sessions are split over parts of the document generated at the same time
+GENERATION_CARDS_PER_CALL = int(os.getenv("GENERATION_CARDS_PER_CALL", 10))
+GENERATION_PARALLEL_CALLS = int(os.getenv("GENERATION_PARALLEL_CALLS", 10))
+# Cards of the parts with questions at least that similar (cosine) are merged
+GENERATION_DUPLICATE_SIMILARITY = float(
+    os.getenv("GENERATION_DUPLICATE_SIMILARITY", 0.9)
+)
+
+# GENERATION BACKEND - see api/backends.py
+# "api.backends.FakeBackend" generates offline, for load tests
+GENERATION_BACKEND = os.getenv("GENERATION_BACKEND", "api.backends.OpenAIBackend")
+FAKE_BACKEND_LATENCY = float(os.getenv("FAKE_BACKEND_LATENCY", 0.5))  # per call
+FAKE_BACKEND_TOKENS_PER_SECOND = float(os.getenv("FAKE_BACKEND_TOKENS_PER_SECOND", 80))
+
+# GENERATION CACHE - see api/generations.py
+GENERATION_CACHE_TTL = int(os.getenv("GENERATION_CACHE_TTL", 7 * 24 * 3600))  # seconds
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", 10000))
+# Requirements of a document at least that similar (cosine of their embeddings) share
+# their cards, 0 only reuses identical requirements
+GENERATION_CACHE_SIMILARITY = float(os.getenv("GENERATION_CACHE_SIMILARITY", 0))
+
+# BATCH SESSIONS - see api/jobs.py
+SESSION_BATCH_MAX_URLS = int(os.getenv("SESSION_BATCH_MAX_URLS", 20))
+SESSION_BATCH_MAX_REQUIREMENTS = int(os.getenv("SESSION_BATCH_MAX_REQUIREMENTS", 5))
+# Documents of a batch fetched and parsed at the same time
+SESSION_BATCH_WORKERS = int(os.getenv("SESSION_BATCH_WORKERS", 4))
+
+# METRICS - see api/metrics.py
+# Bearer token required on /metrics when set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Shared by the gunicorn and generation worker processes of a machine so /metrics
+# aggregates all of them, must exist before they start
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# DOCUMENT CACHE - see api/documents.py
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", 256 * 1024**2))
+# Seconds before a cached url is revalidated with ETag/Last-Modified
+DOCUMENT_CACHE_REVALIDATE_AFTER = int(
+    os.getenv("DOCUMENT_CACHE_REVALIDATE_AFTER", 3600)
+)
+DOCUMENT_FETCH_TIMEOUT = int(os.getenv("DOCUMENT_FETCH_TIMEOUT", 30))  # seconds
+# Larger documents are refused, downloads are streamed to a temporary file
+DOCUMENT_MAX_BYTES = int(os.getenv("DOCUMENT_MAX_BYTES", 50 * 1024**2))
+# Downloads running at the same time for a batch of urls
+DOCUMENT_FETCH_CONCURRENCY = int(os.getenv("DOCUMENT_FETCH_CONCURRENCY", 8))
+
+# DOCUMENT PARSING - see api/parsing.py
+# Processes reading PDFs and other binary files, 0 reads them in the calling thread
+DOCUMENT_PARSE_PROCESSES = int(
+    os.getenv("DOCUMENT_PARSE_PROCESSES", min(4, os.cpu_count() or 1))
+)
+# Reads queued for the processes before the next one waits for room
+DOCUMENT_PARSE_MAX_PENDING = int(
+    os.getenv("DOCUMENT_PARSE_MAX_PENDING", 4 * max(DOCUMENT_PARSE_PROCESSES, 1))
+)
+# A longer PDF is split in ranges of that many pages read by different processes
+DOCUMENT_PARSE_PAGES_PER_TASK = int(os.getenv("DOCUMENT_PARSE_PAGES_PER_TASK", 16))
+DOCUMENT_PARSE_TIMEOUT = int(os.getenv("DOCUMENT_PARSE_TIMEOUT", 120))  # seconds
+# Nodes of a document kept for embedding by the keyword pre-filter (api/selection.py),
+# 0 keeps them all
+DOCUMENT_PREFILTER_MAX_NODES = int(os.getenv("DOCUMENT_PREFILTER_MAX_NODES", 200))
+
+# EMBEDDINGS - see api/embeddings.py
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", BASE_DIR / "embeddings")
+EMBEDDING_API_BASE = os.getenv("EMBEDDING_API_BASE")  # defaults to OpenAI
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 20000))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", 4))
+
+# CARD DEDUPLICATION - see api/dedup.py
+# "flag" keeps the new cards repeating one of the user's cards in the "duplicate"
+# state, "skip" leaves them out (a session repeating older ones may end up empty),
+# "off" keeps them as they are
+CARD_DEDUP = os.getenv("CARD_DEDUP", "flag")
+# Cards whose SimHashes are at most that many bits apart (0 to 3) are duplicates, 0
+# only matches the same words
+CARD_DEDUP_MAX_DISTANCE = int(os.getenv("CARD_DEDUP_MAX_DISTANCE", 3))
+
+# BULK CARD UPDATES - see api/bulk.py
+# Changes a single request may carry
+CARD_BULK_MAX_ITEMS = int(os.getenv("CARD_BULK_MAX_ITEMS", 500))
+
+# EXPORT - see api/export.py
+# Rows read per query while streaming an export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 2000))
+
+# CARD SEARCH - see api/search.py
+# Dimensions of the card embeddings kept for semantic search, 0 keeps them all
+SEARCH_EMBEDDING_DIMENSIONS = int(os.getenv("SEARCH_EMBEDDING_DIMENSIONS", 256))
+# Cards without an embedding a search embeds itself, a call to the embedding API while
+# the user waits. With 0 they are left to the generation worker.
+SEARCH_EMBED_BATCH = int(os.getenv("SEARCH_EMBED_BATCH", 0))
+# Authors whose card embeddings stay in memory, and for how many seconds
+SEARCH_MATRIX_CACHE_SIZE = int(os.getenv("SEARCH_MATRIX_CACHE_SIZE", 8))
+SEARCH_MATRIX_TTL = int(os.getenv("SEARCH_MATRIX_TTL", 60))
+
+# VIEW CACHE - see api/caching.py
+# Cache shared by the web and generation workers, e.g. "redis://localhost:6379/1".
+# Without one the read views are not cached: a cache of each process would miss the
+# writes of the others and serve stale cards.
+VIEW_CACHE_URL = os.getenv("VIEW_CACHE_URL", "")
+VIEW_CACHE_BACKEND = os.getenv(
+    "VIEW_CACHE_BACKEND", "django.core.cache.backends.redis.RedisCache"
+)
+# Seconds a response is served from the cache at most, 0 turns it off
+VIEW_CACHE_TTL = int(os.getenv("VIEW_CACHE_TTL", 300)) if VIEW_CACHE_URL else 0
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "views": (
+        {"BACKEND": VIEW_CACHE_BACKEND, "LOCATION": VIEW_CACHE_URL}
+        if VIEW_CACHE_URL
+        else {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    ),
+}
+
+# RETRIEVAL - see api/retrieval.py
+# Chunks retrieved by similarity before deduplication, reranking and packing
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", 40))
+# Tokens of context sent with a query, and the fewest/most chunks whatever their size
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", 6000))
+RETRIEVAL_MIN_CHUNKS = int(os.getenv("RETRIEVAL_MIN_CHUNKS", 3))
+RETRIEVAL_MAX_CHUNKS = int(os.getenv("RETRIEVAL_MAX_CHUNKS", 30))
+# Chunks less similar to the query than that fraction of the best one are dropped
+RETRIEVAL_MIN_SCORE_RATIO = float(os.getenv("RETRIEVAL_MIN_SCORE_RATIO", 0.75))
+# Maximal marginal relevance: 1 ranks by relevance only, lower favors diverse chunks
+RETRIEVAL_MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", 0.7))
+# Chunks at least that similar to a kept one are duplicates
+RETRIEVAL_DUPLICATE_SIMILARITY = float(
+    os.getenv("RETRIEVAL_DUPLICATE_SIMILARITY", 0.97)
+)
+# Local cross-encoder reranking the chunks, e.g. "BAAI/bge-reranker-base", off if empty
+RETRIEVAL_RERANKER = os.getenv("RETRIEVAL_RERANKER", "")
+
 
 SECRET_KEY = "django-insecure-!m^e3+wjuy4k&vlaex1h=py2pfv1(#o)%c1lqx#!-0(l3zk*j0"
 
@@ -27,7 +176,8 @@ CSRF_TRUSTED_ORIGINS = ["http://*", "https://web-production-5cab7.up.railway.app
 # JWT to work
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        # JWTAuthentication with the users cached, see api/caching.py
+        "api.caching.CachedJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
@@ -57,8 +207,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Request timings for /metrics, first so it covers the other middleware
+    "api.middleware.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    # ETag/If-None-Match for the API responses
+    "django.middleware.http.ConditionalGetMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",